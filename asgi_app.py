@@ -0,0 +1,218 @@
+"""
+ASGI 版本的 webhook 伺服器
+提供與 main.py 相同的 /callback、/audio/<id> 與 / 路由；
+翻譯與語音流程與 main.py 共用 pipeline.Pipeline，以 pipeline.AsyncIO 執行：
+翻譯、gTTS 與 LINE 回覆經由共用的 httpx.AsyncClient 非同步呼叫，轉檔使用 asyncio 子行程，
+同時處理中的訊息數不受執行緒數限制；音訊儲存與翻譯記憶等本機的阻塞呼叫交給執行緒池
+
+快取、語言檢測、音訊儲存等狀態與 main.py 共用同一套實作
+
+啟動方式:
+    uvicorn asgi_app:app --host 0.0.0.0 --port $PORT
+"""
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+from linebot.exceptions import InvalidSignatureError
+from werkzeug.http import parse_range_header, parse_etags
+
+# 阻塞呼叫（音訊儲存、翻譯記憶、沒有非同步實作的翻譯後端）使用的執行緒數；
+# 翻譯後端的用戶端池大小與其相同（需在匯入 main 之前設定）
+ASGI_THREADS = int(os.getenv('ASGI_THREADS', 16))
+os.environ.setdefault('TRANSLATION_POOL_SIZE', str(ASGI_THREADS))
+
+import main
+from pipeline import AsyncIO
+
+# 同時處理中的事件上限，超過時 /callback 回應 503
+ASGI_MAX_INFLIGHT = int(os.getenv('ASGI_MAX_INFLIGHT', 500))
+HTTP_TIMEOUT = float(os.getenv('ASGI_HTTP_TIMEOUT', 10))
+
+_client = None
+_inflight = 0
+
+
+def _create_client():
+    # httpx 0.13（googletrans 固定的版本）使用 PoolLimits，新版使用 Limits
+    if hasattr(httpx, 'Limits'):
+        limits = httpx.Limits(max_keepalive_connections=20, max_connections=ASGI_MAX_INFLIGHT)
+        return httpx.AsyncClient(timeout=HTTP_TIMEOUT, limits=limits)
+    limits = httpx.PoolLimits(soft_limit=20, hard_limit=ASGI_MAX_INFLIGHT)
+    return httpx.AsyncClient(timeout=HTTP_TIMEOUT, pool_limits=limits)
+
+
+def get_client():
+    """取得共用的非同步 HTTP 用戶端（保持連線）"""
+    global _client
+    if _client is None:
+        _client = _create_client()
+    return _client
+
+
+executor = ThreadPoolExecutor(max_workers=ASGI_THREADS, thread_name_prefix='asgi')
+async_io = AsyncIO(main.translation_backend, main.transcoder, executor, get_client,
+                   main.LINE_API_ENDPOINT, os.getenv('LINE_CHANNEL_ACCESS_TOKEN'),
+                   tts_concurrency=main.TTS_CONCURRENCY)
+
+
+async def _process_delivery(events):
+    """處理一次投遞中的所有事件（多事件時先合併翻譯，再以最多 EVENT_FANOUT 個事件同時處理）"""
+    global _inflight
+    try:
+        await main.bot_pipeline.process_events(async_io, events)
+    finally:
+        _inflight -= len(events)
+
+
+async def _read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+
+async def _respond(send, status, body=b'', headers=None, content_type='text/plain; charset=utf-8'):
+    header_list = [(b'content-type', content_type.encode())]
+    if 'content-length' not in (headers or {}):
+        header_list.append((b'content-length', str(len(body)).encode()))
+    for name, value in (headers or {}).items():
+        header_list.append((name.encode(), str(value).encode()))
+    await send({'type': 'http.response.start', 'status': status, 'headers': header_list})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+def _request_base_url(scope, headers):
+    host = headers.get('host') or f"{scope['server'][0]}:{scope['server'][1]}"
+    return f"{scope.get('scheme', 'http')}://{host}"
+
+
+async def callback(scope, receive, send, headers):
+    """驗證簽名後立即回應，事件在背景以 asyncio 工作處理"""
+    global _inflight
+    signature = headers.get('x-line-signature', '')
+    body = (await _read_body(receive)).decode('utf-8')
+    if not signature:
+        return await _respond(send, 400, b'Bad Request')
+    main.set_base_url(os.getenv('BASE_URL', '') or _request_base_url(scope, headers))
+    try:
+        with main.timed('verify'):
+            payload = main.handler.parser.parse(body, signature, as_payload=True)
+    except InvalidSignatureError:
+        return await _respond(send, 400, b'Bad Request')
+    if _inflight + len(payload.events) > ASGI_MAX_INFLIGHT:
+        print(f"處理中事件已滿，拒絕投遞 (inflight={_inflight})")
+        return await _respond(send, 503, b'Busy', {'retry-after': 1})
+    if payload.events:
+        _inflight += len(payload.events)
+        async_io.submit(None, _process_delivery, payload.events)
+    await _respond(send, 200, b'OK')
+
+
+async def serve_audio(scope, send, headers, audio_id):
+    """提供音訊檔案（支援 Range 與 If-None-Match）"""
+    # 語音仍在本行程生成中時等待其完成；儲存查詢在執行緒池中執行（disk 後端會讀取檔案）
+    await async_io.wait(audio_id, main.AUDIO_WAIT_TIMEOUT)
+    entry = await async_io.call(main.audio_cache.get, audio_id)
+    if entry is None and main.AUDIO_PIPELINE and main.audio_cache.shared:
+        # 只等待共用儲存中標記為生成中的語音，其餘立即 404
+        deadline = time.monotonic() + main.AUDIO_WAIT_TIMEOUT
+        while entry is None and time.monotonic() < deadline:
+            pending = await async_io.call(main.audio_cache.is_pending, audio_id, main.AUDIO_WAIT_TIMEOUT * 4)
+            entry = await async_io.call(main.audio_cache.get, audio_id)
+            if entry is not None or not pending:
+                break
+            await asyncio.sleep(0.1)
+    if entry is None:
+        return await _respond(send, 404, b'Not Found')
+    mimetype = 'audio/mp4' if entry.format == 'm4a' else 'audio/mpeg'
+    common = {
+        'etag': f'"{entry.etag}"',
+        'accept-ranges': 'bytes',
+        'cache-control': 'public, max-age=3600',
+        'access-control-allow-origin': '*',
+        'content-disposition': f'inline; filename="audio.{entry.format}"',
+    }
+    if parse_etags(headers.get('if-none-match')).contains(entry.etag):
+        return await _respond(send, 304, b'', dict(common, **{'content-length': 0}), mimetype)
+    # bytes 或 mmap 的 memoryview，直接送出不複製
+    body = entry.data
+    status = 200
+    range_header = None
+    if ',' not in headers.get('range', ''):
+        # 多段 Range 不支援，忽略 Range 改回完整的 200 回應
+        range_header = parse_range_header(headers.get('range'))
+    if range_header is not None:
+        byte_range = range_header.range_for_length(entry.size)
+        if byte_range is None:
+            return await _respond(send, 416, b'', {'content-range': f'bytes */{entry.size}'}, mimetype)
+        start, stop = byte_range
+        body = memoryview(entry.data)[start:stop]
+        common['content-range'] = range_header.to_content_range_header(entry.size)
+        status = 206
+    if scope['method'] == 'HEAD':
+        return await _respond(send, status, b'', dict(common, **{'content-length': len(body)}), mimetype)
+    await _respond(send, status, body, common, mimetype)
+
+
+async def health_check(scope, send, headers):
+    """健康檢查：JSON 或 HTML 分享預覽頁面"""
+    if 'application/json' in headers.get('accept', ''):
+        status = main.service_status()
+        status['server'] = 'asgi'
+        status['asgi_inflight'] = _inflight
+        status['asgi_background_tasks'] = async_io.background_count()
+        status['pending_audio'] = async_io.pending_count()
+        status['coalescing'] = async_io.stats()
+        body = json.dumps(status, ensure_ascii=False).encode('utf-8')
+        return await _respond(send, 200, body, content_type='application/json')
+    base_url = main.get_base_url() or _request_base_url(scope, headers)
+    html = main.app.jinja_env.get_template('index.html').render(base_url=base_url)
+    await _respond(send, 200, html.encode('utf-8'), content_type='text/html; charset=utf-8')
+
+
+async def metrics(send):
+    """Prometheus 指標（與 Flask 版本相同的輸出）"""
+    body = main.metrics_exporter.render().encode('utf-8')
+    await _respond(send, 200, body, content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+async def _lifespan(receive, send):
+    global _client
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            get_client()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            if _client is not None:
+                await _client.aclose()
+                _client = None
+            executor.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    """ASGI 進入點"""
+    if scope['type'] == 'lifespan':
+        return await _lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+    headers = {k.decode('latin-1').lower(): v.decode('latin-1') for k, v in scope['headers']}
+    path = scope['path']
+    method = scope['method']
+    if path == '/callback' and method == 'POST':
+        return await callback(scope, receive, send, headers)
+    if path.startswith('/audio/') and method in ('GET', 'HEAD'):
+        return await serve_audio(scope, send, headers, path[len('/audio/'):])
+    if path == '/' and method in ('GET', 'HEAD'):
+        return await health_check(scope, send, headers)
+    if path == '/metrics' and method == 'GET':
+        return await metrics(send)
+    await _respond(send, 404, b'Not Found')
@@ -0,0 +1,229 @@
+"""
+音訊容器層級處理（不解碼音訊）
+- MP3：解析 MPEG Layer III 幀標頭找出音訊幀範圍，用於把多段 MP3 直接串接成一段
+  （去除各段的 ID3 標籤與 Xing/Info 標頭幀），並由各幀取樣數計算播放長度
+- MP4 / M4A：讀取 moov/mvhd（或 mdhd）的長度；分段 MP4 則加總各 moof 中 trun 的樣本時長
+"""
+
+# Layer III 位元率（kbps），依版本區分
+_BITRATES_V1 = (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320)
+_BITRATES_V2 = (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160)
+# 版本位元 → 取樣率表（3: MPEG-1, 2: MPEG-2, 0: MPEG-2.5）
+_SAMPLE_RATES = {
+    3: (44100, 48000, 32000),
+    2: (22050, 24000, 16000),
+    0: (11025, 12000, 8000),
+}
+
+
+def parse_mp3_header(data, offset):
+    """解析 offset 處的 Layer III 幀標頭，返回 (幀長度, 每幀取樣數, 取樣率, 側資訊長度)；不是有效幀時返回 None"""
+    if offset + 4 > len(data):
+        return None
+    b0, b1, b2, b3 = data[offset], data[offset + 1], data[offset + 2], data[offset + 3]
+    if b0 != 0xFF or (b1 & 0xE0) != 0xE0:
+        return None
+    version = (b1 >> 3) & 0x03
+    layer = (b1 >> 1) & 0x03
+    bitrate_index = b2 >> 4
+    sample_rate_index = (b2 >> 2) & 0x03
+    if version == 1 or layer != 1 or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
+    padding = (b2 >> 1) & 0x01
+    mono = (b3 >> 6) == 3
+    sample_rate = _SAMPLE_RATES[version][sample_rate_index]
+    if version == 3:
+        bitrate = _BITRATES_V1[bitrate_index] * 1000
+        frame_length = 144 * bitrate // sample_rate + padding
+        samples = 1152
+        side_info = 17 if mono else 32
+    else:
+        bitrate = _BITRATES_V2[bitrate_index] * 1000
+        frame_length = 72 * bitrate // sample_rate + padding
+        samples = 576
+        side_info = 9 if mono else 17
+    return (frame_length, samples, sample_rate, side_info)
+
+
+def _id3v2_size(data, offset=0):
+    """ID3v2 標籤長度（含標頭）；沒有標籤時返回 0"""
+    if len(data) - offset >= 10 and bytes(data[offset:offset + 3]) == b'ID3':
+        size = 0
+        for b in data[offset + 6:offset + 10]:
+            size = (size << 7) | (b & 0x7F)
+        footer = 10 if data[offset + 5] & 0x10 else 0
+        return 10 + size + footer
+    return 0
+
+
+def iter_mp3_frames(data):
+    """逐一返回音訊幀 (位置, 幀長度, 每幀取樣數, 取樣率)；跳過 ID3v2 標籤與 Xing/Info 標頭幀"""
+    offset = _id3v2_size(data)
+    length = len(data)
+    first = True
+    while offset + 4 <= length:
+        header = parse_mp3_header(data, offset)
+        if header is None or offset + header[0] > length:
+            if bytes(data[offset:offset + 3]) == b'TAG':
+                break
+            # 失去同步：往後尋找下一個有效幀
+            offset += 1
+            continue
+        frame_length, samples, sample_rate, side_info = header
+        if first:
+            first = False
+            tag = bytes(data[offset + 4 + side_info:offset + 8 + side_info])
+            if tag in (b'Xing', b'Info'):
+                offset += frame_length
+                continue
+        yield (offset, frame_length, samples, sample_rate)
+        offset += frame_length
+
+
+def mp3_audio_range(data):
+    """返回音訊幀所在的 (開始, 結束) 位置；沒有音訊幀時返回 None"""
+    start = end = None
+    for offset, frame_length, _, _ in iter_mp3_frames(data):
+        if start is None:
+            start = offset
+        end = offset + frame_length
+    if start is None:
+        return None
+    return (start, end)
+
+
+def concat_mp3(clips):
+    """逐段返回只含音訊幀的 memoryview，依序寫出即為串接後的 MP3（不解碼、不複製整段音訊）；
+    找不到幀的片段原樣返回"""
+    for clip in clips:
+        view = memoryview(clip)
+        audio_range = mp3_audio_range(view)
+        if audio_range is None:
+            yield view
+        else:
+            yield view[audio_range[0]:audio_range[1]]
+
+
+def mp3_duration_ms(data):
+    """依幀標頭加總取樣數計算 MP3 播放長度（毫秒）；沒有音訊幀時返回 None"""
+    seconds = 0.0
+    found = False
+    for _, _, samples, sample_rate in iter_mp3_frames(data):
+        seconds += samples / sample_rate
+        found = True
+    return int(round(seconds * 1000)) if found else None
+
+
+def _atoms(data, start, end):
+    """逐一返回 MP4 atom 的 (類型, 內容開始位置, 結束位置)"""
+    offset = start
+    while offset + 8 <= end:
+        size = int.from_bytes(data[offset:offset + 4], 'big')
+        kind = bytes(data[offset + 4:offset + 8])
+        header = 8
+        if size == 1:
+            size = int.from_bytes(data[offset + 8:offset + 16], 'big')
+            header = 16
+        elif size == 0:
+            size = end - offset
+        if size < header or offset + size > end:
+            return
+        yield (kind, offset + header, offset + size)
+        offset += size
+
+
+def _find_atom(data, start, end, *path):
+    """依路徑尋找第一個符合的 atom，返回 (內容開始位置, 結束位置) 或 None"""
+    for kind, payload, atom_end in _atoms(data, start, end):
+        if kind == path[0]:
+            if len(path) == 1:
+                return (payload, atom_end)
+            return _find_atom(data, payload, atom_end, *path[1:])
+    return None
+
+
+def _u32(data, offset):
+    return int.from_bytes(data[offset:offset + 4], 'big')
+
+
+def _timescale_duration(data, payload):
+    """讀取 mvhd / mdhd 的 (timescale, duration)"""
+    if data[payload] == 1:
+        return (_u32(data, payload + 20), int.from_bytes(data[payload + 24:payload + 32], 'big'))
+    return (_u32(data, payload + 12), _u32(data, payload + 16))
+
+
+def mp4_duration_ms(data):
+    """由 moov/mvhd 讀取 MP4 播放長度（毫秒）；分段 MP4（mvhd 長度為 0）改為加總各 moof 的樣本時長"""
+    length = len(data)
+    mvhd = _find_atom(data, 0, length, b'moov', b'mvhd')
+    if mvhd is None:
+        return None
+    timescale, duration = _timescale_duration(data, mvhd[0])
+    if duration and timescale:
+        return int(round(duration * 1000 / timescale))
+    mdhd = _find_atom(data, 0, length, b'moov', b'trak', b'mdia', b'mdhd')
+    if mdhd is None:
+        return None
+    timescale, duration = _timescale_duration(data, mdhd[0])
+    if not timescale:
+        return None
+    if duration:
+        return int(round(duration * 1000 / timescale))
+    trex = _find_atom(data, 0, length, b'moov', b'mvex', b'trex')
+    trex_default = _u32(data, trex[0] + 12) if trex else 0
+    total = 0
+    for kind, payload, atom_end in _atoms(data, 0, length):
+        if kind != b'moof':
+            continue
+        for traf_kind, traf, traf_end in _atoms(data, payload, atom_end):
+            if traf_kind == b'traf':
+                total += _traf_duration(data, traf, traf_end, trex_default)
+    return int(round(total * 1000 / timescale)) if total else None
+
+
+def _traf_duration(data, start, end, default_duration):
+    """加總一個 traf 中所有 trun 的樣本時長（timescale 單位）"""
+    total = 0
+    for kind, payload, _ in _atoms(data, start, end):
+        flags = int.from_bytes(data[payload + 1:payload + 4], 'big')
+        if kind == b'tfhd':
+            offset = payload + 8
+            if flags & 0x01:
+                offset += 8
+            if flags & 0x02:
+                offset += 4
+            if flags & 0x08:
+                default_duration = _u32(data, offset)
+        elif kind == b'trun':
+            count = _u32(data, payload + 4)
+            if not flags & 0x100:
+                total += count * default_duration
+                continue
+            offset = payload + 8 + (4 if flags & 0x01 else 0) + (4 if flags & 0x04 else 0)
+            stride = 4 * sum(1 for bit in (0x100, 0x200, 0x400, 0x800) if flags & bit)
+            for i in range(count):
+                total += _u32(data, offset + i * stride)
+    return total
+
+
+def audio_duration_ms(data, audio_format):
+    """依格式從編碼後的資料計算播放長度（毫秒），無法解析時返回 None"""
+    try:
+        if audio_format == 'mp3':
+            return mp3_duration_ms(data)
+        if audio_format == 'm4a':
+            return mp4_duration_ms(data)
+    except (IndexError, ValueError, ZeroDivisionError):
+        return None
+    return None
+
+
+# 無法取得實際長度時（例如語音仍在背景生成）的估計：每字毫秒數依語言而定
+_MS_PER_CHAR = {'vi': 70, 'zh-tw': 230, 'zh-cn': 230}
+
+
+def estimate_duration_ms(text, lang):
+    """依文字長度與語言估計播放長度（毫秒，至少 1000）"""
+    chars = len((text or '').strip())
+    return max(1000, int(chars * _MS_PER_CHAR.get(lang, 125)))
@@ -0,0 +1,499 @@
+"""
+音訊儲存
+可替換的音訊儲存後端（以 AUDIO_STORE 環境變數選擇）：
+- memory：行程內有位元組上限的 LRU 快取，插入、查詢、淘汰皆為 O(1)
+- disk：以內容位址存放的目錄，所有 gunicorn worker 共用，以 mmap 零複製讀取
+- shm：與 disk 相同，但目錄位於 /dev/shm（共享記憶體 tmpfs）
+過期條目由背景執行緒清理，不會在持有鎖時掃描整個快取
+"""
+import hashlib
+import mmap
+import os
+import re
+import tempfile
+import threading
+import time
+from collections import OrderedDict, deque, namedtuple
+
+from audio_format import audio_duration_ms
+
+# path 只有檔案型後端才有，可直接交給 send_file；etag 為音訊內容的雜湊；
+# duration 為從編碼資料解析出的播放長度（毫秒），無法解析時為 None
+AudioEntry = namedtuple('AudioEntry', ['data', 'created_at', 'format', 'size', 'path', 'etag', 'duration'],
+                        defaults=(None, None, None))
+
+AUDIO_FORMATS = ('m4a', 'mp3')
+
+_VALID_ID_RE = re.compile(r'^[0-9a-f-]{8,64}$')
+
+
+def content_etag(data):
+    """以音訊內容的 SHA-256 產生強 ETag"""
+    return hashlib.sha256(data).hexdigest()[:32]
+
+# DiskAudioStore 存放 ETag 與播放長度的旁檔副檔名，以及「生成中」標記的副檔名
+_META_SUFFIX = '.meta'
+_PENDING_SUFFIX = 'pending'
+
+# 每次持有鎖時最多處理的過期紀錄數
+_EXPIRE_BATCH = 128
+
+
+class MemoryAudioStore:
+    """執行緒安全、以位元組計算容量的 LRU 音訊儲存（行程內）"""
+
+    # 只有寫入的行程看得到
+    shared = False
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl=86400, expiry_interval=60):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.expiry_interval = expiry_interval
+        self._entries = OrderedDict()
+        # (建立時間, audio_id)，依插入順序即為時間順序；被淘汰或覆寫的紀錄延遲清除
+        self._expiry = deque()
+        self._lock = threading.Lock()
+        self._expiry_thread = None
+        self.current_bytes = 0
+        self.evictions = 0
+        self.expired = 0
+
+    def put(self, audio_id, data, audio_format, duration=None):
+        """儲存音訊；超過容量時淘汰最久未使用的條目，單筆大於上限則返回 False"""
+        size = len(data)
+        if size > self.max_bytes:
+            return False
+        self._start_expiry_thread()
+        created_at = time.monotonic()
+        etag = content_etag(data)
+        if duration is None:
+            duration = audio_duration_ms(data, audio_format)
+        with self._lock:
+            old = self._entries.pop(audio_id, None)
+            if old is not None:
+                self.current_bytes -= old.size
+            self._entries[audio_id] = AudioEntry(data, created_at, audio_format, size,
+                                                etag=etag, duration=duration)
+            self._expiry.append((created_at, audio_id))
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.current_bytes -= evicted.size
+                self.evictions += 1
+        return True
+
+    def get(self, audio_id):
+        """取得音訊條目並標記為最近使用，不存在返回 None"""
+        with self._lock:
+            entry = self._entries.get(audio_id)
+            if entry is not None:
+                self._entries.move_to_end(audio_id)
+            return entry
+
+    def expire(self):
+        """移除超過 ttl 的條目，每批只持有鎖處理少量紀錄，返回移除數量"""
+        cutoff = time.monotonic() - self.ttl
+        removed = 0
+        while True:
+            with self._lock:
+                for _ in range(_EXPIRE_BATCH):
+                    if not self._expiry or self._expiry[0][0] > cutoff:
+                        break
+                    created_at, audio_id = self._expiry.popleft()
+                    entry = self._entries.get(audio_id)
+                    if entry is not None and entry.created_at == created_at:
+                        del self._entries[audio_id]
+                        self.current_bytes -= entry.size
+                        removed += 1
+                else:
+                    continue
+                break
+        with self._lock:
+            self.expired += removed
+            needs_compact = len(self._expiry) > 2 * len(self._entries) + 1024
+        if needs_compact:
+            self._compact()
+        return removed
+
+    def _compact(self):
+        """清除已被 LRU 淘汰或覆寫的過期紀錄，過濾在鎖外進行"""
+        with self._lock:
+            old, self._expiry = self._expiry, deque()
+        # 建立時間每次 put 都不同，失效的紀錄之後不會再變為有效
+        kept = deque(r for r in old if getattr(self._entries.get(r[1]), 'created_at', None) == r[0])
+        with self._lock:
+            kept.extend(self._expiry)
+            self._expiry = kept
+
+    def _start_expiry_thread(self):
+        # 在第一次寫入時才啟動，確保執行緒屬於 gunicorn fork 之後的 worker
+        if self._expiry_thread is not None:
+            return
+        with self._lock:
+            if self._expiry_thread is not None:
+                return
+            self._expiry_thread = threading.Thread(target=self._expiry_loop, name="audio-expiry", daemon=True)
+            self._expiry_thread.start()
+
+    def _expiry_loop(self):
+        while True:
+            time.sleep(self.expiry_interval)
+            try:
+                self.expire()
+            except Exception as e:
+                print(f"音訊過期清理錯誤: {e}")
+
+    def mark_pending(self, audio_id):
+        # 只有寫入的行程看得到，生成中的語音由 PendingAudio 追蹤
+        pass
+
+    def clear_pending(self, audio_id):
+        pass
+
+    def is_pending(self, audio_id, max_age=60):
+        return False
+
+    def __contains__(self, audio_id):
+        with self._lock:
+            return audio_id in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def stats(self):
+        """返回目前位元組數、條目數與淘汰次數"""
+        with self._lock:
+            return {
+                "backend": "memory",
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "evictions": self.evictions,
+                "expired": self.expired,
+            }
+
+
+class DiskAudioStore:
+    """以內容位址存放在目錄中的音訊儲存，多個 worker 行程共用同一目錄"""
+
+    shared = True
+
+    def __init__(self, directory, max_bytes=64 * 1024 * 1024, ttl=86400, expiry_interval=60):
+        self.directory = directory
+        self.ttl = ttl
+        self.expiry_interval = expiry_interval
+        os.makedirs(directory, exist_ok=True)
+        try:
+            fs = os.statvfs(directory)
+            self.block_size = fs.f_frsize or 4096
+            capacity = fs.f_blocks * fs.f_frsize
+        except (OSError, AttributeError):
+            self.block_size, capacity = 4096, 0
+        # tmpfs（Docker 的 /dev/shm 預設只有 64 MB）寫滿時所有新語音都會寫入失敗，
+        # 上限不超過檔案系統容量的 80%，保留空間給旁檔與寫入中的暫存檔
+        if capacity and max_bytes > capacity * 0.8:
+            limited = int(capacity * 0.8)
+            print(f"音訊儲存上限 {max_bytes} bytes 超過 {directory} 容量的 80%，改為 {limited} bytes")
+            max_bytes = limited
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._expiry_thread = None
+        self._wake = threading.Event()
+        # 位元組數（檔案實際占用的區塊，含 .meta 等旁檔）與條目數由最近一次清理掃描得出，之後累加本行程的寫入
+        self.current_bytes = 0
+        self.entry_count = 0
+        self.evictions = 0
+        self.expired = 0
+
+    def _path(self, audio_id, audio_format):
+        return os.path.join(self.directory, audio_id[:2], f"{audio_id}.{audio_format}")
+
+    def _usage(self, size):
+        """檔案在檔案系統上占用的位元組數：至少一個區塊，並進位到區塊大小"""
+        return max(1, -(-size // self.block_size)) * self.block_size
+
+    def _file_usage(self, st):
+        return self._usage(max(st.st_size, getattr(st, 'st_blocks', 0) * 512))
+
+    def put(self, audio_id, data, audio_format, duration=None):
+        """原子寫入音訊檔案；相同 ID 已存在時直接返回，寫入失敗返回 False
+        （ETag 與播放長度在寫入時算好，存在旁邊的 .meta 檔，讀取時不再雜湊或解析幀標頭）"""
+        size = len(data)
+        if size > self.max_bytes or not _VALID_ID_RE.match(audio_id):
+            return False
+        self._start_expiry_thread()
+        path = self._path(audio_id, audio_format)
+        if os.path.exists(path):
+            return True
+        if duration is None:
+            duration = audio_duration_ms(data, audio_format)
+        meta = f"{content_etag(data)}\n{duration or ''}\n".encode('ascii')
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # 先寫 .meta 再寫音訊檔，讀到音訊檔時 .meta 一定已存在
+            self._write_atomic(path + _META_SUFFIX, meta)
+            self._write_atomic(path, data)
+        except OSError as e:
+            # 多半是檔案系統已滿（ENOSPC），立即喚醒清理而不是等到下一次定期清理
+            print(f"音訊寫入失敗: {e}")
+            self._wake.set()
+            return False
+        with self._lock:
+            self.current_bytes += self._usage(size) + self._usage(len(meta))
+            self.entry_count += 1
+            over_budget = self.current_bytes > self.max_bytes
+        if over_budget:
+            # 交給背景執行緒提前清理，不讓寫入的請求負擔目錄掃描
+            self._wake.set()
+        return True
+
+    @staticmethod
+    def _write_atomic(path, data):
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    @staticmethod
+    def _read_meta(path, data, audio_format):
+        """讀取 put 時存下的 (ETag, 播放長度)；.meta 遺失時才從內容重新計算"""
+        try:
+            with open(path + _META_SUFFIX, 'rb') as f:
+                etag, _, duration = f.read().decode('ascii').partition('\n')
+            duration = duration.strip()
+            return etag, int(duration) if duration else None
+        except (OSError, ValueError):
+            return content_etag(data), audio_duration_ms(data, audio_format)
+
+    def get(self, audio_id):
+        """以 mmap 開啟音訊檔案並返回條目（data 為唯讀 memoryview），不存在返回 None"""
+        if not _VALID_ID_RE.match(audio_id):
+            return None
+        for audio_format in AUDIO_FORMATS:
+            path = self._path(audio_id, audio_format)
+            try:
+                with open(path, 'rb') as f:
+                    st = os.fstat(f.fileno())
+                    if st.st_size == 0:
+                        continue
+                    data = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+            except FileNotFoundError:
+                continue
+            now = time.time()
+            if now - st.st_mtime > self.ttl:
+                return None
+            if now - st.st_mtime > 60:
+                # 以 mtime 記錄最近使用時間（LRU），每分鐘最多更新一次
+                try:
+                    os.utime(path)
+                except OSError:
+                    pass
+            etag, duration = self._read_meta(path, data, audio_format)
+            return AudioEntry(data, st.st_mtime, audio_format, st.st_size, path, etag, duration)
+        return None
+
+    def mark_pending(self, audio_id):
+        """建立「生成中」標記，讓其他 worker 的 /audio/<id> 知道值得等待"""
+        if not _VALID_ID_RE.match(audio_id):
+            return
+        path = self._path(audio_id, _PENDING_SUFFIX)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb'):
+                pass
+        except OSError as e:
+            print(f"建立生成中標記失敗: {e}")
+
+    def clear_pending(self, audio_id):
+        if _VALID_ID_RE.match(audio_id):
+            self._unlink(self._path(audio_id, _PENDING_SUFFIX))
+
+    def is_pending(self, audio_id, max_age=60):
+        """是否有 worker 正在生成此音訊（超過 max_age 秒的標記視為生成行程已中斷）"""
+        if not _VALID_ID_RE.match(audio_id):
+            return False
+        try:
+            st = os.stat(self._path(audio_id, _PENDING_SUFFIX))
+        except FileNotFoundError:
+            return False
+        return time.time() - st.st_mtime <= max_age
+
+    def expire(self):
+        """刪除超過 ttl 未使用的檔案，並依最近使用時間淘汰至位元組上限內，返回刪除數量；
+        位元組數以檔案實際占用的區塊計算，.meta、生成中標記與暫存檔也計入"""
+        now = time.time()
+        files = []
+        metas = {}
+        removed = set()
+        overhead = 0
+        expired = 0
+        for sub in os.scandir(self.directory):
+            if not sub.is_dir():
+                continue
+            for item in os.scandir(sub.path):
+                try:
+                    st = item.stat()
+                except FileNotFoundError:
+                    continue
+                if item.name.endswith(_META_SUFFIX):
+                    # .meta 隨音訊檔一起刪除；只清理音訊檔已不存在的孤兒
+                    if now - st.st_mtime > 300 and not os.path.exists(item.path[:-len(_META_SUFFIX)]):
+                        self._unlink(item.path)
+                    else:
+                        metas[item.path[:-len(_META_SUFFIX)]] = self._file_usage(st)
+                    continue
+                too_old = now - st.st_mtime > self.ttl
+                stale_tmp = item.name.endswith(('.tmp', '.' + _PENDING_SUFFIX)) and now - st.st_mtime > 300
+                if too_old or stale_tmp:
+                    if self._unlink(item.path) and not stale_tmp:
+                        expired += 1
+                    removed.add(item.path)
+                elif item.name.endswith(('.tmp', '.' + _PENDING_SUFFIX)):
+                    overhead += self._file_usage(st)
+                else:
+                    files.append((st.st_mtime, self._file_usage(st), item.path))
+        # 每個條目的占用含其 .meta；淘汰音訊檔時 .meta 一起刪除
+        files = [(mtime, usage + metas.pop(path, 0), path) for mtime, usage, path in files]
+        for path in removed:
+            metas.pop(path, None)
+        overhead += sum(metas.values())
+        total = overhead + sum(usage for _, usage, _ in files)
+        evicted = 0
+        if total > self.max_bytes:
+            files.sort()
+            while files and total > self.max_bytes:
+                _, usage, path = files.pop(0)
+                if self._unlink(path):
+                    evicted += 1
+                total -= usage
+        with self._lock:
+            self.current_bytes = total
+            self.entry_count = len(files)
+            self.expired += expired
+            self.evictions += evicted
+        return expired + evicted
+
+    @staticmethod
+    def _unlink(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            # 其他 worker 已刪除
+            return False
+        if not path.endswith(('.tmp', _META_SUFFIX, '.' + _PENDING_SUFFIX)):
+            try:
+                os.remove(path + _META_SUFFIX)
+            except FileNotFoundError:
+                pass
+        return True
+
+    def _start_expiry_thread(self):
+        if self._expiry_thread is not None:
+            return
+        with self._lock:
+            if self._expiry_thread is not None:
+                return
+            self._expiry_thread = threading.Thread(target=self._expiry_loop, name="audio-expiry", daemon=True)
+            self._expiry_thread.start()
+
+    def _expiry_loop(self):
+        while True:
+            self._wake.wait(self.expiry_interval)
+            self._wake.clear()
+            try:
+                self.expire()
+            except Exception as e:
+                print(f"音訊過期清理錯誤: {e}")
+
+    def __contains__(self, audio_id):
+        # 只檢查檔案是否存在且未過期，不開啟檔案
+        if not _VALID_ID_RE.match(audio_id):
+            return False
+        for audio_format in AUDIO_FORMATS:
+            try:
+                st = os.stat(self._path(audio_id, audio_format))
+            except FileNotFoundError:
+                continue
+            if st.st_size > 0:
+                return time.time() - st.st_mtime <= self.ttl
+        return False
+
+    def __len__(self):
+        with self._lock:
+            return self.entry_count
+
+    def stats(self):
+        """返回目前占用的位元組數、條目數與淘汰次數（位元組數與條目數在每次清理時校正）"""
+        with self._lock:
+            return {
+                "backend": "disk",
+                "directory": self.directory,
+                "entries": self.entry_count,
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "evictions": self.evictions,
+                "expired": self.expired,
+            }
+
+
+class PendingAudio:
+    """生成中的音訊：每個 audio_id 對應一個 Future，讓 /audio/<id> 可以等待生成完成"""
+
+    def __init__(self, executor):
+        self._executor = executor
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def submit(self, audio_id, fn, *args):
+        """在背景生成音訊；相同 audio_id 已在生成中則返回既有的 Future"""
+        with self._lock:
+            future = self._futures.get(audio_id)
+            if future is not None:
+                return future
+            future = self._executor.submit(fn, *args)
+            self._futures[audio_id] = future
+        # fn 在 Future 完成前已寫入儲存，因此移除後查詢儲存即可取得音訊
+        future.add_done_callback(lambda f: self._discard(audio_id, f))
+        return future
+
+    def _discard(self, audio_id, future):
+        with self._lock:
+            if self._futures.get(audio_id) is future:
+                del self._futures[audio_id]
+
+    def wait(self, audio_id, timeout):
+        """等待生成中的音訊完成；沒有對應的生成工作返回 False"""
+        with self._lock:
+            future = self._futures.get(audio_id)
+        if future is None:
+            return False
+        try:
+            future.result(timeout=timeout)
+        except Exception:
+            # 逾時或生成失敗都交由呼叫端查詢儲存後決定是否 404
+            pass
+        return True
+
+    def __len__(self):
+        with self._lock:
+            return len(self._futures)
+
+
+def create_audio_store(kind='memory', directory=None, **options):
+    """依類型建立音訊儲存後端：memory / disk / shm"""
+    kind = (kind or 'memory').lower()
+    if kind == 'memory':
+        return MemoryAudioStore(**options)
+    if kind == 'disk':
+        return DiskAudioStore(directory or os.path.join(tempfile.gettempdir(), 'line-bot-audio'), **options)
+    if kind == 'shm':
+        return DiskAudioStore(directory or '/dev/shm/line-bot-audio', **options)
+    raise ValueError(f"未知的音訊儲存後端: {kind}")
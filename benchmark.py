@@ -0,0 +1,479 @@
+#!/usr/bin/env python3
+"""
+Webhook 效能基準測試
+以本地 stub 伺服器取代 Google 翻譯、gTTS 與 LINE reply API（可設定延遲），
+依序啟動各個伺服器設定（Flask / gunicorn、ASGI / uvicorn，可加上環境變數），
+以固定併發或固定速率送出簽名的 webhook，比較延遲百分位數、吞吐量、錯誤率與記憶體用量
+
+使用方法:
+    python benchmark.py                                  # 比較 flask 與 asgi
+    python benchmark.py --apps asgi --messages 500 --concurrency 100
+    python benchmark.py --latency 0.3                    # 每個上游請求延遲 300ms
+    python benchmark.py --rate 50                        # 每秒送出 50 則（開放式負載）
+    python benchmark.py --config sync=flask --config queue=flask,WEBHOOK_MODE=queue --output after.json
+"""
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+BENCH_SECRET = 'benchmark-channel-secret'
+BENCH_TOKEN = 'benchmark-access-token'
+
+SAMPLE_TEXTS = [
+    'Xin chào, bạn khỏe không?',
+    'Cảm ơn bạn rất nhiều.',
+    'Hôm nay thời tiết đẹp quá.',
+    'Cái này bao nhiêu tiền?',
+    'Tôi muốn đi đến ga tàu.',
+]
+
+
+def silent_mp3(frames=40):
+    """產生靜音 MP3（MPEG-2 Layer III, 24kHz 單聲道 32kbps，每幀 96 bytes / 24ms）"""
+    header = bytes([0xFF, 0xF3, 0x44, 0xC0])
+    return (header + b'\x00' * 92) * frames
+
+
+class StubState:
+    """stub 伺服器的設定與收到的翻譯請求、LINE 回覆 / push 訊息"""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.replies = {}
+        self.reply_messages = {}
+        self.pushes = []
+        self.translations = []
+        self.lock = threading.Lock()
+        self.mp3 = silent_mp3()
+
+
+def _translate_request(f_req):
+    """從 googletrans 的 f.req 取出 (文字, 來源語言, 目標語言)"""
+    rpc = json.loads(json.loads(f_req)[0][0][1])
+    return rpc[0][0], rpc[0][1], rpc[0][2]
+
+
+def _translate_response(f_req):
+    text, src, dest = _translate_request(f_req)
+    src = 'vi' if src == 'auto' else src
+    # 逐行加上目標語言標記，與真實翻譯一樣保留換行（批次翻譯依換行拆回各句）
+    translated = '\n'.join(f'[{dest}] {line}' for line in text.split('\n'))
+    parsed = [[None, None, src], [[[None, None, None, True, None, [[translated]]]]], src]
+    line = json.dumps([['wrb.fr', 'MkEWBc', json.dumps(parsed), None, None, None, 'generic']])
+    return f")]}}'\n\n{len(line)}\n{line}\n"
+
+
+def make_stub_handler(state):
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send(self, body, content_type='application/json'):
+            body = body.encode('utf-8') if isinstance(body, str) else body
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            time.sleep(state.latency)
+            if self.path.startswith('/translate_rpc'):
+                form = urllib.parse.parse_qs(body.decode('utf-8'))
+                with state.lock:
+                    state.translations.append(_translate_request(form['f.req'][0]))
+                self._send(_translate_response(form['f.req'][0]), 'text/plain; charset=utf-8')
+            elif self.path.startswith('/tts_rpc'):
+                audio = base64.b64encode(state.mp3).decode('ascii')
+                line = json.dumps([['wrb.fr', 'jQ1olc', json.dumps([audio]), None, None, None, 'generic']],
+                                  separators=(',', ':'))
+                self._send(f")]}}'\n\n{len(line)}\n{line}\n", 'text/plain; charset=utf-8')
+            elif self.path.startswith('/v2/bot/message/reply'):
+                payload = json.loads(body)
+                with state.lock:
+                    state.replies[payload['replyToken']] = (time.time(), len(payload['messages']))
+                    state.reply_messages[payload['replyToken']] = payload['messages']
+                self._send('{}')
+            elif self.path.startswith('/v2/bot/message/push'):
+                payload = json.loads(body)
+                with state.lock:
+                    state.pushes.append((time.time(), payload['to'], len(payload['messages'])))
+                self._send('{}')
+            else:
+                self.send_error(404)
+
+    return StubHandler
+
+
+def start_stub_server(latency):
+    """在背景執行緒啟動 stub 伺服器，返回 (伺服器, 狀態, 基礎 URL)"""
+    state = StubState(latency)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), make_stub_handler(state))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, state, f'http://127.0.0.1:{server.server_address[1]}'
+
+
+def point_clients_at_stub(stub_url):
+    """把 googletrans 與 gTTS 的請求導向 stub 伺服器（只在基準測試的子行程中使用）"""
+    import googletrans.urls
+    import gtts.tts
+    googletrans.urls.TRANSLATE_RPC = f'{stub_url}/translate_rpc'
+    gtts.tts._translate_url = lambda tld='com', path='': f'{stub_url}/tts_rpc'
+
+
+def serve(args):
+    """子行程：指向 stub 後啟動指定的伺服器"""
+    point_clients_at_stub(args.stub)
+    if args.app == 'asgi':
+        import uvicorn
+        import asgi_app
+        uvicorn.run(asgi_app.app, host='127.0.0.1', port=args.port, log_level='warning')
+        return
+    from gunicorn.app.base import BaseApplication
+    import main
+
+    class _Gunicorn(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', f'127.0.0.1:{args.port}')
+            self.cfg.set('workers', args.workers)
+            self.cfg.set('threads', args.threads)
+            self.cfg.set('worker_class', 'gthread')
+            self.cfg.set('timeout', 120)
+            self.cfg.set('loglevel', 'warning')
+
+        def load(self):
+            return main.app
+
+    _Gunicorn().run()
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def parse_config(spec):
+    """解析伺服器設定：「名稱=app,環境變數=值,...」；省略名稱時以 app（flask / asgi）為名稱"""
+    parts = [part.strip() for part in spec.split(',') if part.strip()]
+    if not parts:
+        raise ValueError("伺服器設定不可為空")
+    name, sep, app = parts.pop(0).partition('=')
+    if not sep:
+        app = name
+    if app not in ('flask', 'asgi'):
+        raise ValueError(f"未知的伺服器: {app}（可用: flask, asgi）")
+    env = {}
+    for part in parts:
+        key, sep, value = part.partition('=')
+        if not sep:
+            raise ValueError(f"環境變數格式錯誤: {part}")
+        env[key.strip()] = value.strip()
+    return {'name': name, 'app': app, 'env': env}
+
+
+def audio_store_dir(args):
+    """為一個伺服器設定建立空的音訊儲存目錄（shm 放在 /dev/shm），各設定之間不共用已生成的語音"""
+    parent = '/dev/shm' if args.audio_store == 'shm' and os.path.isdir('/dev/shm') else None
+    return tempfile.mkdtemp(prefix='line-bot-bench-', dir=parent)
+
+
+def start_app(config, stub_url, args, audio_dir):
+    """啟動待測伺服器子行程並等待就緒，返回 (子行程, 基礎 URL)"""
+    app = config['app']
+    port = _free_port()
+    env = dict(os.environ,
+               LINE_CHANNEL_SECRET=BENCH_SECRET,
+               LINE_CHANNEL_ACCESS_TOKEN=BENCH_TOKEN,
+               LINE_API_ENDPOINT=stub_url,
+               BASE_URL=f'http://127.0.0.1:{port}',
+               AUDIO_FORMAT=args.audio_format,
+               AUDIO_STORE=args.audio_store,
+               AUDIO_STORE_DIR=audio_dir,
+               TRANSLATION_BACKEND=args.translation_backend,
+               TRANSLATION_STUB_LATENCY=str(args.latency),
+               TTS_RATE_PER_SOURCE='0')
+    env.update(config['env'])
+    cmd = [sys.executable, os.path.abspath(__file__), 'serve', '--app', app, '--port', str(port),
+           '--stub', stub_url, '--workers', str(args.workers), '--threads', str(args.threads)]
+    proc = subprocess.Popen(cmd, env=env, cwd=os.path.dirname(os.path.abspath(__file__)),
+                            stdout=subprocess.DEVNULL, stderr=None if args.verbose else subprocess.DEVNULL)
+    base_url = f'http://127.0.0.1:{port}'
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            requests.get(base_url + '/', headers={'Accept': 'application/json'}, timeout=1)
+            return proc, base_url
+        except requests.RequestException:
+            time.sleep(0.2)
+    proc.kill()
+    raise RuntimeError(f'{app} 伺服器啟動逾時')
+
+
+def process_tree_rss(pid):
+    """加總程序與所有子程序（gunicorn worker）的常駐記憶體（bytes）；沒有 /proc 時返回 None"""
+    children = {}
+    try:
+        names = os.listdir('/proc')
+    except OSError:
+        return None
+    for name in names:
+        if not name.isdigit():
+            continue
+        try:
+            with open(f'/proc/{name}/stat') as f:
+                # 第 2 欄（程序名稱）可能含空白，從最後一個 ')' 之後開始解析
+                fields = f.read().rsplit(')', 1)[1].split()
+            children.setdefault(int(fields[1]), []).append(int(name))
+        except (OSError, IndexError, ValueError):
+            continue
+    total = 0
+    stack = [pid]
+    while stack:
+        current = stack.pop()
+        try:
+            with open(f'/proc/{current}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+                        break
+        except OSError:
+            continue
+        stack.extend(children.get(current, []))
+    return total
+
+
+class RssSampler:
+    """在背景定期取樣伺服器程序樹的記憶體用量，記錄峰值"""
+
+    def __init__(self, pid, interval=0.2):
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self.last = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.sample()
+            self._stop.wait(self.interval)
+
+    def sample(self):
+        rss = process_tree_rss(self.pid)
+        if rss:
+            self.last = rss
+            self.peak = max(self.peak, rss)
+        return rss
+
+    def start(self):
+        self.sample()
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.sample()
+
+
+def signed_payload(text, reply_token, user_id='Ubenchmark'):
+    """產生帶有正確 X-Line-Signature 的 webhook 內容"""
+    body = json.dumps({
+        'destination': 'Ubenchmarkbot',
+        'events': [{
+            'type': 'message',
+            'mode': 'active',
+            'timestamp': int(time.time() * 1000),
+            'source': {'type': 'user', 'userId': user_id},
+            'webhookEventId': reply_token,
+            'deliveryContext': {'isRedelivery': False},
+            'replyToken': reply_token,
+            'message': {'id': reply_token, 'type': 'text', 'text': text},
+        }],
+    }, ensure_ascii=False)
+    signature = base64.b64encode(hmac.new(BENCH_SECRET.encode('utf-8'), body.encode('utf-8'),
+                                          hashlib.sha256).digest()).decode('ascii')
+    return body.encode('utf-8'), signature
+
+
+def _percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+def run_load(base_url, state, args, label):
+    """送出訊息並返回結果統計：rate 為 0 時以固定併發（封閉式），否則依固定速率排程（開放式）"""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=args.concurrency, pool_maxsize=args.concurrency)
+    session.mount('http://', adapter)
+    sent = {}
+    callback_latencies = []
+    errors = 0
+    lock = threading.Lock()
+    started = time.time()
+
+    def send_one(i):
+        nonlocal errors
+        text = SAMPLE_TEXTS[i % len(SAMPLE_TEXTS)]
+        if args.unique:
+            text = f'{text} ({i})'
+        token = f'{label}-{i}'
+        body, signature = signed_payload(text, token, user_id=f'Ubenchmark{i % args.sources}')
+        if args.rate:
+            # 延遲從排定的送出時間算起：伺服器處理不及、請求排隊時的等待也計入
+            scheduled = started + i / args.rate
+            time.sleep(max(0.0, scheduled - time.time()))
+            start = scheduled
+        else:
+            start = time.time()
+        try:
+            response = session.post(base_url + '/callback', data=body,
+                                    headers={'X-Line-Signature': signature, 'Content-Type': 'application/json'},
+                                    timeout=120)
+            ok = response.status_code == 200
+        except requests.RequestException:
+            ok = False
+        with lock:
+            if ok:
+                sent[token] = start
+                callback_latencies.append(time.time() - start)
+            else:
+                errors += 1
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(send_one, range(args.messages)))
+    # 等待所有回覆送達 stub 的 LINE API
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        with state.lock:
+            if all(token in state.replies for token in sent):
+                break
+        time.sleep(0.05)
+    with state.lock:
+        reply_latencies = [state.replies[t][0] - s for t, s in sent.items() if t in state.replies]
+        finished = max([state.replies[t][0] for t in sent if t in state.replies], default=time.time())
+    elapsed = finished - started
+    failed = errors + len(sent) - len(reply_latencies)
+    return {
+        'app': label,
+        'messages': args.messages,
+        'rate': args.rate,
+        'completed': len(reply_latencies),
+        'errors': failed,
+        'error_rate': failed / args.messages if args.messages else 0.0,
+        'elapsed': elapsed,
+        'throughput': len(reply_latencies) / elapsed if elapsed > 0 else 0.0,
+        'callback_p50': _percentile(callback_latencies, 50),
+        'callback_p99': _percentile(callback_latencies, 99),
+        'reply_mean': statistics.mean(reply_latencies) if reply_latencies else 0.0,
+        'reply_p50': _percentile(reply_latencies, 50),
+        'reply_p95': _percentile(reply_latencies, 95),
+        'reply_p99': _percentile(reply_latencies, 99),
+        'reply_max': max(reply_latencies, default=0.0),
+    }
+
+
+def print_results(results):
+    print()
+    print(f"{'config':<12}{'done':>6}{'err%':>7}{'msg/s':>8}{'cb p50':>9}{'cb p99':>9}"
+          f"{'reply p50':>11}{'reply p95':>11}{'reply p99':>11}{'rss peak':>11}")
+    for r in results:
+        rss = f"{r['rss_peak'] / 1048576:.0f}MB" if r.get('rss_peak') else '-'
+        print(f"{r['app']:<12}{r['completed']:>6}{r['error_rate'] * 100:>6.1f}%{r['throughput']:>8.1f}"
+              f"{r['callback_p50'] * 1000:>7.0f}ms{r['callback_p99'] * 1000:>7.0f}ms"
+              f"{r['reply_p50'] * 1000:>9.0f}ms{r['reply_p95'] * 1000:>9.0f}ms"
+              f"{r['reply_p99'] * 1000:>9.0f}ms{rss:>11}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='LINE Bot webhook 效能基準測試')
+    sub = parser.add_subparsers(dest='command')
+    serve_parser = sub.add_parser('serve', help='（內部使用）啟動待測伺服器')
+    serve_parser.add_argument('--app', choices=['flask', 'asgi'], required=True)
+    serve_parser.add_argument('--port', type=int, required=True)
+    serve_parser.add_argument('--stub', required=True)
+    serve_parser.add_argument('--workers', type=int, default=2)
+    serve_parser.add_argument('--threads', type=int, default=2)
+
+    parser.add_argument('--apps', default='flask,asgi', help='要測試的伺服器，以逗號分隔（未指定 --config 時使用）')
+    parser.add_argument('--config', action='append', default=[],
+                        help='伺服器設定「名稱=app,環境變數=值,...」，可重複指定（例: queue=flask,WEBHOOK_MODE=queue）')
+    parser.add_argument('--messages', type=int, default=200, help='訊息總數')
+    parser.add_argument('--concurrency', type=int, default=50, help='同時送出的 webhook 數（--rate 時為送出端執行緒上限）')
+    parser.add_argument('--rate', type=float, default=0, help='每秒送出的訊息數（0：以固定併發盡快送出）')
+    parser.add_argument('--latency', type=float, default=0.2, help='stub 上游每個請求的延遲秒數')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn worker 數（flask）')
+    parser.add_argument('--threads', type=int, default=2, help='每個 gunicorn worker 的執行緒數（flask）')
+    parser.add_argument('--audio-format', default='mp3', help='AUDIO_FORMAT（預設 mp3，不需要 ffmpeg）')
+    parser.add_argument('--audio-store', default='shm', help='AUDIO_STORE')
+    parser.add_argument('--translation-backend', default='googletrans',
+                        help='Flask 版本的 TRANSLATION_BACKEND（stub：不經 HTTP，直接模擬延遲）')
+    parser.add_argument('--sources', type=int, default=1, help='訊息平均分配給幾個不同的使用者')
+    parser.add_argument('--no-unique', dest='unique', action='store_false', help='重複使用相同文字（會命中快取）')
+    parser.add_argument('--output', help='把結果寫成 JSON 檔（方便比較部署前後）')
+    parser.add_argument('--verbose', action='store_true', help='顯示伺服器的錯誤輸出')
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        serve(args)
+        return
+
+    try:
+        configs = [parse_config(spec) for spec in args.config or [a.strip() for a in args.apps.split(',') if a.strip()]]
+    except ValueError as e:
+        parser.error(str(e))
+    stub_server, state, stub_url = start_stub_server(args.latency)
+    print(f"stub 上游: {stub_url}（延遲 {args.latency * 1000:.0f}ms）")
+    load = f"每秒 {args.rate:g} 則" if args.rate else f"併發 {args.concurrency}"
+    results = []
+    for config in configs:
+        # 每個設定使用新的音訊儲存目錄，避免命中前一個設定（或上一次執行）生成的語音
+        audio_dir = audio_store_dir(args)
+        try:
+            proc, base_url = start_app(config, stub_url, args, audio_dir)
+            sampler = RssSampler(proc.pid).start()
+            idle_rss = sampler.last
+            try:
+                print(f"測試 {config['name']}: {args.messages} 則訊息，{load} ...")
+                result = run_load(base_url, state, args, config['name'])
+            finally:
+                sampler.stop()
+                proc.terminate()
+                proc.wait(timeout=10)
+        finally:
+            shutil.rmtree(audio_dir, ignore_errors=True)
+        result.update(server=config['app'], env=config['env'], rss_idle=idle_rss, rss_peak=sampler.peak)
+        results.append(result)
+    stub_server.shutdown()
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'latency': args.latency, 'concurrency': args.concurrency, 'results': results}, f, indent=2)
+        print(f"結果已寫入 {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+"""
+依來源公平排程與限流
+FairQueue 以加權公平佇列（WFQ）決定取出順序：每個來源（使用者 / 群組）依權重分得處理順位，
+單一來源大量投遞時只會排在自己的隊伍後面，不會讓其他來源一直等待；
+SourceLimiter 為每個來源維護一個權杖桶，超出額度的來源改為只回覆文字（不生成語音）
+"""
+import heapq
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+
+class FairQueue:
+    """加權公平佇列，提供 WebhookQueue 使用的 queue.Queue 介面（put / get / qsize / task_done / join）。
+
+    每筆項目的完成標籤 = max(虛擬時間, 該來源上一筆的完成標籤) + cost / weight，依標籤由小到大取出；
+    虛擬時間為最近取出項目的開始標籤，閒置後再出現的來源不會因為過去沒用到的額度而插隊太多"""
+
+    def __init__(self, maxsize=0, weight=None, max_per_key=0):
+        self.maxsize = maxsize
+        self.max_per_key = max_per_key
+        self._weight = weight or (lambda key: 1.0)
+        self._heap = []
+        self._seq = 0
+        self._virtual_time = 0.0
+        self._last_finish = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._all_done = threading.Condition(self._lock)
+        self._unfinished = 0
+
+    def put(self, item, block=True, timeout=None, key=None, cost=1.0):
+        """放入項目；佇列已滿（或該來源已達 max_per_key）且等待逾時後拋出 queue.Full"""
+        with self._not_full:
+            if not block:
+                timeout = 0
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while self._full(key):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise queue.Full
+                self._not_full.wait(remaining)
+            self._push(item, key, cost)
+
+    def put_nowait(self, item, key=None, cost=1.0):
+        self.put(item, block=False, key=key, cost=cost)
+
+    def put_many(self, entries, block=True, timeout=None):
+        """一次放入多筆 (項目, 來源, 成本)：全部都有空位才放入，否則等待逾時後拋出 queue.Full（不會只放入一部分）"""
+        with self._not_full:
+            if not block:
+                timeout = 0
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while self._full_many(entries):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise queue.Full
+                self._not_full.wait(remaining)
+            for item, key, cost in entries:
+                self._push(item, key, cost)
+
+    def _full(self, key):
+        if self.maxsize > 0 and len(self._heap) >= self.maxsize:
+            return True
+        return self.max_per_key > 0 and self._pending.get(key, 0) >= self.max_per_key
+
+    def _full_many(self, entries):
+        if self.maxsize > 0 and self._heap and len(self._heap) + len(entries) > self.maxsize:
+            return True
+        if self.max_per_key > 0:
+            counts = {}
+            for _, key, _ in entries:
+                counts[key] = counts.get(key, 0) + 1
+            return any(self._pending.get(key, 0) + n > self.max_per_key for key, n in counts.items())
+        return False
+
+    def _push(self, item, key, cost):
+        start = max(self._virtual_time, self._last_finish.get(key, 0.0))
+        finish = start + cost / max(self._weight(key), 1e-6)
+        self._last_finish[key] = finish
+        self._pending[key] = self._pending.get(key, 0) + 1
+        self._seq += 1
+        heapq.heappush(self._heap, (finish, self._seq, start, key, item))
+        self._unfinished += 1
+        self._not_empty.notify()
+
+    def get(self, block=True, timeout=None):
+        with self._not_empty:
+            if not block:
+                timeout = 0
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while not self._heap:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise queue.Empty
+                self._not_empty.wait(remaining)
+            finish, _, start, key, item = heapq.heappop(self._heap)
+            self._virtual_time = max(self._virtual_time, start)
+            self._pending[key] -= 1
+            if not self._pending[key]:
+                del self._pending[key]
+                if self._last_finish.get(key, 0.0) <= self._virtual_time:
+                    # 來源已無排隊項目且標籤已落後：移除記錄，避免來源數量無限增長
+                    self._last_finish.pop(key, None)
+            if len(self._last_finish) > 1000 + 2 * len(self._pending):
+                self._last_finish = {k: v for k, v in self._last_finish.items()
+                                     if k in self._pending or v > self._virtual_time}
+            self._not_full.notify_all()
+            return item
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def task_done(self):
+        with self._all_done:
+            self._unfinished -= 1
+            if self._unfinished <= 0:
+                self._all_done.notify_all()
+
+    def join(self):
+        """等待所有已放入的項目處理完成（每個 get() 都需對應一次 task_done()）"""
+        with self._all_done:
+            while self._unfinished > 0:
+                self._all_done.wait()
+
+    def qsize(self):
+        with self._lock:
+            return len(self._heap)
+
+    def sources(self):
+        """目前有排隊項目的來源數"""
+        with self._lock:
+            return len(self._pending)
+
+
+class TokenBucket:
+    """權杖桶：每秒補充 rate 個，最多累積 burst 個"""
+
+    def __init__(self, rate, burst, now=None):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic() if now is None else now
+
+    def consume(self, amount=1.0, now=None):
+        now = time.monotonic() if now is None else now
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return True
+        return False
+
+
+class SourceLimiter:
+    """每個來源一個權杖桶（最近使用的 max_sources 個來源）；rate 為 0 時不限流"""
+
+    def __init__(self, rate, burst, max_sources=10000):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.max_sources = max_sources
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self.allowed = 0
+        self.limited = 0
+
+    def allow(self, key, amount=1.0):
+        """來源仍有額度時扣除並返回 True"""
+        if self.rate <= 0:
+            return True
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(self.rate, self.burst)
+                if len(self._buckets) > self.max_sources:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+            ok = bucket.consume(amount)
+            if ok:
+                self.allowed += 1
+            else:
+                self.limited += 1
+            return ok
+
+    def stats(self):
+        with self._lock:
+            return {
+                "rate": self.rate,
+                "burst": self.burst,
+                "sources": len(self._buckets),
+                "allowed": self.allowed,
+                "limited": self.limited,
+            }
@@ -0,0 +1,54 @@
+"""
+gunicorn 設定（Procfile 以 --config 載入，命令列參數仍可覆寫）
+- on_starting：建立並清空本次 master 的指標快照目錄（METRICS_DIR），worker 繼承此環境變數
+- child_exit：把已結束 worker 的計數器與直方圖併入封存快照（合併後的計數不會下降），再刪除其快照
+- when_ready：設定了 PREWARM_PHRASES_FILE / PREWARM_FROM_HISTORY 時，另開一個 prewarm.py 行程預熱一次
+  （不在每個 worker 匯入 main 時各自預熱，避免重複呼叫翻譯與 gTTS），進度寫入 PREWARM_STATUS_FILE
+- post_worker_init：預熱結果無法共用時（未設定 TRANSLATION_MEMORY_PATH 或音訊儲存不是 disk / shm），
+  改由每個 worker 在背景各自預熱
+"""
+import os
+import subprocess
+import sys
+import tempfile
+
+from metrics import archive_snapshot, clear_snapshots
+from prewarm import command_from_env, prewarm_configured, results_shared
+
+
+def on_starting(server):
+    directory = os.environ.setdefault(
+        'METRICS_DIR', os.path.join(tempfile.gettempdir(), f"line-bot-metrics-{os.getpid()}"))
+    clear_snapshots(directory)
+    status_file = os.environ.setdefault(
+        'PREWARM_STATUS_FILE', os.path.join(tempfile.gettempdir(), f"line-bot-prewarm-{os.getpid()}.json"))
+    try:
+        os.remove(status_file)
+    except OSError:
+        pass
+
+
+def child_exit(server, worker):
+    archive_snapshot(os.getenv('METRICS_DIR'), worker.pid)
+
+
+def when_ready(server):
+    if not prewarm_configured():
+        return
+    command = command_from_env()
+    if command is None:
+        server.log.warning("未設定 TRANSLATION_MEMORY_PATH 或音訊儲存不是 disk / shm，"
+                           "預熱結果無法在 worker 間共用，改由每個 worker 各自預熱")
+        return
+    # 預熱行程的指標不併入服務的 /metrics
+    env = dict(os.environ)
+    env.pop('METRICS_DIR', None)
+    server.log.info("開始快取預熱: %s", ' '.join(command[1:]))
+    subprocess.Popen(command, env=env, cwd=os.path.dirname(os.path.abspath(__file__)))
+
+
+def post_worker_init(worker):
+    if prewarm_configured() and not results_shared():
+        bot = sys.modules.get('main')
+        if bot is not None:
+            bot.start_prewarm()
@@ -0,0 +1,104 @@
+"""
+本地語言檢測
+依文字的書寫系統判斷越南語 / 繁體中文 / 簡體中文，不需要網路請求；
+信心不足時才交給遠端檢測（googletrans）
+"""
+import re
+import threading
+import unicodedata
+
+# 越南語字母中的非 ASCII 字元（小寫，NFC）
+VIETNAMESE_CHARS = set(
+    'àáảãạăằắẳẵặâầấẩẫậđèéẻẽẹêềếểễệìíỉĩịòóỏõọôồốổỗộơờớởỡợùúủũụưừứửữựỳýỷỹỵ'
+)
+
+# 常見的簡體專用字與繁體專用字（對照排列）
+SIMPLIFIED_CHARS = set(
+    '这们个说来时为会对发后国过还没么见样经东学车开关门问间长钱买卖谢请认语话让给电点现实报从头几气写与号机应边运进远连难听'
+    '欢谁该饭馆吗贵们钟书习读汉岁爱热闹乐场视务员题级总区医药边块楼层饮单检签记录费须无条馆线网页组织节简体软'
+)
+TRADITIONAL_CHARS = set(
+    '這們個說來時為會對發後國過還沒麼見樣經東學車開關門問間長錢買賣謝請認語話讓給電點現實報從頭幾氣寫與號機應邊運進遠連難聽'
+    '歡誰該飯館嗎貴們鐘書習讀漢歲愛熱鬧樂場視務員題級總區醫藥邊塊樓層飲單檢簽記錄費須無條館線網頁組織節簡體軟'
+)
+
+_LATIN_WORD_RE = re.compile(r'[^\W\d_]+')
+
+
+def _is_cjk(ch):
+    code = ord(ch)
+    return (0x4E00 <= code <= 0x9FFF or 0x3400 <= code <= 0x4DBF
+            or 0xF900 <= code <= 0xFAFF or 0x20000 <= code <= 0x2A6DF)
+
+
+def detect(text):
+    """本地檢測語言，返回 (語言代碼, 信心值 0~1)；無法判斷時語言代碼為 None"""
+    text = unicodedata.normalize('NFC', text or '').lower()
+    cjk = 0
+    simplified = 0
+    traditional = 0
+    latin_chars = []
+    for ch in text:
+        if _is_cjk(ch):
+            cjk += 1
+            if ch in SIMPLIFIED_CHARS:
+                simplified += 1
+            elif ch in TRADITIONAL_CHARS:
+                traditional += 1
+        elif (ch.isalpha() and ch.isascii()) or ch in VIETNAMESE_CHARS:
+            latin_chars.append(ch)
+        elif ch.isalpha():
+            # 其他書寫系統（日文假名、韓文等）由遠端檢測處理
+            return (None, 0.0)
+    letters = cjk + len(latin_chars)
+    if letters == 0:
+        return (None, 0.0)
+    cjk_ratio = cjk / letters
+    if cjk_ratio >= 0.5:
+        # 繁簡都翻譯成越南語，只有標記字元決定來源變體；沒有標記字元時預設繁體
+        lang = 'zh-cn' if simplified > traditional else 'zh-tw'
+        return (lang, cjk_ratio)
+    words = [w for w in _LATIN_WORD_RE.findall(text) if not any(_is_cjk(c) for c in w)]
+    if not words:
+        return (None, 0.0)
+    vi_words = sum(1 for w in words if any(c in VIETNAMESE_CHARS for c in w))
+    confidence = (1 - cjk_ratio) * min(1.0, 0.5 + vi_words / len(words))
+    return ('vi', confidence)
+
+
+class LanguageDetector:
+    """本地優先的語言檢測器，信心低於門檻時呼叫遠端檢測並統計次數"""
+
+    def __init__(self, remote_detect, threshold=0.8):
+        self._remote_detect = remote_detect
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self.local = 0
+        self.fallback = 0
+
+    def detect_local(self, text):
+        """只做本地檢測；信心不足返回 None 並計為一次回退（由呼叫端進行遠端檢測）"""
+        lang, confidence = detect(text)
+        with self._lock:
+            if lang is not None and confidence >= self.threshold:
+                self.local += 1
+                return lang
+            self.fallback += 1
+        return None
+
+    def detect(self, text):
+        """返回語言代碼（小寫，如 vi / zh-tw / zh-cn）"""
+        lang = self.detect_local(text)
+        if lang is not None:
+            return lang
+        return self._remote_detect(text).lower()
+
+    def stats(self):
+        """返回本地檢測與遠端回退的次數"""
+        with self._lock:
+            total = self.local + self.fallback
+            return {
+                "local": self.local,
+                "fallback": self.fallback,
+                "fallback_rate": round(self.fallback / total, 4) if total else 0.0,
+            }
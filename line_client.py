@@ -0,0 +1,130 @@
+"""
+LINE Messaging API 的 HTTP 用戶端
+line-bot-sdk 預設的 RequestsHttpClient 每次呼叫都使用 requests.post（不共用連線，每則回覆都重新 TLS 握手）；
+這裡改用共用的 requests.Session 連線池（keep-alive），並在 429 / 5xx / 連線錯誤時以抖動退避重試，
+每次呼叫的耗時記錄在延遲直方圖中。
+push 類 API 重試時每次都帶同一個 X-Line-Retry-Key，前一次其實已送達時 LINE 回應 409 而不會重複送出；
+reply API 的 reply token 只能使用一次，重試不會造成重複訊息
+"""
+import random
+import threading
+import time
+import uuid
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from linebot.http_client import HttpClient, RequestsHttpResponse
+
+from metrics import LatencyHistogram
+
+RETRY_STATUS_CODES = frozenset([429, 500, 502, 503, 504])
+# 支援 X-Line-Retry-Key 的 API（重複送出會讓使用者收到兩次訊息）
+RETRY_KEY_PATHS = frozenset([
+    '/v2/bot/message/push',
+    '/v2/bot/message/multicast',
+    '/v2/bot/message/narrowcast',
+    '/v2/bot/message/broadcast',
+])
+
+
+class PooledHttpClient(HttpClient):
+    """執行緒共用的連線池 HttpClient，可直接傳給 LineBotApi(http_client=...)"""
+
+    def __init__(self, pool_size=10, timeout=(3.05, 10), retries=2, backoff=0.2, max_backoff=2.0):
+        super(PooledHttpClient, self).__init__(timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self.requests = 0
+        self.retried = 0
+        self.failures = 0
+
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        return self._request('GET', url, headers=headers, params=params, stream=stream, timeout=timeout)
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        return self._request('POST', url, headers=headers, data=data, timeout=timeout)
+
+    def delete(self, url, headers=None, data=None, timeout=None):
+        return self._request('DELETE', url, headers=headers, data=data, timeout=timeout)
+
+    def put(self, url, headers=None, data=None, timeout=None):
+        return self._request('PUT', url, headers=headers, data=data, timeout=timeout)
+
+    def _request(self, method, url, timeout=None, headers=None, **kwargs):
+        timeout = self.timeout if timeout is None else timeout
+        path = urlsplit(url).path
+        histogram = self._histogram(f"{method} {path}")
+        retry_key = None
+        if method == 'POST' and path in RETRY_KEY_PATHS:
+            # 一次邏輯請求一個重試鍵，所有重試都帶同一個
+            headers = dict(headers or {})
+            retry_key = headers.setdefault('X-Line-Retry-Key', str(uuid.uuid4()))
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            try:
+                response = self.session.request(method, url, timeout=timeout, headers=headers, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                histogram.observe(time.perf_counter() - start)
+                if attempt >= self.retries:
+                    self._count(failed=True)
+                    raise
+                delay = self._backoff_delay(attempt)
+                print(f"LINE API 連線錯誤，{delay:.2f} 秒後重試: {e}")
+            else:
+                histogram.observe(time.perf_counter() - start)
+                if response.status_code not in RETRY_STATUS_CODES or attempt >= self.retries:
+                    # 重試後的 409：相同重試鍵的請求先前已被接受，訊息已送達
+                    accepted = retry_key is not None and attempt > 0 and response.status_code == 409
+                    self._count(failed=response.status_code >= 400 and not accepted)
+                    return RequestsHttpResponse(response)
+                delay = self._backoff_delay(attempt, response.headers.get('Retry-After'))
+                print(f"LINE API 回應 {response.status_code}，{delay:.2f} 秒後重試")
+                response.close()
+            with self._lock:
+                self.retried += 1
+            attempt += 1
+            time.sleep(delay)
+
+    def _backoff_delay(self, attempt, retry_after=None):
+        """指數退避加上完全抖動；有 Retry-After 時以它為下限（不超過 max_backoff）"""
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * (2 ** attempt)))
+        if retry_after:
+            try:
+                delay = max(delay, min(self.max_backoff, float(retry_after)))
+            except ValueError:
+                pass
+        return delay
+
+    def _histogram(self, name):
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = LatencyHistogram()
+            return histogram
+
+    def _count(self, failed):
+        with self._lock:
+            self.requests += 1
+            if failed:
+                self.failures += 1
+
+    def stats(self):
+        """返回呼叫次數、重試次數、失敗次數與各端點的延遲直方圖"""
+        with self._lock:
+            histograms = dict(self._histograms)
+            result = {
+                "requests": self.requests,
+                "retried": self.retried,
+                "failures": self.failures,
+            }
+        result["latency"] = {name: h.snapshot() for name, h in histograms.items()}
+        return result
@@ -1,49 +1,143 @@
 # main.py
-from flask import Flask, request, abort, send_file, render_template
+from flask import Flask, request, abort, send_file, render_template, Response
 from linebot import LineBotApi, WebhookHandler
 from linebot.exceptions import InvalidSignatureError
-from linebot.models import MessageEvent, TextMessage, TextSendMessage, AudioSendMessage, FollowEvent
-from googletrans import Translator
-from gtts import gTTS
+from linebot.models import TextSendMessage
 import os
-import io
 import uuid
+import time
+from concurrent.futures import ThreadPoolExecutor
 import threading
-from datetime import datetime, timedelta
+import atexit
+from functools import partial
+import pipeline
+from pipeline import Pipeline, SyncIO, run_sync, source_key
+from webhook_queue import WebhookQueue
+from translation_cache import TranslationCache
+from translation_memory import TranslationMemory
+from lang_detect import LanguageDetector
+from audio_store import create_audio_store
 
-# 嘗試導入 pydub 用於格式轉換
-try:
-    from pydub import AudioSegment
-    PYDUB_AVAILABLE = True
-except ImportError:
-    PYDUB_AVAILABLE = False
+from transcoder import Transcoder
+from prewarm import CacheWarmer, load_phrases, read_status
+from line_client import PooledHttpClient
+from translation_backend import create_backend, gunicorn_threads
+from metrics import MetricsRegistry, MultiprocessMetrics, clear_snapshots
+from tracing import Tracer
+from fair_queue import SourceLimiter
 
 app = Flask(__name__)
-line_bot_api = LineBotApi(os.getenv('LINE_CHANNEL_ACCESS_TOKEN'))
+LINE_API_ENDPOINT = os.getenv('LINE_API_ENDPOINT', 'https://api.line.me')
+# LINE API 用戶端：共用連線池（keep-alive），429 / 5xx 時以抖動退避重試
+line_bot_api = LineBotApi(
+    os.getenv('LINE_CHANNEL_ACCESS_TOKEN'),
+    endpoint=LINE_API_ENDPOINT,
+    timeout=(float(os.getenv('LINE_HTTP_CONNECT_TIMEOUT', 3.05)), float(os.getenv('LINE_HTTP_READ_TIMEOUT', 10))),
+    http_client=partial(
+        PooledHttpClient,
+        pool_size=int(os.getenv('LINE_HTTP_POOL_SIZE', 10)),
+        retries=int(os.getenv('LINE_HTTP_RETRIES', 2)),
+        backoff=float(os.getenv('LINE_HTTP_BACKOFF', 0.2))
+    )
+)
+line_http_client = line_bot_api.http_client
 handler = WebhookHandler(os.getenv('LINE_CHANNEL_SECRET'))
-translator = Translator()
+# 翻譯後端（googletrans 用戶端池或本地 stub）；池大小預設為同時翻譯的執行緒數：
+# gunicorn --threads，queue 模式再加上背景處理執行緒
+TRANSLATION_BACKEND = os.getenv('TRANSLATION_BACKEND', 'googletrans')
+TRANSLATION_POOL_SIZE = int(os.getenv('TRANSLATION_POOL_SIZE') or (
+    gunicorn_threads() + (int(os.getenv('WEBHOOK_WORKERS', 4)) if os.getenv('WEBHOOK_MODE', 'sync').lower() == 'queue' else 0)
+))
+if TRANSLATION_BACKEND == 'stub':
+    translation_backend = create_backend('stub', latency=float(os.getenv('TRANSLATION_STUB_LATENCY', 0)))
+else:
+    translation_backend = create_backend(TRANSLATION_BACKEND, pool_size=TRANSLATION_POOL_SIZE)
+# 相同的翻譯 / 語音生成同時只呼叫一次上游（SingleFlight，見 pipeline.SyncIO）；
+# 本地檢測信心不足時才呼叫遠端檢測
+language_detector = LanguageDetector(
+    translation_backend.detect,
+    threshold=float(os.getenv('LANG_DETECT_THRESHOLD', 0.8))
+)
+translation_cache = TranslationCache(
+    max_bytes=int(os.getenv('TRANSLATION_CACHE_MAX_BYTES', 8 * 1024 * 1024)),
+    ttl=int(os.getenv('TRANSLATION_CACHE_TTL', 86400))
+)
 
-# 音訊快取和鎖
-audio_cache = {}
-cache_lock = threading.Lock()
+# 持久化翻譯記憶（設定 TRANSLATION_MEMORY_PATH 才啟用，例如 Railway volume 上的路徑）
+TRANSLATION_MEMORY_PATH = os.getenv('TRANSLATION_MEMORY_PATH', '')
+translation_memory = None
+if TRANSLATION_MEMORY_PATH:
+    translation_memory = TranslationMemory(
+        TRANSLATION_MEMORY_PATH,
+        max_entries=int(os.getenv('TRANSLATION_MEMORY_MAX_ENTRIES', 100000))
+    )
+    atexit.register(translation_memory.flush)
+    warmed = translation_memory.warm(translation_cache, int(os.getenv('TRANSLATION_MEMORY_WARM', 1000)))
+    print(f"翻譯記憶已載入 {warmed} 筆常用翻譯")
+
+# 音訊快取（memory：行程內 LRU；disk / shm：所有 worker 共用的內容位址目錄）
+audio_cache = create_audio_store(
+    os.getenv('AUDIO_STORE', 'memory'),
+    directory=os.getenv('AUDIO_STORE_DIR') or None,
+    max_bytes=int(os.getenv('AUDIO_STORE_MAX_BYTES', 64 * 1024 * 1024)),
+    ttl=int(os.getenv('AUDIO_TTL', 86400)),
+    expiry_interval=int(os.getenv('AUDIO_EXPIRY_INTERVAL', 60))
+)
 app_base_url = None
 url_lock = threading.Lock()
-_last_cleanup_time = None
-_cleanup_lock = threading.Lock()
+
+# 語音格式：m4a（以 ffmpeg 管線轉檔）或 mp3（直接傳送 gTTS 輸出，不轉檔）
+AUDIO_FORMAT = os.getenv('AUDIO_FORMAT', 'm4a').lower()
+# 語音轉檔位元率（也是音訊內容位址的一部分）
+AUDIO_BITRATE = os.getenv('AUDIO_BITRATE', '64k')
+transcoder = Transcoder(
+    ffmpeg=os.getenv('FFMPEG_BINARY', 'ffmpeg'),
+    bitrate=AUDIO_BITRATE,
+    max_concurrency=int(os.getenv('TRANSCODE_CONCURRENCY', 2))
+)
+
+# 語音管線模式：先回覆文字與預先分配的語音 URL，語音在背景生成
+AUDIO_PIPELINE = os.getenv('AUDIO_PIPELINE', 'false').lower() in ('1', 'true', 'yes')
+AUDIO_WAIT_TIMEOUT = float(os.getenv('AUDIO_WAIT_TIMEOUT', 15))
+tts_executor = ThreadPoolExecutor(max_workers=int(os.getenv('TTS_WORKERS', 2)), thread_name_prefix='tts')
+# 長文逐句並行合成語音時，每則訊息同時合成的句數上限；所有訊息合計的 gTTS 同時請求上限
+SENTENCE_TTS_WORKERS = int(os.getenv('SENTENCE_TTS_WORKERS', 4))
+TTS_CONCURRENCY = int(os.getenv('TTS_CONCURRENCY', 8))
+
+# Webhook 處理模式：sync（同步處理）或 queue（立即回應，背景執行緒處理）
+WEBHOOK_MODE = os.getenv('WEBHOOK_MODE', 'sync').lower()
+# 公平排程權重（queue 模式），例如 user=2,group=1 讓一對一聊天分得兩倍的處理順位
+SOURCE_WEIGHTS = {
+    kind.strip(): float(weight)
+    for kind, _, weight in (item.partition('=') for item in os.getenv('SOURCE_WEIGHTS', '').split(',') if '=' in item)
+}
+# 每個來源（使用者 / 群組）的語音額度：每秒補充的次數與最多累積的次數，超出時只回覆文字；0 為不限制
+tts_limiter = SourceLimiter(
+    rate=float(os.getenv('TTS_RATE_PER_SOURCE', 0.2)),
+    burst=int(os.getenv('TTS_BURST_PER_SOURCE', 10))
+)
+# 每則訊息的回覆期限（毫秒，從 LINE 送出事件起算）：剩餘時間不足以生成語音時先回覆文字；0 為不限制
+REPLY_BUDGET_MS = float(os.getenv('REPLY_BUDGET_MS', 8000))
+# 沒有足夠的歷史資料時預估的語音生成時間（秒）
+AUDIO_EXPECTED_SECONDS = float(os.getenv('AUDIO_EXPECTED_SECONDS', 2))
+# 尚未完成的語音工作數（立即生成、背景生成與補送各計一次）達到此上限時視為滿載，新訊息先回覆文字
+AUDIO_MAX_INFLIGHT = int(os.getenv('AUDIO_MAX_INFLIGHT', 8))
+# 略過語音時的處理：drop（只回覆文字）或 push（語音生成後以 push message 補送，會計入 LINE 訊息額度）
+AUDIO_FALLBACK = os.getenv('AUDIO_FALLBACK', 'drop').lower()
+# 一次投遞含多個事件時（群組訊息較多時常見）同時處理的事件數上限
+EVENT_FANOUT = int(os.getenv('EVENT_FANOUT', 4))
+# 翻譯、語音與 LINE API 在呼叫端的執行緒中同步執行；背景語音與補送交給 tts_executor
+sync_io = SyncIO(translation_backend, transcoder, line_bot_api, tts_executor, tts_concurrency=TTS_CONCURRENCY)
 
 def cleanup_old_audio():
-    """清理超過 24 小時的舊音訊檔案"""
-    global _last_cleanup_time
-    current_time = datetime.now()
-    with _cleanup_lock:
-        if _last_cleanup_time and (current_time - _last_cleanup_time) < timedelta(minutes=10):
-            return
-        _last_cleanup_time = current_time
-    with cache_lock:
-        keys_to_delete = [k for k, v in audio_cache.items() 
-                         if len(v) >= 2 and current_time - v[1] > timedelta(hours=24)]
-        for k in keys_to_delete:
-            del audio_cache[k]
+    """清理過期的舊音訊檔案（平時由 audio_cache 的背景執行緒定期執行）"""
+    return audio_cache.expire()
+
+def set_base_url(base_url):
+    """記錄目前請求的應用基礎 URL"""
+    global app_base_url
+    with url_lock:
+        app_base_url = base_url
 
 def get_base_url():
     """獲取應用基礎 URL"""
@@ -60,126 +154,90 @@ def get_base_url():
 
 @app.route("/callback", methods=['POST'])
 def callback():
-    global app_base_url
     signature = request.headers.get('X-Line-Signature', '')
     if not signature:
         abort(400)
     body = request.get_data(as_text=True)
-    base_url = os.getenv('BASE_URL', '') or request.url_root.rstrip('/')
-    with url_lock:
-        app_base_url = base_url
+    set_base_url(os.getenv('BASE_URL', '') or request.url_root.rstrip('/'))
     try:
-        handler.handle(body, signature)
+        with timed('verify'):
+            payload = handler.parser.parse(body, signature, as_payload=True)
     except InvalidSignatureError:
         abort(400)
+    if WEBHOOK_MODE == 'queue':
+        # 一次投遞可能包含多個來源的事件：依來源拆開分別排程，成本為該來源的事件數
+        groups = {}
+        for event in payload.events:
+            groups.setdefault(source_key(event.source), []).append(event)
+        if not webhook_queue.submit_many([(events, source, len(events)) for source, events in groups.items()]):
+            # 佇列已滿：回應 503 讓 LINE 稍後重送，而不是佔住執行緒
+            print(f"Webhook 佇列已滿，拒絕投遞 (depth={webhook_queue.depth()})")
+            return 'Busy', 503, {'Retry-After': '1'}
+        return 'OK'
+    process_events(payload.events)
     return 'OK'
 
-@app.route("/", methods=['GET'])
-def health_check():
-    """健康檢查端點，顯示 HTML 頁面（用於分享預覽）和 JSON API"""
-    # 檢查是否請求 JSON 格式
-    if request.headers.get('Accept', '').find('application/json') != -1:
-        return {
-            "status": "ok",
-            "service": "LINE Bot Translation Service",
-            "description": "免費越南語-繁體中文翻譯機器人，支援語音播放",
-            "features": [
-                "自動翻譯越南語 ↔ 繁體中文",
-                "簡體中文 → 越南語",
-                "文字轉語音播放"
-            ],
-            "usage": "加好友關注即可免費使用，直接輸入文字即可翻譯",
-            "contact": {
-                "id": "0002738",
-                "phone": "0963858005",
-                "services": [
-                    "網站開發",
-                    "程序開發",
-                    "機器人開發",
-                    "AI 程序開發",
-                    "廣告服務"
-                ]
-            },
-            "endpoints": {
-                "health": "/",
-                "webhook": "/callback",
-                "audio": "/audio/<audio_id>"
-            }
-        }
-    
-    # 返回 HTML 頁面（用於分享預覽）
-    base_url = get_base_url() or request.url_root.rstrip('/')
-    return render_template('index.html', base_url=base_url)
+def source_weight(key):
+    """依來源類型（user / group / room）取得公平排程的權重"""
+    return SOURCE_WEIGHTS.get(key.split(':', 1)[0], 1.0)
 
-@app.route("/audio/<audio_id>", methods=['GET'])
-def serve_audio(audio_id):
-    """提供音訊檔案的下載端點"""
-    audio_data = None
-    audio_format = 'mp3'
-    with cache_lock:
-        if audio_id in audio_cache:
-            entry = audio_cache[audio_id]
-            if len(entry) >= 1:
-                audio_data = bytes(entry[0])
-                audio_format = entry[2] if len(entry) >= 3 else 'mp3'
-    if not audio_data:
-        abort(404)
-    mimetype = 'audio/mp4' if audio_format == 'm4a' else 'audio/mpeg'
-    filename = f'audio.{audio_format}'
-    response = send_file(io.BytesIO(audio_data), mimetype=mimetype, as_attachment=False)
-    response.headers.update({
-        'Content-Type': mimetype,
-        'Content-Length': str(len(audio_data)),
-        'Accept-Ranges': 'bytes',
-        'Cache-Control': 'public, max-age=3600',
-        'Access-Control-Allow-Origin': '*',
-        'Content-Disposition': f'inline; filename="{filename}"'
-    })
-    return response
+def process_events(events):
+    """處理已驗證的 webhook 事件（一次投遞或其中同一來源的事件）；多個事件時先合併翻譯，再以有限的併發同時處理"""
+    run_sync(bot_pipeline.process_events(sync_io, events))
 
-def generate_audio(text, lang, format_type='m4a'):
-    """生成語音檔案並返回 (音訊資料, 實際使用的文字長度, 格式類型)"""
-    if len(text) > 5000:
-        text = text[:5000] + "..."
-    actual_length = len(text)
-    if not text or not text.strip():
-        raise ValueError("No text to send to TTS API")
-    tts = gTTS(text=text, lang=lang, slow=False)
-    audio_buffer = io.BytesIO()
-    tts.write_to_fp(audio_buffer)
-    audio_data = audio_buffer.getvalue()
-    if not audio_data:
-        raise ValueError("生成的音訊資料為空")
-    if format_type == 'm4a' and PYDUB_AVAILABLE:
-        try:
-            audio_segment = AudioSegment.from_mp3(io.BytesIO(audio_data))
-            m4a_buffer = io.BytesIO()
-            # 使用 'ipod' 格式（ffmpeg 支持），這會生成 M4A/AAC 格式
-            audio_segment.export(m4a_buffer, format="ipod", codec="aac", bitrate="64k")
-            audio_data = m4a_buffer.getvalue()
-            print(f"音訊已轉換為 M4A，大小: {len(audio_data)} bytes")
-        except Exception as e:
-            print(f"M4A 轉換失敗，使用 MP3: {e}")
-            format_type = 'mp3'
-    return (audio_data, actual_length, format_type)
+webhook_queue = WebhookQueue(
+    process_events,
+    maxsize=int(os.getenv('WEBHOOK_QUEUE_SIZE', 100)),
+    workers=int(os.getenv('WEBHOOK_WORKERS', 4)),
+    put_timeout=float(os.getenv('WEBHOOK_QUEUE_TIMEOUT', 0.05)),
+    weight=source_weight,
+    max_per_source=int(os.getenv('WEBHOOK_MAX_PER_SOURCE', 0))
+)
 
-def get_tts_lang(lang_code):
-    """將語言代碼轉換為 gTTS 支援的語言代碼"""
-    lang_map = {'vi': 'vi', 'zh-tw': 'zh-tw', 'zh-cn': 'zh-cn', 'zh': 'zh-tw'}
-    return lang_map.get(lang_code, 'vi')
-
-def save_audio_to_cache(audio_data, audio_format='m4a'):
-    """將音訊資料儲存到快取並返回 ID"""
-    audio_id = str(uuid.uuid4())
-    with cache_lock:
-        audio_cache[audio_id] = (audio_data, datetime.now(), audio_format)
-    cleanup_old_audio()
-    return audio_id
-
-@handler.add(FollowEvent)
-def handle_follow(event):
-    """處理用戶加入好友事件 - 發送歡迎訊息"""
-    greeting_text = """🎉 歡迎使用免費翻譯機器人！
+# Prometheus 指標：各處理階段耗時與錯誤次數，以及既有統計（快取命中、佇列深度等）
+metrics_registry = MetricsRegistry(prefix='linebot_')
+metrics_registry.counter_func(
+    'translation_cache_requests_total', '記憶體翻譯快取查詢次數',
+    lambda: {'hit': translation_cache.stats()['hits'], 'miss': translation_cache.stats()['misses']}, label='result')
+metrics_registry.counter_func(
+    'translation_memory_requests_total', '持久化翻譯記憶查詢次數',
+    lambda: {'hit': translation_memory.stats()['hits'], 'miss': translation_memory.stats()['misses']} if translation_memory else None,
+    label='result')
+metrics_registry.counter_func(
+    'language_detections_total', '語言檢測次數（本地 / 遠端回退）',
+    lambda: {k: language_detector.stats()[k] for k in ('local', 'fallback')}, label='method')
+metrics_registry.counter_func(
+    'coalesced_calls_total', '合併到進行中相同請求的呼叫次數',
+    lambda: {kind: stats['coalesced'] for kind, stats in sync_io.stats().items()},
+    label='kind')
+metrics_registry.counter_func(
+    'line_api_retries_total', 'LINE API 重試次數', lambda: line_http_client.stats()['retried'])
+metrics_registry.counter_func(
+    'webhook_deliveries_total', 'Webhook 佇列投遞次數',
+    lambda: {k: webhook_queue.stats()[k] for k in ('accepted', 'rejected', 'processed', 'failed')},
+    label='result')
+metrics_registry.gauge_func(
+    'webhook_queue_depth', 'Webhook 佇列中等待處理的投遞數', webhook_queue.depth)
+metrics_registry.gauge_func(
+    'pending_audio', '背景生成中的語音數', sync_io.pending_count)
+# disk / shm 儲存由所有 worker 共用，各 worker 回報的是同一個值，彙總時取最大值
+metrics_registry.gauge_func(
+    'audio_store_bytes', '音訊儲存目前的位元組數', lambda: audio_cache.stats()['bytes'],
+    aggregate='max' if audio_cache.shared else 'sum')
+metrics_registry.gauge_func(
+    'audio_store_entries', '音訊儲存目前的條目數', lambda: audio_cache.stats()['entries'],
+    aggregate='max' if audio_cache.shared else 'sum')
+metrics_registry.gauge_func(
+    'translation_cache_bytes', '記憶體翻譯快取目前的位元組數',
+    lambda: translation_cache.stats()['bytes'])
+# 事件追蹤：每個事件輸出一行 JSON 日誌（抽樣比例；耗時超過 TRACE_SLOW_MS 或出錯的事件一律輸出）
+tracer = Tracer(
+    sample_rate=float(os.getenv('TRACE_SAMPLE_RATE', 1)),
+    slow_ms=float(os.getenv('TRACE_SLOW_MS', 0))
+)
+
+# 加入好友時的歡迎訊息
+GREETING_TEXT = """🎉 歡迎使用免費翻譯機器人！
 
 ✅ 加好友關注即可免費使用
 ✅ 無需付費，無需註冊
@@ -236,57 +294,207 @@ def handle_follow(event):
    電話: 0963858005
 
 隨時為您提供專業服務！"""
+
+# 固定的回覆訊息只建立一次
+GREETING_MESSAGE = TextSendMessage(text=GREETING_TEXT)
+
+# 偵測語言 → 翻譯 → 語音 → 回覆的流程（與 asgi_app.py 共用，見 pipeline.py）
+bot_pipeline = Pipeline(
+    translation_cache, language_detector, audio_cache, tracer, metrics_registry,
+    translation_memory=translation_memory,
+    tts_limiter=tts_limiter,
+    base_url=get_base_url,
+    greeting_message=GREETING_MESSAGE,
+    audio_format=AUDIO_FORMAT,
+    audio_bitrate=AUDIO_BITRATE,
+    audio_pipeline=AUDIO_PIPELINE,
+    audio_fallback=AUDIO_FALLBACK,
+    reply_budget_ms=REPLY_BUDGET_MS,
+    audio_expected_seconds=AUDIO_EXPECTED_SECONDS,
+    audio_max_inflight=AUDIO_MAX_INFLIGHT,
+    sentence_workers=SENTENCE_TTS_WORKERS,
+    event_fanout=EVENT_FANOUT
+)
+
+def timed(stage):
+    """計時一個處理階段，記錄到指標直方圖與目前事件的追蹤 span"""
+    return bot_pipeline.timed(stage)
+
+# 多個 gunicorn worker 的快照寫在同一目錄（由 gunicorn.conf.py 在 master 啟動時建立並清空）；
+# 未設定時（例如直接執行 python main.py）只輸出本程序的指標
+metrics_exporter = MultiprocessMetrics(
+    metrics_registry,
+    directory=os.getenv('METRICS_DIR') or None,
+    interval=float(os.getenv('METRICS_INTERVAL', 5))
+)
+metrics_exporter.start()
+atexit.register(metrics_exporter.write)
+
+def service_status():
+    """服務狀態（健康檢查 JSON）"""
+    return {
+        "status": "ok",
+        "service": "LINE Bot Translation Service",
+        "description": "免費越南語-繁體中文翻譯機器人，支援語音播放",
+        "features": [
+            "自動翻譯越南語 ↔ 繁體中文",
+            "簡體中文 → 越南語",
+            "文字轉語音播放"
+        ],
+        "usage": "加好友關注即可免費使用，直接輸入文字即可翻譯",
+        "contact": {
+            "id": "0002738",
+            "phone": "0963858005",
+            "services": [
+                "網站開發",
+                "程序開發",
+                "機器人開發",
+                "AI 程序開發",
+                "廣告服務"
+            ]
+        },
+        "endpoints": {
+            "health": "/",
+            "webhook": "/callback",
+            "audio": "/audio/<audio_id>"
+        },
+        "webhook_mode": WEBHOOK_MODE,
+        "webhook_queue": webhook_queue.stats(),
+        "translation_cache": translation_cache.stats(),
+        "translation_backend": translation_backend.stats(),
+        "translation_memory": translation_memory.stats() if translation_memory is not None else None,
+        "language_detector": language_detector.stats(),
+        "audio_store": audio_cache.stats(),
+        "audio_pipeline": AUDIO_PIPELINE,
+        "pending_audio": sync_io.pending_count(),
+        "coalescing": sync_io.stats(),
+        "transcoder": transcoder.stats(),
+        "prewarm": prewarm_stats(),
+        "tracing": tracer.stats(),
+        "tts_limiter": tts_limiter.stats(),
+        "line_api": line_http_client.stats()
+    }
+
+@app.route("/", methods=['GET'])
+def health_check():
+    """健康檢查端點，顯示 HTML 頁面（用於分享預覽）和 JSON API"""
+    # 檢查是否請求 JSON 格式
+    if request.headers.get('Accept', '').find('application/json') != -1:
+        return service_status()
     
-    try:
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(text=greeting_text)
-        )
-    except Exception as e:
-        print(f"發送歡迎訊息錯誤: {e}")
-
-@handler.add(MessageEvent, message=TextMessage)
-def handle_message(event):
-    try:
-        input_text = event.message.text
-        if not input_text or not input_text.strip():
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text="請輸入要翻譯的文字"))
-            return
-        detected = translator.detect(input_text)
-        src_lang = detected.lang
-        dest_lang = 'zh-tw' if src_lang == 'vi' else 'vi' if src_lang in ['zh-cn', 'zh-tw'] else 'vi'
-        translated = translator.translate(input_text, src=src_lang, dest=dest_lang)
-        translated_text = translated.text
-        if not translated_text or not translated_text.strip():
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text="翻譯失敗，請稍後再試"))
-            return
-        messages = [TextSendMessage(text=translated_text)]
-        try:
-            tts_lang = get_tts_lang(dest_lang)
-            audio_data, actual_text_length, audio_format = generate_audio(translated_text, tts_lang, 'm4a')
-            audio_id = save_audio_to_cache(audio_data, audio_format)
-            base_url = get_base_url() or os.getenv('RAILWAY_PUBLIC_DOMAIN', '')
-            if not base_url:
-                raise ValueError("BASE_URL 未設定")
-            if not base_url.startswith('http'):
-                base_url = f"https://{base_url}"
-            elif base_url.startswith('http://'):
-                base_url = base_url.replace('http://', 'https://', 1)
-            audio_url = f"{base_url.rstrip('/')}/audio/{audio_id}"
-            duration = max(1000, int(actual_text_length * 125))
-            audio_message = AudioSendMessage(original_content_url=audio_url, duration=duration)
-            messages.append(audio_message)
-            print(f"語音已生成: {audio_url}, {duration}ms, {len(audio_data)} bytes, {audio_format}")
-        except Exception as e:
-            print(f"語音生成錯誤: {e}")
-        line_bot_api.reply_message(event.reply_token, messages)
-    except Exception as e:
-        print(f"處理訊息錯誤: {e}")
+    # 返回 HTML 頁面（用於分享預覽）
+    base_url = get_base_url() or request.url_root.rstrip('/')
+    return render_template('index.html', base_url=base_url)
+
+@app.route("/metrics", methods=['GET'])
+def metrics():
+    """Prometheus 指標（已合併所有 worker）"""
+    return Response(metrics_exporter.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route("/audio/<audio_id>", methods=['GET'])
+def serve_audio(audio_id):
+    """提供音訊檔案的下載端點（支援 Range 與 If-None-Match）"""
+    # 語音仍在生成中時等待其完成（先等待再查詢，避免錯過剛完成的生成）
+    sync_io.wait(audio_id, AUDIO_WAIT_TIMEOUT)
+    entry = audio_cache.get(audio_id)
+    if entry is None and AUDIO_PIPELINE and audio_cache.shared:
+        # 只有共用儲存中有「生成中」標記（另一個 worker 正在生成）才輪詢等待，
+        # 未知或已過期的 ID 立即返回 404，不佔住請求執行緒
+        deadline = time.monotonic() + AUDIO_WAIT_TIMEOUT
+        while entry is None and time.monotonic() < deadline:
+            pending = audio_cache.is_pending(audio_id, AUDIO_WAIT_TIMEOUT * 4)
+            entry = audio_cache.get(audio_id)
+            if entry is not None or not pending:
+                break
+            time.sleep(0.1)
+    if entry is None:
+        abort(404)
+    mimetype = 'audio/mp4' if entry.format == 'm4a' else 'audio/mpeg'
+    filename = f'audio.{entry.format}'
+    if ',' in request.headers.get('Range', ''):
+        # 多段 Range 不支援（Werkzeug 會回 416），忽略 Range 改回完整的 200 回應
+        request.environ.pop('HTTP_RANGE', None)
+    if entry.path:
+        # 檔案型後端：交給 send_file，完整回應由 WSGI 伺服器以 sendfile 傳送
+        response = send_file(entry.path, mimetype=mimetype, conditional=True, etag=entry.etag,
+                             download_name=filename, max_age=3600)
+    else:
+        # 記憶體後端：完整回應直接送出快取中的 bytes，Range 請求只切出請求的片段
+        response = Response([entry.data], mimetype=mimetype)
+        response.set_etag(entry.etag)
+        response.make_conditional(request, accept_ranges=True, complete_length=entry.size)
+        response.headers['Content-Disposition'] = f'inline; filename="{filename}"'
+    response.cache_control.public = True
+    response.cache_control.max_age = 3600
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    return response
+
+def get_tts_lang(lang_code):
+    """將語言代碼轉換為 gTTS 支援的語言代碼"""
+    return pipeline.get_tts_lang(lang_code)
+
+def generate_audio(text, lang):
+    """逐句生成語音並串接，返回 (音訊資料, 播放長度毫秒, 格式類型)"""
+    return run_sync(bot_pipeline.generate_audio(sync_io, text, lang))
+
+def save_audio_to_cache(audio_data, audio_format='m4a', audio_id=None, duration=None):
+    """將音訊資料（與播放長度）儲存到快取並返回 ID（超過快取上限時返回 None）"""
+    if audio_id is None:
+        audio_id = str(uuid.uuid4())
+    with timed('store'):
+        stored = audio_cache.put(audio_id, audio_data, audio_format, duration)
+    return audio_id if stored else None
+
+def prewarm_phrase(text):
+    """預先計算一句常用語的翻譯與語音並存入快取，返回是否新生成了語音"""
+    return run_sync(bot_pipeline.prewarm_phrase(sync_io, text))
+
+def history_phrases(limit):
+    """從翻譯記憶取出最常使用的 limit 句原文"""
+    if translation_memory is None or limit <= 0:
+        return []
+    return [text for text, src, dest, translated in translation_memory.hottest(limit) if src != 'detect']
+
+# 啟動時的快取預熱（PREWARM_PHRASES_FILE / PREWARM_FROM_HISTORY 未設定時不執行；直接執行 main.py 時使用）
+PREWARM_PHRASES_FILE = os.getenv('PREWARM_PHRASES_FILE', '')
+PREWARM_FROM_HISTORY = int(os.getenv('PREWARM_FROM_HISTORY', 0))
+cache_warmer = CacheWarmer(prewarm_phrase, concurrency=int(os.getenv('PREWARM_CONCURRENCY', 2)))
+
+def prewarm_stats():
+    """本行程的預熱進度；gunicorn 另開行程預熱時改為讀取該行程寫入的 PREWARM_STATUS_FILE"""
+    stats = cache_warmer.stats()
+    if stats['total'] == 0:
+        shared = read_status(os.getenv('PREWARM_STATUS_FILE', ''))
+        if shared is not None:
+            return dict(shared, process='prewarm.py')
+    return stats
+
+def start_prewarm():
+    """在背景執行緒開始預熱，不阻塞服務啟動"""
+    phrases = []
+    if PREWARM_PHRASES_FILE:
         try:
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text="發生錯誤，請稍後再試"))
-        except:
-            pass
+            phrases.extend(load_phrases(PREWARM_PHRASES_FILE))
+        except OSError as e:
+            print(f"讀取預熱清單錯誤: {e}")
+    phrases.extend(history_phrases(PREWARM_FROM_HISTORY))
+    if phrases:
+        print(f"開始快取預熱: {len(phrases)} 句")
+        cache_warmer.start(phrases)
+
+# 事件由 callback 解析後交給 Pipeline.dispatch 分派，以下只是單一事件的同步包裝
+def handle_follow(event):
+    """處理用戶加入好友事件 - 發送歡迎訊息"""
+    run_sync(bot_pipeline.handle_follow(sync_io, event))
+
+def handle_message(event):
+    """處理文字訊息：檢測語言、翻譯，附上語音後回覆"""
+    run_sync(bot_pipeline.handle_message(sync_io, event))
 
 if __name__ == "__main__":
+    # 單一程序執行時不合併上一次執行留下的指標快照
+    clear_snapshots(metrics_exporter.directory)
+    # gunicorn 下由 gunicorn.conf.py 決定另開行程預熱一次，或在每個 worker 的 post_worker_init 各自預熱
+    start_prewarm()
     port = int(os.getenv('PORT', 8080))
     app.run(host='0.0.0.0', port=port, debug=False)
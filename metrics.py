@@ -0,0 +1,428 @@
+"""
+延遲統計與 Prometheus 指標
+固定區間的延遲直方圖（執行緒安全），可估計百分位數；
+MetricsRegistry 收集直方圖、計數器與量測值，以 Prometheus 文字格式輸出；
+多個 gunicorn worker 時，各 worker 定期把快照寫入共用目錄，/metrics 讀取全部快照後合併輸出
+"""
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+# 區間上限（秒）
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class LatencyHistogram:
+    """記錄耗時分佈：各區間次數、總次數與總耗時"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._lock = threading.Lock()
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        index = len(self.buckets)
+        for i, upper in enumerate(self.buckets):
+            if seconds <= upper:
+                index = i
+                break
+        with self._lock:
+            self._counts[index] += 1
+            self.count += 1
+            self.sum += seconds
+
+    def raw(self):
+        """返回 (各區間次數（非累積，最後一格為超過最大區間）, 總次數, 總耗時)"""
+        with self._lock:
+            return (list(self._counts), self.count, self.sum)
+
+    def percentile(self, pct):
+        """以區間上限估計百分位數（秒）；超過最大區間時返回最大區間上限"""
+        with self._lock:
+            counts = list(self._counts)
+            total = self.count
+        if total == 0:
+            return 0.0
+        rank = pct / 100 * total
+        seen = 0
+        for upper, count in zip(self.buckets, counts):
+            seen += count
+            if seen >= rank:
+                return upper
+        return self.buckets[-1]
+
+    def snapshot(self):
+        """返回累積區間次數（le → 次數）、總次數、總耗時與估計百分位數"""
+        with self._lock:
+            counts = list(self._counts)
+            total = self.count
+            total_seconds = self.sum
+        cumulative = {}
+        running = 0
+        for upper, count in zip(self.buckets, counts):
+            running += count
+            cumulative[str(upper)] = running
+        cumulative['+Inf'] = total
+        return {
+            "count": total,
+            "sum": round(total_seconds, 6),
+            "avg_ms": round(total_seconds / total * 1000, 1) if total else 0.0,
+            "p50_ms": round(self.percentile(50) * 1000, 1),
+            "p95_ms": round(self.percentile(95) * 1000, 1),
+            "p99_ms": round(self.percentile(99) * 1000, 1),
+            "buckets": cumulative,
+        }
+
+
+class _Family:
+    """同名指標的一組時間序列，以單一標籤區分（label 為 None 時只有一條序列）"""
+
+    def __init__(self, name, help_text, label=None):
+        self.name = name
+        self.help = help_text
+        self.label = label
+        self._lock = threading.Lock()
+
+
+class HistogramFamily(_Family):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, label=None, buckets=DEFAULT_BUCKETS):
+        super(HistogramFamily, self).__init__(name, help_text, label)
+        self.buckets = tuple(sorted(buckets))
+        self._children = {}
+
+    def labels(self, value=''):
+        histogram = self._children.get(value)
+        if histogram is None:
+            with self._lock:
+                histogram = self._children.setdefault(value, LatencyHistogram(self.buckets))
+        return histogram
+
+    def observe(self, seconds, value=''):
+        self.labels(value).observe(seconds)
+
+    def collect(self):
+        with self._lock:
+            children = dict(self._children)
+        values = {}
+        for value, histogram in children.items():
+            counts, count, total = histogram.raw()
+            values[value] = {"counts": counts, "count": count, "sum": total}
+        return values
+
+
+class CounterFamily(_Family):
+    kind = 'counter'
+
+    def __init__(self, name, help_text, label=None):
+        super(CounterFamily, self).__init__(name, help_text, label)
+        self._values = {}
+
+    def inc(self, value='', amount=1):
+        with self._lock:
+            self._values[value] = self._values.get(value, 0) + amount
+
+    def collect(self):
+        with self._lock:
+            return dict(self._values)
+
+
+class CallbackFamily(_Family):
+    """每次收集時呼叫 fn() 取值（返回數字，或 {標籤值: 數字}），用於既有模組的統計資料"""
+
+    def __init__(self, name, help_text, fn, kind='gauge', label=None, aggregate='sum'):
+        super(CallbackFamily, self).__init__(name, help_text, label)
+        self.kind = kind
+        self.fn = fn
+        self.aggregate = aggregate
+
+    def collect(self):
+        try:
+            result = self.fn()
+        except Exception as e:
+            print(f"收集指標 {self.name} 失敗: {e}")
+            return {}
+        if isinstance(result, dict):
+            return {str(k): v for k, v in result.items() if v is not None}
+        return {} if result is None else {'': result}
+
+
+class MetricsRegistry:
+    """指標登錄表：stage_seconds / stage_errors 之類的指標在這裡建立，snapshot() 可序列化為 JSON"""
+
+    def __init__(self, prefix=''):
+        self.prefix = prefix
+        self._families = []
+
+    def _add(self, family):
+        family.name = self.prefix + family.name
+        self._families.append(family)
+        return family
+
+    def histogram(self, name, help_text, label=None, buckets=DEFAULT_BUCKETS):
+        return self._add(HistogramFamily(name, help_text, label, buckets))
+
+    def counter(self, name, help_text, label=None):
+        return self._add(CounterFamily(name, help_text, label))
+
+    def counter_func(self, name, help_text, fn, label=None):
+        """由 fn() 取得累計值的計數器（各 worker 相加）"""
+        return self._add(CallbackFamily(name, help_text, fn, 'counter', label))
+
+    def gauge_func(self, name, help_text, fn, label=None, aggregate='sum'):
+        """由 fn() 取得目前值的量測值；aggregate 為 sum（各 worker 相加）或 max（共用資源，取最大值）"""
+        return self._add(CallbackFamily(name, help_text, fn, 'gauge', label, aggregate))
+
+    @contextmanager
+    def timer(self, histogram, value='', errors=None):
+        """計時 with 區塊並記錄到直方圖；區塊拋出例外時 errors 計數器加一（例外照常拋出）"""
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            if errors is not None:
+                errors.inc(value)
+            raise
+        finally:
+            histogram.observe(time.perf_counter() - start, value)
+
+    def snapshot(self):
+        result = []
+        for family in self._families:
+            entry = {
+                "name": family.name,
+                "help": family.help,
+                "type": family.kind,
+                "label": family.label,
+                "values": family.collect(),
+            }
+            if family.kind == 'histogram':
+                entry["buckets"] = list(family.buckets)
+            else:
+                entry["aggregate"] = getattr(family, 'aggregate', 'sum')
+            result.append(entry)
+        return result
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def merge_snapshots(snapshots):
+    """合併多個 worker 的快照。snapshots 為 [(快照, 程序是否仍在執行)]；
+    計數器與直方圖是累計值，已結束的 worker 也要計入；量測值只取仍在執行的 worker"""
+    merged = []
+    index = {}
+    for snapshot, alive in snapshots:
+        for family in snapshot:
+            if family["type"] == 'gauge' and not alive:
+                continue
+            target = index.get(family["name"])
+            if target is None:
+                target = dict(family, values={})
+                index[family["name"]] = target
+                merged.append(target)
+            values = target["values"]
+            for value, data in family["values"].items():
+                current = values.get(value)
+                if family["type"] == 'histogram':
+                    if current is None or len(current["counts"]) != len(data["counts"]):
+                        values[value] = {"counts": list(data["counts"]), "count": data["count"], "sum": data["sum"]}
+                    else:
+                        current["counts"] = [a + b for a, b in zip(current["counts"], data["counts"])]
+                        current["count"] += data["count"]
+                        current["sum"] += data["sum"]
+                elif current is None:
+                    values[value] = data
+                elif family.get("aggregate") == 'max':
+                    values[value] = max(current, data)
+                else:
+                    values[value] = current + data
+    return merged
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        if value == float('inf'):
+            return '+Inf'
+        return repr(value)
+    return str(value)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(pairs):
+    pairs = [(k, v) for k, v in pairs if k]
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
+
+
+def render_prometheus(snapshot):
+    """以 Prometheus 文字格式（0.0.4）輸出快照"""
+    lines = []
+    for family in snapshot:
+        name = family["name"]
+        label = family["label"]
+        lines.append(f"# HELP {name} {family['help']}")
+        lines.append(f"# TYPE {name} {family['type']}")
+        for value in sorted(family["values"]):
+            data = family["values"][value]
+            base = [(label, value)] if label else []
+            if family["type"] == 'histogram':
+                running = 0
+                for upper, count in zip(family["buckets"] + ['+Inf'], data["counts"]):
+                    running += count
+                    le = upper if upper == '+Inf' else _format_value(float(upper))
+                    lines.append(f"{name}_bucket{_labels(base + [('le', le)])} {running}")
+                lines.append(f"{name}_sum{_labels(base)} {_format_value(float(data['sum']))}")
+                lines.append(f"{name}_count{_labels(base)} {data['count']}")
+            else:
+                lines.append(f"{name}{_labels(base)} {_format_value(data)}")
+    return '\n'.join(lines) + '\n'
+
+
+# 已結束 worker 的累計計數器與直方圖（見 archive_snapshot）
+ARCHIVE_NAME = 'archive.json'
+
+
+class MultiprocessMetrics:
+    """跨 worker 彙總：每個 worker 每 interval 秒把快照寫成 <目錄>/<pid>.json（原子替換），
+    輸出時合併目錄中所有快照。directory 為 None 時只輸出本程序的指標"""
+
+    def __init__(self, registry, directory=None, interval=5.0):
+        self.registry = registry
+        self.directory = directory
+        self.interval = interval
+        self._thread = None
+        self._lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            # gunicorn --preload 時模組在 master 載入，fork 後執行緒不會延續，需在每個 worker 重新啟動
+            if hasattr(os, 'register_at_fork'):
+                os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        self._thread = None
+        self._lock = threading.Lock()
+        self.start()
+
+    def start(self):
+        """啟動定期寫入的背景執行緒（gunicorn fork 之後，在各 worker 中第一次使用時啟動）"""
+        if not self.directory:
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.write()
+
+    def write(self):
+        if not self.directory:
+            return
+        path = os.path.join(self.directory, f"{os.getpid()}.json")
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.registry.snapshot(), f, separators=(',', ':'))
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"寫入指標快照失敗: {e}")
+
+    def collect(self):
+        """返回合併後的快照（本程序使用即時值，其他 worker 使用最近一次寫入的快照）"""
+        if not self.directory:
+            return self.registry.snapshot()
+        self.start()
+        own = self.registry.snapshot()
+        snapshots = [(own, True)]
+        pid = os.getpid()
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            names = []
+        for name in names:
+            if not name.endswith('.json') or name == f"{pid}.json":
+                continue
+            if name == ARCHIVE_NAME:
+                try:
+                    with open(os.path.join(self.directory, name)) as f:
+                        snapshots.append((json.load(f), False))
+                except (ValueError, OSError):
+                    pass
+                continue
+            try:
+                other = int(name[:-5])
+                with open(os.path.join(self.directory, name)) as f:
+                    snapshots.append((json.load(f), _pid_alive(other)))
+            except (ValueError, OSError):
+                continue
+        return merge_snapshots(snapshots)
+
+    def render(self):
+        return render_prometheus(self.collect())
+
+
+def clear_snapshots(directory):
+    """刪除目錄中所有 worker 的快照（gunicorn master 啟動時執行，不沿用上一次執行的計數）"""
+    if not directory:
+        return 0
+    os.makedirs(directory, exist_ok=True)
+    removed = 0
+    for name in os.listdir(directory):
+        if name.endswith(('.json', '.tmp')):
+            try:
+                os.remove(os.path.join(directory, name))
+                removed += 1
+            except OSError:
+                pass
+    return removed
+
+
+def archive_snapshot(directory, pid):
+    """把已結束 worker 的計數器與直方圖併入 archive.json 後刪除其快照（gunicorn child_exit 時在 master 執行）；
+    合併後的計數不會因 worker 重啟而下降（Prometheus 會誤判為計數器重設），目錄也不會隨 worker 更替而增長"""
+    if not directory:
+        return
+    path = os.path.join(directory, f"{pid}.json")
+    try:
+        with open(path) as f:
+            snapshot = json.load(f)
+    except (OSError, ValueError):
+        return
+    archive_path = os.path.join(directory, ARCHIVE_NAME)
+    try:
+        with open(archive_path) as f:
+            archive = json.load(f)
+    except (OSError, ValueError):
+        archive = []
+    # 量測值只代表仍在執行的 worker，不寫入封存
+    merged = [family for family in merge_snapshots([(archive, False), (snapshot, False)])
+              if family["type"] != 'gauge']
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(merged, f, separators=(',', ':'))
+        os.replace(tmp_path, archive_path)
+        os.remove(path)
+    except OSError as e:
+        print(f"封存指標快照失敗: {e}")
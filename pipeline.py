@@ -0,0 +1,767 @@
+"""
+翻譯與語音處理流程
+main.py（Flask / gunicorn 執行緒）與 asgi_app.py（asyncio）共用同一份流程：流程以協程撰寫，
+所有 I/O（翻譯後端、gTTS、ffmpeg、音訊儲存、翻譯記憶、LINE API）都經由傳入的 io 物件呼叫
+- SyncIO：直接在目前執行緒呼叫，協程不會真正暫停，以 run_sync() 在執行緒中跑完
+- AsyncIO：翻譯、gTTS 與 LINE API 使用非同步 HTTP，ffmpeg 使用 asyncio 子行程；
+  音訊儲存、翻譯記憶等本機的阻塞呼叫交給執行緒池，不卡住事件迴圈
+"""
+import asyncio
+import base64
+import contextvars
+import hashlib
+import json
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from io import BytesIO
+
+from gtts import gTTS
+from linebot.exceptions import LineBotApiError
+from linebot.models import MessageEvent, TextMessage, FollowEvent, TextSendMessage, AudioSendMessage
+
+from audio_format import concat_mp3, audio_duration_ms, estimate_duration_ms
+from audio_store import PendingAudio
+from metrics import LatencyHistogram
+from sentences import split_sentences, join_sentences, batch_chunks
+from singleflight import SingleFlight, AsyncSingleFlight
+from transcoder import TranscodeError
+from translation_cache import TranslationCache, normalize_text
+
+# 固定的回覆訊息只建立一次
+EMPTY_INPUT_MESSAGE = TextSendMessage(text="請輸入要翻譯的文字")
+TRANSLATION_FAILED_MESSAGE = TextSendMessage(text="翻譯失敗，請稍後再試")
+ERROR_MESSAGE = TextSendMessage(text="發生錯誤，請稍後再試")
+
+
+def run_sync(coro):
+    """在目前執行緒跑完一個只經由 SyncIO 做 I/O 的協程（不會真正暫停），返回其結果"""
+    try:
+        coro.send(None)
+    except StopIteration as e:
+        return e.value
+    coro.close()
+    raise RuntimeError("協程在同步模式下暫停（使用了非同步 I/O）")
+
+
+def _run_coroutine(coro_fn, *args):
+    return run_sync(coro_fn(*args))
+
+
+def truncate_tts_text(text):
+    """截斷過長文字以符合 TTS 限制（盡量在句子邊界截斷）"""
+    if len(text) > 5000:
+        kept = ''
+        for sentence, separator in split_sentences(text):
+            if len(kept) + len(sentence) > 5000:
+                break
+            kept += sentence + separator
+        text = (kept.rstrip() or text[:5000]) + "..."
+    return text
+
+
+def tts_sentences(text):
+    """把要朗讀的文字切成句子（略過只有標點或符號的片段）"""
+    return [sentence.strip() for sentence, _ in split_sentences(text) if any(ch.isalnum() for ch in sentence)]
+
+
+def get_dest_lang(src_lang):
+    """依來源語言決定目標語言：越南語 → 繁體中文，其餘 → 越南語"""
+    return 'zh-tw' if src_lang == 'vi' else 'vi' if src_lang in ['zh-cn', 'zh-tw'] else 'vi'
+
+
+def get_tts_lang(lang_code):
+    """將語言代碼轉換為 gTTS 支援的語言代碼"""
+    lang_map = {'vi': 'vi', 'zh-tw': 'zh-tw', 'zh-cn': 'zh-cn', 'zh': 'zh-tw'}
+    return lang_map.get(lang_code, 'vi')
+
+
+def source_key(source):
+    """事件來源的排程 / 限流鍵：群組與聊天室以整個群組計算，一對一聊天以使用者計算"""
+    if source is None:
+        return 'unknown'
+    for kind in ('group', 'room', 'user'):
+        source_id = getattr(source, f'{kind}_id', None)
+        if source_id:
+            return f'{kind}:{source_id}'
+    return 'unknown'
+
+
+def synthesize_mp3(text, lang):
+    """呼叫 gTTS 取得一段 MP3（阻塞）"""
+    audio_buffer = BytesIO()
+    gTTS(text=text, lang=lang, slow=False).write_to_fp(audio_buffer)
+    audio_data = audio_buffer.getvalue()
+    if not audio_data:
+        raise ValueError("生成的音訊資料為空")
+    return audio_data
+
+
+# gTTS 回應中每一段 base64 音訊的位置（與 gTTS.stream() 的解析相同）
+_TTS_AUDIO_RE = re.compile(r'jQ1olc","\[\\"(.*)\\"]')
+
+
+async def synthesize_mp3_async(client, text, lang):
+    """以 gTTS 相同的 RPC 經由 httpx.AsyncClient 取得一段 MP3，不占用執行緒"""
+    chunks = []
+    for prepared in gTTS(text=text, lang=lang, slow=False)._prepare_requests():
+        response = await client.post(prepared.url, data=prepared.body, headers=dict(prepared.headers))
+        response.raise_for_status()
+        for line in response.text.splitlines():
+            if 'jQ1olc' in line:
+                match = _TTS_AUDIO_RE.search(line)
+                if not match:
+                    raise ValueError("TTS 回應中沒有音訊")
+                chunks.append(base64.b64decode(match.group(1).encode('ascii')))
+    audio_data = b''.join(chunks)
+    if not audio_data:
+        raise ValueError("生成的音訊資料為空")
+    return audio_data
+
+
+class SyncIO:
+    """同步 I/O：在呼叫端的執行緒中直接執行（gunicorn 請求執行緒、Webhook 佇列執行緒）；
+    並行的工作各自在臨時的執行緒中以 run_sync() 執行，背景工作交給 background_executor"""
+
+    def __init__(self, translation_backend, transcoder, line_bot_api, background_executor, tts_concurrency=8):
+        self.backend = translation_backend
+        self.transcoder = transcoder
+        self.line_bot_api = line_bot_api
+        # 所有訊息共用的 gTTS 同時請求上限
+        self._tts_slots = threading.BoundedSemaphore(max(1, tts_concurrency))
+        self.flights = {'translation': SingleFlight(), 'audio': SingleFlight()}
+        self._background = background_executor
+        self.pending = PendingAudio(background_executor)
+
+    async def call(self, fn, *args):
+        return fn(*args)
+
+    async def gather(self, coros, limit):
+        """同時執行多個協程（最多 limit 個執行緒），依序返回結果"""
+        coros = list(coros)
+        if len(coros) <= 1 or limit <= 1:
+            return [await coro for coro in coros]
+        # 每個協程在自己的 context 副本中執行，span 才會記錄到目前事件的追蹤
+        context = contextvars.copy_context()
+        with ThreadPoolExecutor(max_workers=min(limit, len(coros)), thread_name_prefix='pipeline') as pool:
+            return list(pool.map(lambda coro: context.copy().run(run_sync, coro), coros))
+
+    async def flight(self, kind, key, coro_fn, *args):
+        """相同 key 同時只執行一次（kind: translation / audio）"""
+        return self.flights[kind].do(key, _run_coroutine, coro_fn, *args)
+
+    async def translate_batch(self, texts, src, dest):
+        return self.backend.translate_batch(texts, src, dest)
+
+    async def detect(self, text):
+        return self.backend.detect(text)
+
+    async def synthesize(self, text, lang):
+        with self._tts_slots:
+            return synthesize_mp3(text, lang)
+
+    async def transcode(self, chunks):
+        return self.transcoder.mp3_to_m4a(chunks)
+
+    async def reply(self, reply_token, messages):
+        self.line_bot_api.reply_message(reply_token, messages)
+
+    async def push(self, to, messages):
+        try:
+            self.line_bot_api.push_message(to, messages)
+        except LineBotApiError as e:
+            # 重試時 LINE 回應相同重試鍵的請求已被接受：訊息已送達
+            if e.status_code != 409:
+                raise
+
+    def submit(self, key, coro_fn, *args):
+        """在背景執行 coro_fn(*args)；key 不為 None 時相同 key 同時只執行一次，可由 wait() 等待"""
+        if key is None:
+            return self._background.submit(_run_coroutine, coro_fn, *args)
+        return self.pending.submit(key, _run_coroutine, coro_fn, *args)
+
+    def wait(self, key, timeout):
+        return self.pending.wait(key, timeout)
+
+    def pending_count(self):
+        return len(self.pending)
+
+    def stats(self):
+        return {kind: flight.stats() for kind, flight in self.flights.items()}
+
+
+class AsyncIO:
+    """非同步 I/O（ASGI）：翻譯、gTTS 與 LINE API 經由共用的 httpx.AsyncClient 呼叫，ffmpeg 以 asyncio 子行程執行，
+    同時處理中的訊息數不受執行緒數限制；音訊儲存、翻譯記憶與沒有非同步實作的翻譯後端交給執行緒池；
+    背景工作保留強參照直到完成"""
+
+    def __init__(self, translation_backend, transcoder, executor, get_client, line_endpoint, access_token,
+                 tts_concurrency=8):
+        self.backend = translation_backend
+        self.transcoder = transcoder
+        self.executor = executor
+        self.tts_concurrency = max(1, tts_concurrency)
+        self._tts_slots = None
+        self.get_client = get_client
+        self.line_endpoint = line_endpoint
+        self.access_token = access_token
+        self.flights = {'translation': AsyncSingleFlight(), 'audio': AsyncSingleFlight()}
+        self.pending = {}
+        # 事件迴圈只以弱參照持有工作，背景工作需保留在集合中直到完成
+        self._tasks = set()
+
+    async def call(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, partial(fn, *args))
+
+    async def gather(self, coros, limit):
+        slots = asyncio.Semaphore(max(1, limit))
+
+        async def run(coro):
+            async with slots:
+                return await coro
+
+        return list(await asyncio.gather(*[run(coro) for coro in coros]))
+
+    async def flight(self, kind, key, coro_fn, *args):
+        return await self.flights[kind].do(key, coro_fn, *args)
+
+    async def translate_batch(self, texts, src, dest):
+        if self.backend.native_async:
+            return await self.backend.translate_batch_async(self.get_client(), texts, src, dest)
+        return await self.call(self.backend.translate_batch, texts, src, dest)
+
+    async def detect(self, text):
+        if self.backend.native_async:
+            return await self.backend.detect_async(self.get_client(), text)
+        return await self.call(self.backend.detect, text)
+
+    async def synthesize(self, text, lang):
+        if self._tts_slots is None:
+            self._tts_slots = asyncio.Semaphore(self.tts_concurrency)
+        async with self._tts_slots:
+            return await synthesize_mp3_async(self.get_client(), text, lang)
+
+    async def transcode(self, chunks):
+        return await self.transcoder.mp3_to_m4a_async(chunks)
+
+    async def _post_line(self, path, payload):
+        response = await self.get_client().post(
+            f"{self.line_endpoint}{path}",
+            data=json.dumps(payload),
+            headers={
+                'Authorization': 'Bearer ' + (self.access_token or ''),
+                'Content-Type': 'application/json',
+            })
+        response.raise_for_status()
+
+    async def reply(self, reply_token, messages):
+        if not isinstance(messages, (list, tuple)):
+            messages = [messages]
+        await self._post_line('/v2/bot/message/reply',
+                              {'replyToken': reply_token, 'messages': [m.as_json_dict() for m in messages]})
+
+    async def push(self, to, messages):
+        if not isinstance(messages, (list, tuple)):
+            messages = [messages]
+        await self._post_line('/v2/bot/message/push', {'to': to, 'messages': [m.as_json_dict() for m in messages]})
+
+    def submit(self, key, coro_fn, *args):
+        """在背景執行 await coro_fn(*args)；key 不為 None 時相同 key 同時只執行一次，可由 wait() 等待"""
+        if key is not None and key in self.pending:
+            return self.pending[key]
+        task = asyncio.ensure_future(coro_fn(*args))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        if key is not None:
+            self.pending[key] = task
+            task.add_done_callback(lambda t: self._discard(key, t))
+        return task
+
+    def _discard(self, key, task):
+        if self.pending.get(key) is task:
+            del self.pending[key]
+
+    async def wait(self, key, timeout):
+        task = self.pending.get(key)
+        if task is None:
+            return False
+        try:
+            await asyncio.wait_for(asyncio.shield(task), timeout)
+        except Exception:
+            # 逾時或生成失敗都交由呼叫端查詢儲存後決定是否 404
+            pass
+        return True
+
+    def pending_count(self):
+        return len(self.pending)
+
+    def background_count(self):
+        return len(self._tasks)
+
+    def stats(self):
+        return {kind: flight.stats() for kind, flight in self.flights.items()}
+
+
+class Pipeline:
+    """偵測語言 → 翻譯 → 語音 → 回覆的流程；快取、指標與語音負載等狀態由同步與非同步 I/O 共用，
+    每個方法的 io 參數決定 I/O 的執行方式"""
+
+    def __init__(self, translation_cache, language_detector, audio_store, tracer, metrics_registry,
+                 translation_memory=None, tts_limiter=None, base_url=None, greeting_message=None,
+                 audio_format='m4a', audio_bitrate='64k', audio_pipeline=False, audio_fallback='drop',
+                 reply_budget_ms=8000, audio_expected_seconds=2, audio_max_inflight=8,
+                 sentence_workers=4, event_fanout=4):
+        self.translation_cache = translation_cache
+        self.language_detector = language_detector
+        self.translation_memory = translation_memory
+        self.audio_store = audio_store
+        self.tracer = tracer
+        self.tts_limiter = tts_limiter
+        self.base_url = base_url or (lambda: '')
+        self.greeting_message = greeting_message
+        self.audio_format = audio_format
+        self.audio_bitrate = audio_bitrate
+        self.audio_pipeline = audio_pipeline
+        self.audio_fallback = audio_fallback
+        self.reply_budget_ms = reply_budget_ms
+        self.audio_expected_seconds = audio_expected_seconds
+        self.audio_max_inflight = audio_max_inflight
+        self.sentence_workers = sentence_workers
+        self.event_fanout = event_fanout
+        # 同時生成中的語音數（指標）與每段語音的生成時間
+        self.audio_latency = LatencyHistogram(buckets=(0.25, 0.5, 0.75, 1.0, 1.5, 2.0, 3.0, 4.0, 5.0, 7.5, 10.0, 15.0))
+        self.audio_inflight = 0
+        # 判斷是否滿載的語音工作數，每個工作只計一次：回覆前立即生成中的語音、尚未完成的補送，
+        # 以及 io.pending_count()（管線模式背景生成中的語音）
+        self.inline_audio = 0
+        self.queued_pushes = 0
+        self._load_lock = threading.Lock()
+        self._register_metrics(metrics_registry)
+
+    def _register_metrics(self, registry):
+        self.metrics = registry
+        self.stage_seconds = registry.histogram(
+            'stage_seconds', '各處理階段耗時（秒）', label='stage')
+        self.stage_errors = registry.counter(
+            'stage_errors_total', '各處理階段發生錯誤的次數', label='stage')
+        self.batched_events = registry.counter(
+            'batched_events_total', '以多事件投遞合併處理的事件數')
+        self.tts_skipped = registry.counter(
+            'tts_skipped_total', '未生成語音、只回覆文字的次數', label='reason')
+        self.audio_paths = registry.counter(
+            'audio_paths_total', '語音的處理方式（cached / inline / pipeline / push / none）', label='path')
+        self.audio_pushes = registry.counter(
+            'audio_pushes_total', '以 push message 補送語音的結果', label='result')
+        registry.gauge_func(
+            'audio_inflight', '生成中的語音數', lambda: self.audio_inflight)
+        self.audio_cache_requests = registry.counter(
+            'audio_cache_requests_total', '譯文語音快取查詢次數（hit / miss）', label='result')
+
+    @contextmanager
+    def timed(self, stage):
+        """計時一個處理階段（verify / detect / translate / tts / transcode / store / reply），
+        記錄到指標直方圖與目前事件的追蹤 span"""
+        with self.metrics.timer(self.stage_seconds, stage, self.stage_errors), self.tracer.span(stage):
+            yield
+
+    # ---- 語言檢測與翻譯 ----
+
+    async def detect_language(self, io, text):
+        """檢測文字語言（先查快取，再本地檢測，信心不足才呼叫遠端）"""
+        src_lang = self.translation_cache.get(text, 'detect', '')
+        if src_lang is None:
+            src_lang = self.language_detector.detect_local(text)
+            if src_lang is None:
+                src_lang = (await io.flight('translation', ('detect', normalize_text(text)), io.detect, text)).lower()
+            self.translation_cache.put(text, 'detect', '', src_lang)
+        return src_lang
+
+    async def lookup_translation(self, io, text, src_lang, dest_lang):
+        """查詢記憶體快取與持久化翻譯記憶，未命中返回 None"""
+        translated_text = self.translation_cache.get(text, src_lang, dest_lang)
+        if translated_text is None and self.translation_memory is not None:
+            translated_text = await io.call(self.translation_memory.get, text, src_lang, dest_lang)
+            if translated_text is not None:
+                self.translation_cache.put(text, src_lang, dest_lang, translated_text)
+        return translated_text
+
+    async def remember_translation(self, io, text, src_lang, dest_lang, translated_text):
+        """把新的翻譯結果寫入記憶體快取與持久化翻譯記憶"""
+        if not translated_text or not translated_text.strip():
+            return
+        self.translation_cache.put(text, src_lang, dest_lang, translated_text)
+        if self.translation_memory is not None:
+            await io.call(self.translation_memory.put, text, src_lang, dest_lang, translated_text)
+
+    async def translate_text(self, io, text, src_lang, dest_lang):
+        """翻譯文字（先查快取與翻譯記憶）；多句訊息逐句查快取，只把未快取的句子批次送出翻譯"""
+        return (await self.translate_texts(io, [text], src_lang, dest_lang))[0]
+
+    async def translate_texts(self, io, texts, src_lang, dest_lang):
+        """翻譯多則相同語言方向的文字：整段與各句先查快取，
+        相同的句子只翻譯一次，所有未快取的句子合併成批次請求"""
+        results = [await self.lookup_translation(io, text, src_lang, dest_lang) for text in texts]
+        pending = {}
+        translations = {}
+        missing = {}
+        for i, text in enumerate(texts):
+            if results[i] is not None:
+                continue
+            parts = split_sentences(text.strip())
+            pending[i] = parts
+            for sentence, _ in parts:
+                key = normalize_text(sentence)
+                if key in translations or key in missing:
+                    continue
+                cached = await self.lookup_translation(io, sentence, src_lang, dest_lang)
+                if cached is None:
+                    missing[key] = sentence
+                else:
+                    translations[key] = cached
+        chunks = batch_chunks(list(missing.values()))
+        chunk_results = await io.gather([self._translate_chunk(io, chunk, src_lang, dest_lang) for chunk in chunks],
+                                        len(chunks))
+        for chunk, translated in zip(chunks, chunk_results):
+            translations.update(zip((normalize_text(sentence) for sentence in chunk), translated))
+        if pending:
+            self.tracer.annotate(sentences=sum(len(parts) for parts in pending.values()),
+                                 translated_sentences=len(missing))
+        for i, parts in pending.items():
+            results[i] = join_sentences([(translations[normalize_text(sentence)], sep) for sentence, sep in parts],
+                                        dest_lang)
+            await self.remember_translation(io, texts[i], src_lang, dest_lang, results[i])
+        return results
+
+    async def _translate_chunk(self, io, chunk, src_lang, dest_lang):
+        if len(chunk) == 1:
+            key = TranslationCache.make_key(chunk[0], src_lang, dest_lang)
+        else:
+            key = ('batch', src_lang, dest_lang) + tuple(normalize_text(sentence) for sentence in chunk)
+        return await io.flight('translation', key, self._fetch_translations, io, chunk, src_lang, dest_lang)
+
+    async def _fetch_translations(self, io, sentences, src_lang, dest_lang):
+        """以一次請求翻譯一句或多句，並逐句記住結果"""
+        results = await io.translate_batch(sentences, src_lang, dest_lang)
+        for sentence, translated_text in zip(sentences, results):
+            await self.remember_translation(io, sentence, src_lang, dest_lang, translated_text)
+        return results
+
+    # ---- 語音 ----
+
+    def make_audio_id(self, text, tts_lang, format_type, bitrate=None):
+        """以 (文字, 語言, 格式, 位元率) 的雜湊產生內容位址音訊 ID"""
+        key = '\0'.join([text, tts_lang, format_type, bitrate or self.audio_bitrate])
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()[:32]
+
+    def build_audio_url(self, audio_id):
+        """組出 LINE 可取用的 HTTPS 音訊 URL"""
+        base_url = self.base_url()
+        if not base_url:
+            raise ValueError("BASE_URL 未設定")
+        if not base_url.startswith('http'):
+            base_url = f"https://{base_url}"
+        elif base_url.startswith('http://'):
+            base_url = base_url.replace('http://', 'https://', 1)
+        return f"{base_url.rstrip('/')}/audio/{audio_id}"
+
+    async def sentence_audio(self, io, sentence, lang, cache=True):
+        """取得單句的 MP3：先查快取，未命中才呼叫 gTTS（同一句同時只合成一次）；
+        cache 為 False 時合成結果不存入句子快取（單句訊息的整段語音另有快取，不重複存放）"""
+        # 以 'sentence' 取代格式參與雜湊，與整段語音的 ID 區隔
+        audio_id = self.make_audio_id(sentence, lang, 'sentence')
+        entry = await io.call(self.audio_store.get, audio_id)
+        if entry is not None:
+            return entry.data
+        return await io.flight('audio', audio_id, self._synthesize_sentence, io, audio_id, sentence, lang, cache)
+
+    async def _synthesize_sentence(self, io, audio_id, sentence, lang, cache):
+        with self.timed('tts'):
+            audio_data = await io.synthesize(sentence, lang)
+        if cache:
+            with self.timed('store'):
+                await io.call(self.audio_store.put, audio_id, audio_data, 'mp3')
+        return audio_data
+
+    async def generate_audio(self, io, text, lang):
+        """逐句生成語音（並行、逐句快取）並在容器層級串接，返回 (音訊資料, 播放長度毫秒, 格式類型)；
+        每則訊息最多同時合成 sentence_workers 句，所有訊息合計受 io 的 gTTS 同時請求上限限制"""
+        text = truncate_tts_text(text)
+        sentences = tts_sentences(text)
+        if not sentences:
+            raise ValueError("No text to send to TTS API")
+        # 各句音訊保留到串接完成（轉檔失敗時改用 MP3 串接），一則訊息最多約 5000 字的語音
+        clips = await io.gather([self.sentence_audio(io, sentence, lang, cache=len(sentences) > 1)
+                                 for sentence in sentences], self.sentence_workers)
+        self.tracer.annotate(audio_sentences=len(sentences))
+        if self.audio_format == 'm4a':
+            try:
+                # 各句 MP3 去除標頭後逐段寫入 ffmpeg 管線，不先串接成一整段
+                with self.timed('transcode'):
+                    audio_data, _ = await io.transcode(concat_mp3(clips))
+                return (audio_data, audio_duration_ms(audio_data, 'm4a'), 'm4a')
+            except TranscodeError as e:
+                print(f"M4A 轉換失敗，使用 MP3: {e}")
+        audio_data = b''.join(concat_mp3(clips))
+        return (audio_data, audio_duration_ms(audio_data, 'mp3'), 'mp3')
+
+    async def produce_audio(self, io, audio_id, text, tts_lang):
+        """生成語音並存入快取，返回 (音訊資料, 播放長度毫秒, 格式類型)；相同 ID 同時只生成一次"""
+        return await io.flight('audio', audio_id, self._generate_and_store_audio, io, audio_id, text, tts_lang)
+
+    async def _generate_and_store_audio(self, io, audio_id, text, tts_lang):
+        with self.audio_generation():
+            audio_data, duration, audio_format = await self.generate_audio(io, text, tts_lang)
+        with self.timed('store'):
+            stored = await io.call(self.audio_store.put, audio_id, audio_data, audio_format, duration)
+        if not stored:
+            raise ValueError(f"音訊過大，無法快取: {len(audio_data)} bytes")
+        return (audio_data, duration, audio_format)
+
+    async def produce_audio_in_background(self, io, audio_id, text, tts_lang):
+        """背景生成語音（管線模式），錯誤只記錄不拋出"""
+        try:
+            await self.produce_audio(io, audio_id, text, tts_lang)
+        except Exception as e:
+            print(f"背景語音生成錯誤: {audio_id}, {e}")
+        finally:
+            await io.call(self.audio_store.clear_pending, audio_id)
+
+    # ---- 回覆期限與負載 ----
+
+    @contextmanager
+    def audio_generation(self):
+        """記錄同時生成中的語音數與每段語音的生成時間（用於判斷是否來得及在回覆期限內附上語音）"""
+        with self._load_lock:
+            self.audio_inflight += 1
+        start = time.perf_counter()
+        try:
+            yield
+            self.audio_latency.observe(time.perf_counter() - start)
+        finally:
+            with self._load_lock:
+                self.audio_inflight -= 1
+
+    def expected_audio_seconds(self):
+        """預估生成一段語音所需的時間：最近生成時間的 p90，資料不足時使用 audio_expected_seconds"""
+        if self.audio_latency.count < 10:
+            return self.audio_expected_seconds
+        return self.audio_latency.percentile(90)
+
+    def reply_deadline(self, event):
+        """依事件時間戳記算出回覆期限（time.monotonic()）；時間戳記不合理（時鐘偏差）時從現在起算"""
+        if self.reply_budget_ms <= 0:
+            return None
+        age = time.time() - (event.timestamp or 0) / 1000
+        if not 0 <= age <= 60:
+            age = 0.0
+        return time.monotonic() - age + self.reply_budget_ms / 1000
+
+    def audio_jobs(self, io):
+        """尚未完成的語音工作數（立即生成、背景生成與補送各計一次）"""
+        with self._load_lock:
+            jobs = self.inline_audio + self.queued_pushes
+        return jobs + io.pending_count()
+
+    def audio_skip_reason(self, io, deadline, source=None):
+        """需要生成語音時判斷是否先略過：滿載返回 'saturated'，剩餘時間不足返回 'budget'，
+        來源超出語音額度返回 'rate_limited'，否則返回 None（額度只在確定要合成時才扣除）"""
+        if self.audio_max_inflight > 0 and self.audio_jobs(io) >= self.audio_max_inflight:
+            return 'saturated'
+        if deadline is not None and not self.audio_pipeline and deadline - time.monotonic() < self.expected_audio_seconds():
+            return 'budget'
+        if source is not None and self.tts_limiter is not None and not self.tts_limiter.allow(source_key(source)):
+            return 'rate_limited'
+        return None
+
+    # ---- 訊息 ----
+
+    async def build_audio_message(self, io, translated_text, dest_lang, deadline=None, source=None):
+        """取得譯文的語音（快取、背景生成或立即生成），返回 (AudioSendMessage, None)；
+        需要生成但已滿載、來不及在回覆期限內完成或來源超出語音額度時返回 (None, 略過原因)（只回覆文字）"""
+        tts_lang = get_tts_lang(dest_lang)
+        audio_id = self.make_audio_id(translated_text, tts_lang, self.audio_format)
+        entry = await io.call(self.audio_store.get, audio_id)
+        self.audio_cache_requests.inc('miss' if entry is None else 'hit')
+        # 已快取的語音不需要合成，不檢查負載也不扣除來源的語音額度
+        skip_reason = None if entry is not None else self.audio_skip_reason(io, deadline, source)
+        if skip_reason:
+            self.tts_skipped.inc(skip_reason)
+            self.tracer.annotate(audio_skipped=skip_reason)
+            return (None, skip_reason)
+        if entry is not None:
+            # 相同的翻譯結果直接重用已編碼的語音與其播放長度，不再呼叫 gTTS 與 ffmpeg
+            audio_bytes, audio_format, duration = entry.size, entry.format, entry.duration
+            self.audio_paths.inc('cached')
+        elif self.audio_pipeline:
+            # 先回覆，語音在背景生成；LINE 取用 /audio/<id> 時會等待生成完成（長度只能估計）
+            await io.call(self.audio_store.mark_pending, audio_id)
+            io.submit(audio_id, self.produce_audio_in_background, io, audio_id, translated_text, tts_lang)
+            audio_bytes, audio_format, duration = 0, 'pending', None
+            self.audio_paths.inc('pipeline')
+        else:
+            with self._load_lock:
+                self.inline_audio += 1
+            try:
+                audio_data, duration, audio_format = await self.produce_audio(io, audio_id, translated_text, tts_lang)
+            finally:
+                with self._load_lock:
+                    self.inline_audio -= 1
+            audio_bytes = len(audio_data)
+            self.audio_paths.inc('inline')
+        audio_url = self.build_audio_url(audio_id)
+        duration = duration or estimate_duration_ms(truncate_tts_text(translated_text), tts_lang)
+        self.tracer.annotate(audio_id=audio_id, audio_cached=entry is not None, audio_format=audio_format,
+                             audio_bytes=audio_bytes, audio_duration_ms=duration)
+        return (AudioSendMessage(original_content_url=audio_url, duration=duration), None)
+
+    def push_audio_later(self, io, source, translated_text, dest_lang):
+        """在背景生成語音，完成後以 push message 補送到原本的聊天室；尚未完成的補送過多時放棄"""
+        target = source_key(source).split(':', 1)[-1]
+        with self._load_lock:
+            accepted = target != 'unknown' and (self.audio_max_inflight <= 0
+                                                or self.queued_pushes < self.audio_max_inflight)
+            if accepted:
+                self.queued_pushes += 1
+        if not accepted:
+            self.audio_paths.inc('none')
+            return
+        tts_lang = get_tts_lang(dest_lang)
+        audio_id = self.make_audio_id(translated_text, tts_lang, self.audio_format)
+        self.audio_paths.inc('push')
+        io.submit(None, self._push_audio, io, target, audio_id, translated_text, tts_lang)
+
+    async def _push_audio(self, io, target, audio_id, translated_text, tts_lang):
+        try:
+            _, duration, _ = await self.produce_audio(io, audio_id, translated_text, tts_lang)
+            duration = duration or estimate_duration_ms(truncate_tts_text(translated_text), tts_lang)
+            await io.push(target, AudioSendMessage(original_content_url=self.build_audio_url(audio_id),
+                                                   duration=duration))
+            self.audio_pushes.inc('sent')
+        except Exception as e:
+            self.audio_pushes.inc('failed')
+            print(f"補送語音錯誤: {audio_id}, {e}")
+        finally:
+            with self._load_lock:
+                self.queued_pushes -= 1
+
+    async def reply(self, io, reply_token, messages):
+        """呼叫 LINE reply API（計入 reply 階段耗時）"""
+        with self.timed('reply'):
+            await io.reply(reply_token, messages)
+
+    async def handle_follow(self, io, event):
+        """處理用戶加入好友事件 - 發送歡迎訊息"""
+        try:
+            await self.reply(io, event.reply_token, self.greeting_message)
+        except Exception as e:
+            print(f"發送歡迎訊息錯誤: {e}")
+
+    async def handle_message(self, io, event):
+        """處理文字訊息：檢測語言、翻譯，附上語音後回覆"""
+        deadline = self.reply_deadline(event)
+        try:
+            input_text = event.message.text
+            if not input_text or not input_text.strip():
+                await self.reply(io, event.reply_token, EMPTY_INPUT_MESSAGE)
+                return
+            with self.timed('detect'):
+                src_lang = await self.detect_language(io, input_text)
+            dest_lang = get_dest_lang(src_lang)
+            self.tracer.annotate(src_lang=src_lang, dest_lang=dest_lang, chars=len(input_text))
+            with self.timed('translate'):
+                translated_text = await self.translate_text(io, input_text, src_lang, dest_lang)
+            if not translated_text or not translated_text.strip():
+                await self.reply(io, event.reply_token, TRANSLATION_FAILED_MESSAGE)
+                return
+            messages = [TextSendMessage(text=translated_text)]
+            try:
+                audio_message, skip_reason = await self.build_audio_message(
+                    io, translated_text, dest_lang, deadline, event.source)
+                if audio_message is not None:
+                    messages.append(audio_message)
+                elif skip_reason != 'rate_limited' and self.audio_fallback == 'push':
+                    self.push_audio_later(io, event.source, translated_text, dest_lang)
+                else:
+                    # 來源超出語音額度（例如洗版的群組）時也不補送，不佔用 gTTS 與轉檔資源
+                    self.audio_paths.inc('none')
+            except Exception as e:
+                print(f"語音生成錯誤: {e}")
+                self.tracer.annotate(audio_error=f"{type(e).__name__}: {e}")
+                self.audio_paths.inc('none')
+            await self.reply(io, event.reply_token, messages)
+        except Exception as e:
+            print(f"處理訊息錯誤: {e}")
+            self.tracer.annotate(error=f"{type(e).__name__}: {e}")
+            try:
+                await self.reply(io, event.reply_token, ERROR_MESSAGE)
+            except Exception:
+                pass
+
+    # ---- 事件 ----
+
+    async def dispatch(self, io, event):
+        """依事件類型呼叫處理函數（文字訊息、加入好友），其他事件忽略"""
+        if isinstance(event, MessageEvent) and isinstance(event.message, TextMessage):
+            await self.handle_message(io, event)
+        elif isinstance(event, FollowEvent):
+            await self.handle_follow(io, event)
+
+    async def process_event(self, io, event):
+        """處理單一事件（一個事件一筆追蹤記錄），錯誤只記錄不拋出"""
+        try:
+            with self.tracer.trace(event.webhook_event_id, event=event.type):
+                await self.dispatch(io, event)
+        except Exception as e:
+            print(f"事件處理錯誤: {e}")
+
+    async def process_events(self, io, events):
+        """處理一次 webhook 投遞中的所有事件；多個事件時先合併翻譯，再以有限的併發同時處理"""
+        if len(events) <= 1:
+            for event in events:
+                await self.process_event(io, event)
+            return
+        self.batched_events.inc(amount=len(events))
+        try:
+            await self.prefetch_translations(io, events)
+        except Exception as e:
+            # 合併翻譯失敗時各事件仍會各自翻譯
+            print(f"合併翻譯錯誤: {e}")
+        await io.gather([self.process_event(io, event) for event in events], self.event_fanout)
+
+    async def batch_translation_groups(self, io, events):
+        """找出投遞中的文字訊息，依 (來源語言, 目標語言) 分組，返回 {(src, dest): [文字]}"""
+        texts = [event.message.text for event in events
+                 if isinstance(event, MessageEvent) and isinstance(event.message, TextMessage)
+                 and event.message.text and event.message.text.strip()]
+        # 本地無法判斷的文字（如不帶聲調的越南文）需要遠端檢測，同時檢測而非逐則等待
+        unique = list(dict.fromkeys(texts))
+        detected = await io.gather([self.detect_language(io, text) for text in unique], self.event_fanout)
+        src_langs = dict(zip(unique, detected))
+        groups = {}
+        for text in texts:
+            src_lang = src_langs[text]
+            groups.setdefault((src_lang, get_dest_lang(src_lang)), []).append(text)
+        return groups
+
+    async def prefetch_translations(self, io, events):
+        """同一次投遞的多則訊息以一次批次請求翻譯（結果存入快取，逐則處理時直接命中）"""
+        groups = await self.batch_translation_groups(io, events)
+        await io.gather([self.translate_texts(io, texts, src_lang, dest_lang)
+                         for (src_lang, dest_lang), texts in groups.items() if len(texts) > 1], len(groups))
+
+    async def prewarm_phrase(self, io, text):
+        """預先計算一句常用語的翻譯與語音並存入快取，返回是否新生成了語音"""
+        src_lang = await self.detect_language(io, text)
+        dest_lang = get_dest_lang(src_lang)
+        translated_text = await self.translate_text(io, text, src_lang, dest_lang)
+        if not translated_text or not translated_text.strip():
+            return False
+        tts_lang = get_tts_lang(dest_lang)
+        audio_id = self.make_audio_id(translated_text, tts_lang, self.audio_format)
+        if await io.call(self.audio_store.__contains__, audio_id):
+            return False
+        await self.produce_audio(io, audio_id, translated_text, tts_lang)
+        return True
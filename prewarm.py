@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""
+快取預熱
+從常用語清單或翻譯記憶中的熱門條目，預先計算翻譯與語音並存入快取；
+在背景執行緒中以有限併發執行，不影響服務啟動
+
+使用方法（需搭配 AUDIO_STORE=disk/shm 與 TRANSLATION_MEMORY_PATH，預熱結果才會被服務行程共用）:
+    python prewarm.py prewarm_phrases.txt
+    python prewarm.py --from-history 200 --concurrency 4
+
+gunicorn 部署時由 gunicorn.conf.py 的 when_ready 依 PREWARM_* 環境變數啟動一次本程式；
+預熱結果無法共用時（未設定 TRANSLATION_MEMORY_PATH 或音訊儲存不是 disk / shm）改由每個 worker 各自預熱
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from translation_cache import normalize_text
+
+
+def load_phrases(path):
+    """讀取常用語清單（每行一句，忽略空行與 # 開頭的註解）"""
+    phrases = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                phrases.append(line)
+    return phrases
+
+
+def unique_phrases(phrases):
+    """依正規化後的文字去除重複，保留原順序"""
+    seen = set()
+    result = []
+    for phrase in phrases:
+        key = normalize_text(phrase)
+        if key and key not in seen:
+            seen.add(key)
+            result.append(phrase)
+    return result
+
+
+class CacheWarmer:
+    """以有限併發對每個常用語呼叫 warm_one(text)"""
+
+    def __init__(self, warm_one, concurrency=2, status_path=None):
+        self._warm_one = warm_one
+        self.concurrency = max(1, concurrency)
+        # 另開行程預熱時把進度寫入此檔案，讓服務行程的健康檢查也能看到
+        self.status_path = status_path
+        self._lock = threading.Lock()
+        self._thread = None
+        self.total = 0
+        self.done = 0
+        self.generated = 0
+        self.failed = 0
+        self.running = False
+        self.elapsed = 0.0
+
+    def start(self, phrases):
+        """在背景執行緒開始預熱，已在執行時返回 False"""
+        with self._lock:
+            if self.running:
+                return False
+            self.running = True
+        self._thread = threading.Thread(target=self.run, args=(phrases,), name='cache-warmer', daemon=True)
+        self._thread.start()
+        return True
+
+    def run(self, phrases):
+        """同步執行預熱，返回統計"""
+        phrases = unique_phrases(phrases)
+        with self._lock:
+            self.running = True
+            self.total += len(phrases)
+        start = time.monotonic()
+        self.write_status()
+        try:
+            with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='prewarm') as pool:
+                for _ in pool.map(self._warm, phrases):
+                    self.write_status()
+        finally:
+            with self._lock:
+                self.running = False
+                self.elapsed = time.monotonic() - start
+            self.write_status()
+        print(f"快取預熱完成: {self.done} 句，新生成語音 {self.generated} 段，失敗 {self.failed} 句，"
+              f"耗時 {self.elapsed:.1f} 秒")
+        return self.stats()
+
+    def _warm(self, phrase):
+        try:
+            generated = self._warm_one(phrase)
+        except Exception as e:
+            print(f"預熱失敗: {phrase[:30]}, {e}")
+            with self._lock:
+                self.failed += 1
+            return
+        with self._lock:
+            self.done += 1
+            if generated:
+                self.generated += 1
+
+    def join(self, timeout=None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def write_status(self):
+        """把目前進度原子寫入 status_path（未設定時不寫入）"""
+        if not self.status_path:
+            return
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.status_path) or '.', suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.stats(), f)
+            os.replace(tmp_path, self.status_path)
+        except OSError as e:
+            print(f"寫入預熱進度失敗: {e}")
+
+    def stats(self):
+        """返回預熱進度"""
+        with self._lock:
+            return {
+                "running": self.running,
+                "total": self.total,
+                "done": self.done,
+                "generated": self.generated,
+                "failed": self.failed,
+                "elapsed": round(self.elapsed, 1),
+            }
+
+
+def read_status(path):
+    """讀取預熱行程寫入的進度，檔案不存在或無法解析時返回 None"""
+    if not path:
+        return None
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def prewarm_configured():
+    """是否設定了 PREWARM_PHRASES_FILE 或 PREWARM_FROM_HISTORY"""
+    return bool(os.getenv('PREWARM_PHRASES_FILE', '')) or int(os.getenv('PREWARM_FROM_HISTORY', 0)) > 0
+
+
+def results_shared():
+    """另開行程的預熱結果能否被服務行程使用：翻譯需寫入翻譯記憶（worker 快取未命中時查詢），
+    語音需存在 disk / shm 等共用儲存；否則預熱行程結束時結果就消失"""
+    return (bool(os.getenv('TRANSLATION_MEMORY_PATH', ''))
+            and os.getenv('AUDIO_STORE', 'memory').lower() in ('disk', 'shm'))
+
+
+def command_from_env():
+    """依 PREWARM_PHRASES_FILE / PREWARM_FROM_HISTORY / PREWARM_CONCURRENCY 組出預熱指令；
+    未設定預熱或預熱結果無法共用（見 results_shared）時返回 None"""
+    if not prewarm_configured() or not results_shared():
+        return None
+    phrases_file = os.getenv('PREWARM_PHRASES_FILE', '')
+    command = [sys.executable, os.path.abspath(__file__)]
+    if phrases_file:
+        command.append(phrases_file)
+    command += ['--from-history', os.getenv('PREWARM_FROM_HISTORY', '0'),
+                '--concurrency', os.getenv('PREWARM_CONCURRENCY', '2')]
+    if os.getenv('PREWARM_STATUS_FILE'):
+        command += ['--status-file', os.getenv('PREWARM_STATUS_FILE')]
+    return command
+
+
+def main():
+    parser = argparse.ArgumentParser(description='預先計算常用語的翻譯與語音')
+    parser.add_argument('files', nargs='*', help='常用語清單檔案（每行一句）')
+    parser.add_argument('--from-history', type=int, default=0, help='同時預熱翻譯記憶中最常使用的 N 句')
+    parser.add_argument('--concurrency', type=int, default=2, help='同時預熱的句數')
+    parser.add_argument('--status-file', help='把預熱進度寫入此 JSON 檔（gunicorn 部署時供 worker 的健康檢查讀取）')
+    args = parser.parse_args()
+
+    import main as bot
+    phrases = []
+    for path in args.files:
+        phrases.extend(load_phrases(path))
+    phrases.extend(bot.history_phrases(args.from_history))
+    if not phrases:
+        parser.error('沒有可預熱的常用語')
+    stats = CacheWarmer(bot.prewarm_phrase, args.concurrency, status_path=args.status_file).run(phrases)
+    sys.exit(0 if stats['failed'] == 0 else 1)
+
+
+if __name__ == '__main__':
+    main()
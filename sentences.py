@@ -0,0 +1,99 @@
+"""
+分句與批次翻譯輔助
+把訊息切成句子（保留句子之間的分隔字元，可原樣組回），
+未快取的句子以換行串接成一次翻譯請求，再依換行拆回各句
+"""
+# 中文句末標點直接斷句；英文 / 越南語的 . ! ? 後面需接空白或文字結尾才斷句（避免切開 1.500、3.14）
+_CJK_TERMINATORS = '。！？'
+_LATIN_TERMINATORS = '.!?…'
+_CLOSING = '\'"”’）)]」』'
+_CJK_END = '。！？…」』）'
+
+
+def _sentence_end(text, pos):
+    """返回從 pos 開始的句子結束位置（不含後面的空白）"""
+    length = len(text)
+    i = pos
+    while i < length:
+        ch = text[i]
+        if ch == '\n':
+            return i
+        if ch in _CJK_TERMINATORS or ch in _LATIN_TERMINATORS:
+            j = i
+            while j < length and (text[j] in _CJK_TERMINATORS or text[j] in _LATIN_TERMINATORS):
+                j += 1
+            while j < length and text[j] in _CLOSING:
+                j += 1
+            if ch in _CJK_TERMINATORS or j == length or text[j].isspace():
+                return j
+            i = j
+            continue
+        i += 1
+    return length
+
+
+def split_sentences(text):
+    """切分句子，返回 [(句子, 後面的分隔字元)]；''.join(句子 + 分隔) == 原文"""
+    parts = []
+    pos = 0
+    length = len(text)
+    while pos < length:
+        end = max(_sentence_end(text, pos), pos + 1)
+        sep_end = end
+        while sep_end < length and text[sep_end].isspace():
+            sep_end += 1
+        sentence = text[pos:end]
+        separator = text[end:sep_end]
+        if sentence.strip() or not parts:
+            parts.append((sentence, separator))
+        else:
+            # 只有空白的片段併入前一句的分隔
+            previous, previous_sep = parts[-1]
+            parts[-1] = (previous, previous_sep + sentence + separator)
+        pos = sep_end
+    return parts
+
+
+def join_sentences(parts, dest_lang):
+    """依原本的分隔組回譯文；中文句末標點後沒有空白時，譯成越南語需補一個空格"""
+    pieces = []
+    for i, (sentence, separator) in enumerate(parts):
+        pieces.append(sentence)
+        if (not separator and i + 1 < len(parts) and not dest_lang.startswith('zh')
+                and sentence and not sentence[-1].isspace()):
+            separator = ' '
+        elif separator and dest_lang.startswith('zh') and separator.strip() == '' and '\n' not in separator \
+                and sentence and sentence[-1] in _CJK_END:
+            # 譯成中文時句子之間不需要空白
+            separator = ''
+        pieces.append(separator)
+    return ''.join(pieces).strip()
+
+
+def batch_chunks(texts, max_chars=4500):
+    """把待翻譯的句子分成以換行串接後不超過 max_chars 的批次（單句過長時自成一批）"""
+    chunks = []
+    current = []
+    size = 0
+    for text in texts:
+        added = len(text) + (1 if current else 0)
+        if current and size + added > max_chars:
+            chunks.append(current)
+            current = []
+            size = 0
+            added = len(text)
+        current.append(text)
+        size += added
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def split_batch_result(translated, count):
+    """依換行拆回各句譯文；行數不符時返回 None（由呼叫端改為逐句翻譯）"""
+    lines = [line.strip() for line in (translated or '').split('\n')]
+    if count > 1:
+        lines = [line for line in lines if line]
+    if len(lines) != count:
+        return None
+    return lines
@@ -0,0 +1,98 @@
+"""
+相同請求合併（single-flight）
+同一個鍵同時只執行一次，期間到達的相同請求等待並共用同一個結果，
+用於合併同時送來的相同翻譯與語音生成
+"""
+import asyncio
+import threading
+from concurrent.futures import Future
+
+
+class SingleFlight:
+    """執行緒版本：第一個呼叫者在自己的執行緒中執行，其餘呼叫者等待其結果"""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.coalesced = 0
+
+    def do(self, key, fn, *args, **kwargs):
+        """執行 fn(*args, **kwargs)；相同鍵已在執行時等待並返回同一個結果（或例外）"""
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                self.coalesced += 1
+                leader = False
+            else:
+                future = Future()
+                self._calls[key] = future
+                self.calls += 1
+                leader = True
+        if not leader:
+            return future.result()
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._calls)
+
+    def stats(self):
+        """返回實際執行次數、被合併的請求數與執行中的鍵數"""
+        with self._lock:
+            return _stats(self.calls, self.coalesced, len(self._calls))
+
+
+class AsyncSingleFlight:
+    """asyncio 版本（ASGI 使用）：相同鍵共用同一個 Task"""
+
+    def __init__(self):
+        self._tasks = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    async def do(self, key, coro_fn, *args):
+        """執行 await coro_fn(*args)；相同鍵已在執行時等待同一個 Task"""
+        task = self._tasks.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            task = asyncio.ensure_future(coro_fn(*args))
+            self._tasks[key] = task
+            self.calls += 1
+            task.add_done_callback(lambda t: self._done(key, t))
+        # shield：單一等待者被取消時不影響其他等待者
+        return await asyncio.shield(task)
+
+    def _done(self, key, task):
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+        if not task.cancelled():
+            # 所有等待者都已取消時，避免出現未取得例外的警告
+            task.exception()
+
+    def __len__(self):
+        return len(self._tasks)
+
+    def stats(self):
+        return _stats(self.calls, self.coalesced, len(self._tasks))
+
+
+def _stats(calls, coalesced, in_flight):
+    total = calls + coalesced
+    return {
+        "calls": calls,
+        "coalesced": coalesced,
+        "coalesced_rate": round(coalesced / total, 4) if total else 0.0,
+        "in_flight": in_flight,
+    }
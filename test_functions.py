@@ -23,6 +23,56 @@ def print_error(msg):
 def print_info(msg):
     print(f"{Colors.BLUE}ℹ {msg}{Colors.RESET}")
 
+_bot = None
+
+def load_bot():
+    """以 benchmark.py 的本地 stub 取代 Google 翻譯、gTTS 與 LINE API 後匯入 main，返回 (main 模組, stub 狀態)；
+    整個測試程序只匯入一次，測試中修改的模組設定需自行還原"""
+    global _bot
+    if _bot is None:
+        import os
+        import benchmark
+        _, state, stub_url = benchmark.start_stub_server(0)
+        benchmark.point_clients_at_stub(stub_url)
+        os.environ.update({
+            'LINE_CHANNEL_ACCESS_TOKEN': benchmark.BENCH_TOKEN,
+            'LINE_CHANNEL_SECRET': benchmark.BENCH_SECRET,
+            'LINE_API_ENDPOINT': stub_url,
+            'BASE_URL': 'https://bot.example.com',
+            'AUDIO_FORMAT': 'mp3',
+            'AUDIO_STORE': 'memory',
+            'TRACE_SAMPLE_RATE': '0',
+        })
+        os.environ.pop('METRICS_DIR', None)
+        import main
+        _bot = (main, state)
+    return _bot
+
+def signed_events(events):
+    """把多個事件包成一次帶有正確 X-Line-Signature 的 webhook 投遞，返回 (內容, 簽名)"""
+    import base64
+    import hashlib
+    import hmac
+    import json
+    import benchmark
+    body = json.dumps({'destination': 'Ubenchmarkbot', 'events': events}, ensure_ascii=False).encode('utf-8')
+    signature = base64.b64encode(hmac.new(benchmark.BENCH_SECRET.encode('utf-8'), body, hashlib.sha256).digest())
+    return body, signature.decode('ascii')
+
+def text_event(text, reply_token, source):
+    """文字訊息事件（source 例如 {'type': 'group', 'groupId': 'C1', 'userId': 'U1'}）"""
+    import time
+    return {
+        'type': 'message',
+        'mode': 'active',
+        'timestamp': int(time.time() * 1000),
+        'source': source,
+        'webhookEventId': reply_token,
+        'deliveryContext': {'isRedelivery': False},
+        'replyToken': reply_token,
+        'message': {'id': reply_token, 'type': 'text', 'text': text},
+    }
+
 def test_get_tts_lang_logic():
     """測試 get_tts_lang 函數邏輯"""
     print_info("測試 get_tts_lang 邏輯...")
@@ -103,23 +153,44 @@ def test_url_handling():
     return all_pass
 
 def test_duration_calculation():
-    """測試音訊長度計算邏輯"""
+    """測試音訊長度計算：從 MP3 幀標頭計算，無法取得時依語言估計"""
     print_info("測試音訊長度計算邏輯...")
+    from audio_format import audio_duration_ms, estimate_duration_ms
+    
+    import struct
+    
+    def atom(kind, payload):
+        return struct.pack('>I', 8 + len(payload)) + kind + payload
+    
+    def full_header(timescale, duration):
+        # version 0：flags、建立 / 修改時間之後為 timescale 與 duration
+        return b'\x00' * 12 + struct.pack('>II', timescale, duration)
     
+    # MPEG-2 Layer III, 24kHz：每幀 576 個取樣 = 24ms
+    frame = bytes([0xFF, 0xF3, 0x44, 0xC0]) + b'\x00' * 92
+    mp4 = atom(b'ftyp', b'M4A ') + atom(b'moov', atom(b'mvhd', full_header(1000, 2500)))
+    # 分段 MP4：mvhd / mdhd 長度為 0，由 trex 預設時長 × trun 樣本數計算（10 × 1024 / 24000 秒）
+    fragmented = atom(b'moov', atom(b'mvhd', full_header(1000, 0))
+                      + atom(b'trak', atom(b'mdia', atom(b'mdhd', full_header(24000, 0))))
+                      + atom(b'mvex', atom(b'trex', struct.pack('>IIII', 0, 1, 1, 1024)))) \
+        + atom(b'moof', atom(b'traf', atom(b'tfhd', struct.pack('>II', 0, 1))
+                                     + atom(b'trun', struct.pack('>II', 0, 10))))
     test_cases = [
-        (10, 1250),   # 10 字元 * 125ms = 1250ms
-        (100, 12500), # 100 字元 * 125ms = 12500ms
-        (1, 1000),    # 最小 1000ms
-        (0, 1000),    # 最小 1000ms
+        (audio_duration_ms(frame * 50, 'mp3'), 1200, "50 幀 MP3"),
+        (audio_duration_ms(mp4, 'm4a'), 2500, "MP4 mvhd"),
+        (audio_duration_ms(fragmented, 'm4a'), 427, "分段 MP4"),
+        (audio_duration_ms(b'not audio', 'm4a'), None, "無法解析的 M4A"),
+        (estimate_duration_ms("Xin chào các bạn", 'vi'), 1120, "越南語估計 16 字元"),
+        (estimate_duration_ms("你好", 'zh-tw'), 1000, "中文估計（最小 1000ms）"),
+        (estimate_duration_ms("今天天氣很好", 'zh-tw'), 1380, "中文估計 6 字元"),
     ]
     
     all_pass = True
-    for text_length, expected_min in test_cases:
-        duration = max(1000, int(text_length * 125))
-        if duration >= expected_min:
-            print_success(f"{text_length} 字元 → {duration}ms (>= {expected_min}ms)")
+    for duration, expected, label in test_cases:
+        if duration == expected:
+            print_success(f"{label} → {duration}")
         else:
-            print_error(f"{text_length} 字元 → {duration}ms (期望 >= {expected_min}ms)")
+            print_error(f"{label} → {duration} (期望 {expected})")
             all_pass = False
     
     return all_pass
@@ -185,6 +256,1648 @@ def test_cache_entry_format():
         print_error("快取條目格式錯誤: 長度不足")
         return False
 
+def test_webhook_queue():
+    """測試 webhook 佇列的處理與滿載拒絕"""
+    print_info("測試 webhook 佇列...")
+    import threading
+    from webhook_queue import WebhookQueue
+    
+    gate = threading.Event()
+    done = []
+    q = WebhookQueue(lambda item: (gate.wait(2), done.append(item)), maxsize=1, workers=1, put_timeout=0)
+    
+    all_pass = True
+    results = [q.submit(i) for i in range(3)]
+    # 第一筆被工作執行緒取走，第二筆排隊，第三筆因佇列已滿被拒絕
+    if q.stats()['rejected'] >= 1 and results[0]:
+        print_success(f"佇列滿載時拒絕投遞: {results}")
+    else:
+        print_error(f"佇列未拒絕投遞: {results}, {q.stats()}")
+        all_pass = False
+    
+    gate.set()
+    q._queue.join()
+    stats = q.stats()
+    if stats['depth'] == 0 and stats['processed'] == stats['accepted']:
+        print_success(f"佇列已清空: {stats}")
+    else:
+        print_error(f"佇列處理不完整: {stats}")
+        all_pass = False
+    
+    return all_pass
+
+def test_translation_cache():
+    """測試翻譯快取的正規化、LRU 與 TTL"""
+    print_info("測試翻譯快取...")
+    import time
+    from translation_cache import TranslationCache
+    
+    all_pass = True
+    cache = TranslationCache(max_bytes=10 * 1024, ttl=60)
+    cache.put("Xin  chào ", 'vi', 'zh-tw', "你好")
+    if cache.get("Xin chào", 'vi', 'zh-tw') == "你好" and cache.get("Xin chào", 'vi', 'zh-cn') is None:
+        print_success("正規化鍵與語言對命中正確")
+    else:
+        print_error("正規化鍵或語言對錯誤")
+        all_pass = False
+    
+    small = TranslationCache(max_bytes=1500, ttl=60)
+    for i in range(10):
+        small.put(f"text {i}", 'vi', 'zh-tw', f"文字 {i}")
+    stats = small.stats()
+    if stats['bytes'] <= 1500 and stats['evictions'] > 0 and small.get("text 9", 'vi', 'zh-tw') == "文字 9":
+        print_success(f"記憶體預算內 LRU 淘汰: {stats['entries']} 條, {stats['bytes']} bytes")
+    else:
+        print_error(f"LRU 淘汰錯誤: {stats}")
+        all_pass = False
+    
+    expiring = TranslationCache(ttl=0.01)
+    expiring.put("好的", 'zh-tw', 'vi', "Được")
+    time.sleep(0.02)
+    if expiring.get("好的", 'zh-tw', 'vi') is None:
+        print_success("TTL 過期條目已失效")
+    else:
+        print_error("TTL 過期條目仍命中")
+        all_pass = False
+    
+    return all_pass
+
+def test_local_language_detection():
+    """測試本地語言檢測與遠端回退"""
+    print_info("測試本地語言檢測...")
+    from lang_detect import LanguageDetector
+    
+    remote_calls = []
+    detector = LanguageDetector(lambda text: remote_calls.append(text) or 'zh-CN', threshold=0.8)
+    test_cases = [
+        ('Xin chào', 'vi'),
+        ('Cảm ơn bạn nhiều', 'vi'),
+        ('你好，這是一條測試訊息。', 'zh-tw'),
+        ('你好，这是一条测试消息。', 'zh-cn'),
+        ('謝謝', 'zh-tw'),
+        ('hello', 'zh-cn'),  # 無越南語聲調，交給遠端檢測
+    ]
+    
+    all_pass = True
+    for text, expected in test_cases:
+        result = detector.detect(text)
+        if result == expected:
+            print_success(f"{text} → {result}")
+        else:
+            print_error(f"{text} → {result} (期望: {expected})")
+            all_pass = False
+    
+    stats = detector.stats()
+    if stats['fallback'] == 1 and remote_calls == ['hello']:
+        print_success(f"遠端回退統計: {stats}")
+    else:
+        print_error(f"遠端回退統計錯誤: {stats}")
+        all_pass = False
+    
+    return all_pass
+
+def test_audio_store():
+    """測試音訊儲存的位元組上限與 LRU 淘汰"""
+    print_info("測試音訊儲存...")
+    from audio_store import MemoryAudioStore
+    
+    store = MemoryAudioStore(max_bytes=300)
+    store.put('a', b'x' * 100, 'm4a')
+    store.put('b', b'x' * 100, 'm4a')
+    store.put('c', b'x' * 100, 'mp3')
+    store.get('a')  # a 變為最近使用
+    store.put('d', b'x' * 100, 'm4a')
+    
+    all_pass = True
+    stats = store.stats()
+    if 'b' not in store and 'a' in store and stats['bytes'] == 300 and stats['evictions'] == 1:
+        print_success(f"淘汰最久未使用的條目: {stats}")
+    else:
+        print_error(f"LRU 淘汰錯誤: {stats}")
+        all_pass = False
+    
+    if not store.put('big', b'x' * 301, 'm4a') and store.get('c').format == 'mp3':
+        print_success("超過上限的單筆音訊被拒絕")
+    else:
+        print_error("超過上限的單筆音訊未被拒絕")
+        all_pass = False
+    
+    return all_pass
+
+def test_audio_expiry():
+    """測試音訊依建立時間順序逐批過期"""
+    print_info("測試音訊過期清理...")
+    import time
+    from audio_store import MemoryAudioStore
+    
+    all_pass = True
+    store = MemoryAudioStore(max_bytes=1024 * 1024, ttl=0.05)
+    for i in range(300):
+        store.put(f'old-{i}', b'x', 'm4a')
+    time.sleep(0.06)
+    store.put('new', b'x', 'm4a')
+    removed = store.expire()
+    if removed == 300 and 'new' in store and len(store) == 1:
+        print_success(f"移除 {removed} 筆過期音訊，保留新音訊")
+    else:
+        print_error(f"過期清理錯誤: removed={removed}, entries={len(store)}")
+        all_pass = False
+    
+    # 大量 LRU 淘汰後，失效的過期紀錄會被壓縮
+    small = MemoryAudioStore(max_bytes=10, ttl=3600)
+    for i in range(3000):
+        small.put(f'clip-{i}', b'x', 'm4a')
+    small.expire()
+    if len(small._expiry) == len(small) == 10:
+        print_success(f"過期紀錄已壓縮: {len(small._expiry)} 筆")
+    else:
+        print_error(f"過期紀錄未壓縮: {len(small._expiry)} 筆")
+        all_pass = False
+    
+    return all_pass
+
+def test_disk_audio_store():
+    """測試共用目錄音訊儲存的跨 worker 讀取與容量淘汰"""
+    print_info("測試共用目錄音訊儲存...")
+    import errno
+    import os
+    import tempfile
+    import threading
+    from audio_store import create_audio_store, content_etag
+    
+    all_pass = True
+    with tempfile.TemporaryDirectory() as directory:
+        # 兩個實例共用同一目錄，模擬兩個 gunicorn worker
+        worker_a = create_audio_store('disk', directory=directory)
+        worker_b = create_audio_store('disk', directory=directory)
+        audio_id = 'ab' * 16
+        worker_a.put(audio_id, b'\x00' * 100, 'm4a')
+        entry = worker_b.get(audio_id)
+        if entry is not None and entry.format == 'm4a' and bytes(entry.data[:4]) == b'\x00' * 4 and os.path.exists(entry.path):
+            print_success(f"另一個 worker 可讀取音訊: {entry.size} bytes")
+        else:
+            print_error("另一個 worker 無法讀取音訊")
+            all_pass = False
+        
+        # ETag 與播放長度在寫入時算好並存檔，讀取時直接取用
+        worker_a.put('cd' * 16, b'\x01' * 50, 'mp3', duration=1234)
+        entry = worker_b.get('cd' * 16)
+        if (entry is not None and entry.duration == 1234 and entry.etag == content_etag(b'\x01' * 50)
+                and os.path.exists(entry.path + '.meta') and 'cd' * 16 in worker_b and 'ef' * 16 not in worker_b):
+            print_success(f"讀取寫入時存下的 ETag 與播放長度: {entry.etag[:8]}…, {entry.duration}ms")
+        else:
+            print_error(f"ETag / 播放長度錯誤: {entry}")
+            all_pass = False
+        
+        # 位元組數以占用的區塊計算：每筆 100 bytes 的語音與其 .meta、生成中標記都至少占一個區塊
+        block = worker_b.block_size
+        worker_b.max_bytes = 5 * block
+        worker_b.mark_pending('ee' * 16)
+        for i in range(3):
+            worker_b.put(f'{i:02d}' * 16, b'\x00' * 100, 'mp3')
+        worker_b.expire()
+        stats = worker_b.stats()
+        if stats['bytes'] <= 5 * block and stats['entries'] == 2 and stats['evictions'] >= 1:
+            print_success(f"旁檔計入占用，超過上限時淘汰最舊的檔案: {stats['entries']} 筆, {stats['bytes']} bytes")
+        else:
+            print_error(f"容量淘汰錯誤: {stats}")
+            all_pass = False
+        
+        # 寫入失敗（例如檔案系統已滿）時立即喚醒背景清理
+        cleaned = threading.Event()
+        full = create_audio_store('disk', directory=directory, expiry_interval=3600)
+        full.expire = cleaned.set
+        
+        def no_space(path, data):
+            raise OSError(errno.ENOSPC, "No space left on device")
+        
+        full._write_atomic = no_space
+        if not full.put('ff' * 16, b'\x00' * 100, 'mp3') and cleaned.wait(2):
+            print_success("寫入失敗時返回 False 並立即喚醒清理")
+        else:
+            print_error("寫入失敗後沒有喚醒清理")
+            all_pass = False
+        
+        # 上限不超過檔案系統容量的 80%（/dev/shm 常只有 64 MB）
+        fs = os.statvfs(directory)
+        capped = create_audio_store('disk', directory=directory, max_bytes=fs.f_blocks * fs.f_frsize * 2)
+        if capped.max_bytes <= fs.f_blocks * fs.f_frsize * 0.8:
+            print_success(f"上限依檔案系統容量調降: {capped.max_bytes} bytes")
+        else:
+            print_error(f"上限未依容量調降: {capped.max_bytes}")
+            all_pass = False
+        
+        if worker_a.get('../etc/passwd') is None:
+            print_success("拒絕不合法的音訊 ID")
+        else:
+            print_error("接受了不合法的音訊 ID")
+            all_pass = False
+    
+    return all_pass
+
+def test_pending_audio():
+    """測試生成中音訊的 Future 共用與等待"""
+    print_info("測試生成中音訊等待...")
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+    from audio_store import MemoryAudioStore, PendingAudio
+    
+    store = MemoryAudioStore()
+    gate = threading.Event()
+    calls = []
+    
+    def produce(audio_id):
+        gate.wait(2)
+        calls.append(audio_id)
+        store.put(audio_id, b'audio', 'm4a')
+    
+    pending = PendingAudio(ThreadPoolExecutor(max_workers=2))
+    first = pending.submit('a' * 32, produce, 'a' * 32)
+    second = pending.submit('a' * 32, produce, 'a' * 32)
+    
+    all_pass = True
+    if first is second and 'a' * 32 not in store:
+        print_success("相同 ID 共用同一個生成工作")
+    else:
+        print_error("相同 ID 產生了多個生成工作")
+        all_pass = False
+    
+    gate.set()
+    waited = pending.wait('a' * 32, timeout=2)
+    if waited and store.get('a' * 32) is not None and calls == ['a' * 32]:
+        print_success("等待完成後可取得音訊")
+    else:
+        print_error(f"等待後無法取得音訊: waited={waited}, calls={calls}")
+        all_pass = False
+    
+    if not pending.wait('b' * 32, timeout=0.1):
+        print_success("沒有生成工作的 ID 立即返回")
+    else:
+        print_error("沒有生成工作的 ID 未立即返回")
+        all_pass = False
+    
+    return all_pass
+
+def test_translation_memory():
+    """測試持久化翻譯記憶的讀寫、重新開啟、熱門載入與清理"""
+    print_info("測試持久化翻譯記憶...")
+    import os
+    import tempfile
+    from translation_cache import TranslationCache
+    from translation_memory import TranslationMemory
+    
+    all_pass = True
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'memory.db')
+        memory = TranslationMemory(path, max_entries=100)
+        memory.put("Xin  chào", 'vi', 'zh-tw', "你好")
+        memory.put("Cảm ơn", 'vi', 'zh-tw', "謝謝")
+        for _ in range(3):
+            memory.get("Cảm ơn", 'vi', 'zh-tw')
+        memory.flush()
+        
+        reopened = TranslationMemory(path, max_entries=100)
+        if reopened.get("Xin chào", 'vi', 'zh-tw') == "你好" and reopened.get("Xin chào", 'vi', 'zh-cn') is None:
+            print_success("重新開啟後仍可讀取翻譯")
+        else:
+            print_error("重新開啟後讀取翻譯錯誤")
+            all_pass = False
+        
+        cache = TranslationCache()
+        loaded = reopened.warm(cache, 1)
+        if loaded == 1 and cache.get("Cảm ơn", 'vi', 'zh-tw') == "謝謝" and cache.get("Xin chào", 'vi', 'zh-tw') is None:
+            print_success("只載入最常使用的條目")
+        else:
+            print_error(f"熱門條目載入錯誤: {loaded}")
+            all_pass = False
+        
+        for i in range(150):
+            reopened.put(f"text {i}", 'vi', 'zh-tw', f"文字 {i}")
+        stats = reopened.stats()
+        if stats['entries'] <= 100 and stats['pruned'] > 0 and reopened.get("text 149", 'vi', 'zh-tw') == "文字 149":
+            print_success(f"超過上限時刪除最久未使用的條目: {stats['entries']} 筆")
+        else:
+            print_error(f"條目上限清理錯誤: {stats}")
+            all_pass = False
+    
+    return all_pass
+
+def test_cache_warmer():
+    """測試快取預熱的去重、併發上限與失敗統計"""
+    print_info("測試快取預熱...")
+    import os
+    import tempfile
+    import threading
+    import time
+    from prewarm import CacheWarmer, command_from_env, load_phrases, prewarm_configured, read_status, results_shared
+    
+    all_pass = True
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'phrases.txt')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write("# 註解\nXin chào\n\n你好\nXin  chào\n壞掉\n")
+        phrases = load_phrases(path)
+    
+    lock = threading.Lock()
+    active = [0, 0]
+    warmed = []
+    
+    def warm_one(text):
+        with lock:
+            active[0] += 1
+            active[1] = max(active[1], active[0])
+        time.sleep(0.02)
+        with lock:
+            active[0] -= 1
+            warmed.append(text)
+        if text == '壞掉':
+            raise ValueError("翻譯失敗")
+        return True
+    
+    warmer = CacheWarmer(warm_one, concurrency=2)
+    if warmer.start(phrases) and not warmer.start(phrases):
+        print_success("預熱在背景執行，重複啟動被忽略")
+    else:
+        print_error("背景預熱啟動狀態錯誤")
+        all_pass = False
+    warmer.join(5)
+    stats = warmer.stats()
+    if phrases == ["Xin chào", "你好", "Xin  chào", "壞掉"] and sorted(warmed) == sorted(["Xin chào", "你好", "壞掉"]):
+        print_success("忽略註解與空行，並去除重複句子")
+    else:
+        print_error(f"常用語讀取或去重錯誤: {phrases}, {warmed}")
+        all_pass = False
+    if active[1] <= 2 and stats['done'] == 2 and stats['failed'] == 1 and not stats['running']:
+        print_success(f"併發上限內完成預熱: {stats}")
+    else:
+        print_error(f"預熱統計錯誤: 最大併發 {active[1]}, {stats}")
+        all_pass = False
+    
+    # gunicorn 另開預熱行程時把進度寫入檔案，worker 的健康檢查讀取該檔案
+    with tempfile.TemporaryDirectory() as directory:
+        status_path = os.path.join(directory, 'prewarm.json')
+        CacheWarmer(lambda text: True, status_path=status_path).run(["Xin chào", "你好"])
+        status = read_status(status_path)
+    if status and status['done'] == 2 and not status['running'] and read_status(status_path) is None:
+        print_success("預熱進度寫入狀態檔，檔案不存在時返回 None")
+    else:
+        print_error(f"預熱狀態檔錯誤: {status}")
+        all_pass = False
+    
+    # 預熱結果只有寫入翻譯記憶與共用音訊儲存時，另開行程才有意義，否則由 worker 各自預熱
+    keys = ('PREWARM_PHRASES_FILE', 'PREWARM_FROM_HISTORY', 'TRANSLATION_MEMORY_PATH', 'AUDIO_STORE', 'PREWARM_STATUS_FILE')
+    saved = {key: os.environ.get(key) for key in keys}
+    try:
+        for key in keys:
+            os.environ.pop(key, None)
+        os.environ.update(PREWARM_PHRASES_FILE='prewarm_phrases.txt', PREWARM_STATUS_FILE='/tmp/prewarm.json')
+        unshared = (prewarm_configured(), results_shared(), command_from_env())
+        os.environ.update(TRANSLATION_MEMORY_PATH='/tmp/memory.db', AUDIO_STORE='memory')
+        memory_store = command_from_env()
+        os.environ['AUDIO_STORE'] = 'shm'
+        command = command_from_env()
+    finally:
+        for key, value in saved.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+    if (unshared == (True, False, None) and memory_store is None and command
+            and command[-2:] == ['--status-file', '/tmp/prewarm.json']):
+        print_success("預熱結果無法共用時不另開預熱行程，可共用時把進度寫入狀態檔")
+    else:
+        print_error(f"預熱指令錯誤: {unshared}, {memory_store}, {command}")
+        all_pass = False
+    
+    return all_pass
+
+def test_single_flight():
+    """測試相同請求合併：同時的相同鍵只執行一次並共用結果與例外"""
+    print_info("測試相同請求合併...")
+    import threading
+    import time
+    from singleflight import SingleFlight
+    
+    flight = SingleFlight()
+    calls = []
+    
+    def slow_translate(text):
+        calls.append(text)
+        time.sleep(0.05)
+        return f"譯:{text}"
+    
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(flight.do('k', slow_translate, 'Xin chào')))
+               for _ in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    
+    all_pass = True
+    stats = flight.stats()
+    if calls == ['Xin chào'] and results == ['譯:Xin chào'] * 5 and stats['coalesced'] == 4 and stats['in_flight'] == 0:
+        print_success(f"5 個同時請求只執行 1 次: {stats}")
+    else:
+        print_error(f"請求合併錯誤: calls={calls}, {stats}")
+        all_pass = False
+    
+    flight.do('k', slow_translate, 'Cảm ơn')
+    if len(calls) == 2:
+        print_success("完成後的相同鍵會重新執行")
+    else:
+        print_error("完成後的相同鍵沒有重新執行")
+        all_pass = False
+    
+    def failing():
+        time.sleep(0.05)
+        raise ValueError("上游錯誤")
+    
+    errors = []
+    
+    def call_failing():
+        try:
+            flight.do('bad', failing)
+        except ValueError as e:
+            errors.append(str(e))
+    
+    threads = [threading.Thread(target=call_failing) for _ in range(3)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if errors == ["上游錯誤"] * 3:
+        print_success("例外傳給所有等待中的請求")
+    else:
+        print_error(f"例外傳遞錯誤: {errors}")
+        all_pass = False
+    
+    return all_pass
+
+def test_line_reply_client():
+    """以本地模擬 LINE API 測試回覆用戶端的連線重用、重試與延遲統計"""
+    print_info("測試 LINE 回覆用戶端...")
+    import json
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from linebot import LineBotApi
+    from linebot.exceptions import LineBotApiError
+    from linebot.models import TextSendMessage
+    from line_client import PooledHttpClient
+    
+    statuses = [503, 429, 200, 200, 400]
+    received = []
+    retry_keys = []
+    ports = set()
+    
+    class MockLineApi(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        
+        def log_message(self, format, *args):
+            pass
+        
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            ports.add(self.client_address[1])
+            status = statuses.pop(0)
+            retry_keys.append(self.headers.get('X-Line-Retry-Key'))
+            if status == 200 and self.path.endswith('/reply'):
+                received.append(json.loads(body)['replyToken'])
+            payload = b'{}' if status == 200 else b'{"message": "error"}'
+            self.send_response(status)
+            if status == 429:
+                self.send_header('Retry-After', '0')
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+    
+    server = ThreadingHTTPServer(('127.0.0.1', 0), MockLineApi)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    api = LineBotApi('test-token', endpoint=f'http://127.0.0.1:{server.server_address[1]}', timeout=(1, 2),
+                     http_client=lambda timeout: PooledHttpClient(pool_size=2, timeout=timeout, retries=2, backoff=0.01))
+    client = api.http_client
+    
+    all_pass = True
+    try:
+        api.reply_message('token-1', TextSendMessage(text="你好"))
+        api.reply_message('token-2', TextSendMessage(text="謝謝"))
+        stats = client.stats()
+        if received == ['token-1', 'token-2'] and stats['retried'] == 2 and len(ports) == 1:
+            print_success("503 / 429 後重試成功，4 次請求共用 1 條連線")
+        else:
+            print_error(f"重試或連線重用錯誤: {received}, {stats}, 連線數 {len(ports)}")
+            all_pass = False
+        
+        try:
+            api.reply_message('token-3', TextSendMessage(text="錯誤"))
+            print_error("400 應拋出 LineBotApiError")
+            all_pass = False
+        except LineBotApiError as e:
+            stats = client.stats()
+            if e.status_code == 400 and stats['retried'] == 2 and stats['failures'] == 1:
+                print_success("400 不重試並拋出 LineBotApiError")
+            else:
+                print_error(f"400 處理錯誤: {stats}")
+                all_pass = False
+        
+        latency = client.stats()['latency'].get('POST /v2/bot/message/reply', {})
+        if latency.get('count') == 5 and latency['buckets']['+Inf'] == 5:
+            print_success(f"延遲直方圖記錄每次呼叫: p50 {latency['p50_ms']}ms")
+        else:
+            print_error(f"延遲直方圖錯誤: {latency}")
+            all_pass = False
+        
+        # push 重試時帶同一個 X-Line-Retry-Key；重試後的 409 表示先前的請求已送達
+        retry_keys.clear()
+        statuses.extend([503, 200, 500, 409])
+        api.push_message('user-1', TextSendMessage(text="語音"))
+        try:
+            api.push_message('user-1', TextSendMessage(text="語音"))
+        except LineBotApiError as e:
+            if e.status_code != 409:
+                raise
+        if (len(retry_keys) == 4 and retry_keys[0] and retry_keys[0] == retry_keys[1]
+                and retry_keys[2] == retry_keys[3] and retry_keys[1] != retry_keys[2]
+                and client.stats()['failures'] == 1):
+            print_success("push 重試沿用同一個重試鍵，每則訊息各自一個")
+        else:
+            print_error(f"重試鍵錯誤: {retry_keys}, {client.stats()}")
+            all_pass = False
+    finally:
+        server.shutdown()
+    
+    return all_pass
+
+def test_translation_backend():
+    """測試翻譯後端：用戶端池的借出上限與等待時間、stub 後端、註冊與執行緒數推算"""
+    print_info("測試翻譯後端...")
+    import sys
+    import threading
+    import time
+    import translation_backend
+    from translation_backend import GoogletransBackend, TranslationBackend, create_backend, register_backend
+    
+    lock = threading.Lock()
+    active = [0, 0]
+    
+    class FakeTranslator:
+        def translate(self, text, src, dest):
+            with lock:
+                active[0] += 1
+                active[1] = max(active[1], active[0])
+            time.sleep(0.03)
+            with lock:
+                active[0] -= 1
+            return type('Translated', (), {'text': f"{dest}:{text}"})()
+    
+    backend = GoogletransBackend(pool_size=2, translator_factory=FakeTranslator)
+    results = []
+    threads = [threading.Thread(target=lambda i=i: results.append(backend.translate(f"t{i}", 'vi', 'zh-tw')))
+               for i in range(6)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    stats = backend.stats()
+    
+    all_pass = True
+    if len(results) == 6 and active[1] <= 2 and stats['calls'] == 6 and stats['wait_time']['count'] == 6 \
+            and stats['wait_time']['sum'] > 0.02:
+        print_success(f"池大小 2 時最多 2 個並行呼叫，等待時間已記錄: {stats['wait_time']['sum']:.3f}s")
+    else:
+        print_error(f"用戶端池錯誤: 最大並行 {active[1]}, {stats}")
+        all_pass = False
+    
+    stub = create_backend('stub')
+    if stub.translate("Xin chào", 'vi', 'zh-tw') == "[zh-tw] Xin chào" and stub.detect("你好嗎") == 'zh-tw':
+        print_success("stub 後端不連網路即可翻譯與檢測")
+    else:
+        print_error("stub 後端結果錯誤")
+        all_pass = False
+    
+    class EchoBackend(TranslationBackend):
+        name = 'echo'
+        
+        def translate(self, text, src, dest):
+            return text
+    
+    register_backend('echo', EchoBackend)
+    try:
+        create_backend('missing')
+        unknown_rejected = False
+    except ValueError:
+        unknown_rejected = True
+    if create_backend('echo').translate("abc", 'vi', 'zh-tw') == "abc" and unknown_rejected:
+        print_success("可註冊新後端，未知名稱拋出 ValueError")
+    else:
+        print_error("後端註冊錯誤")
+        all_pass = False
+    translation_backend.BACKENDS.pop('echo', None)
+    
+    original_argv = sys.argv
+    sys.argv = ['gunicorn', 'main:app', '--workers', '2', '--threads', '3']
+    try:
+        threads_from_argv = translation_backend.gunicorn_threads()
+    finally:
+        sys.argv = original_argv
+    if threads_from_argv == 3:
+        print_success("從 gunicorn 命令列讀取 --threads")
+    else:
+        print_error(f"--threads 讀取錯誤: {threads_from_argv}")
+        all_pass = False
+    
+    return all_pass
+
+def test_sentence_batching():
+    """測試分句、組回譯文與批次翻譯的拆分"""
+    print_info("測試分句與批次翻譯...")
+    from sentences import split_sentences, join_sentences, batch_chunks
+    from translation_backend import TranslationBackend
+    
+    all_pass = True
+    text = "Thông báo. Giá: 1.500 đồng!\nCảm ơn"
+    parts = split_sentences(text)
+    if [p[0] for p in parts] == ["Thông báo.", "Giá: 1.500 đồng!", "Cảm ơn"] and \
+            ''.join(s + sep for s, sep in parts) == text:
+        print_success("依句末標點與換行分句，數字中的小數點不斷句，可原樣組回")
+    else:
+        print_error(f"分句錯誤: {parts}")
+        all_pass = False
+    
+    zh_parts = split_sentences("你好。謝謝！")
+    joined = join_sentences([("Xin chào.", zh_parts[0][1]), ("Cảm ơn!", zh_parts[1][1])], 'vi')
+    if len(zh_parts) == 2 and joined == "Xin chào. Cảm ơn!":
+        print_success("中文句子譯成越南語時補上句間空格")
+    else:
+        print_error(f"組回譯文錯誤: {zh_parts}, {joined}")
+        all_pass = False
+    
+    if batch_chunks(["a" * 3, "b" * 3, "c" * 3], max_chars=7) == [["aaa", "bbb"], ["ccc"]]:
+        print_success("批次大小不超過字數上限")
+    else:
+        print_error("批次切分錯誤")
+        all_pass = False
+    
+    class LineBackend(TranslationBackend):
+        def __init__(self, drop_lines=False):
+            self.requests = []
+            self.drop_lines = drop_lines
+        
+        def translate(self, text, src, dest):
+            self.requests.append(text)
+            if self.drop_lines:
+                return text.replace('\n', ' ').upper()
+            return text.upper()
+    
+    batched = LineBackend()
+    fallback = LineBackend(drop_lines=True)
+    if batched.translate_batch(["một", "hai"], 'vi', 'zh-tw') == ["MỘT", "HAI"] and len(batched.requests) == 1 \
+            and fallback.translate_batch(["một", "hai"], 'vi', 'zh-tw') == ["MỘT", "HAI"] \
+            and len(fallback.requests) == 3:
+        print_success("多句以一次請求翻譯，行數不符時改為逐句翻譯")
+    else:
+        print_error(f"批次翻譯錯誤: {batched.requests}, {fallback.requests}")
+        all_pass = False
+    
+    return all_pass
+
+def test_mp3_concat():
+    """測試 MP3 幀解析與容器層級串接（去除 ID3 標籤與 Xing 標頭幀）"""
+    print_info("測試 MP3 串接...")
+    from audio_format import concat_mp3, iter_mp3_frames
+    
+    # MPEG-2 Layer III, 24kHz 單聲道 32kbps：每幀 96 bytes
+    frame = bytes([0xFF, 0xF3, 0x44, 0xC0]) + b'\x00' * 92
+    xing = bytes([0xFF, 0xF3, 0x44, 0xC0]) + b'\x00' * 9 + b'Xing' + b'\x00' * 79
+    id3 = b'ID3\x04\x00\x00\x00\x00\x00\x0a' + b'\x01' * 10
+    first = id3 + xing + frame * 3
+    second = frame * 2 + b'TAG' + b'\x00' * 125
+    
+    all_pass = True
+    frames = list(iter_mp3_frames(first))
+    if len(frames) == 3 and frames[0][0] == len(id3) + len(xing):
+        print_success("跳過 ID3 標籤與 Xing 標頭幀，找到 3 個音訊幀")
+    else:
+        print_error(f"幀解析錯誤: {frames}")
+        all_pass = False
+    
+    joined = b''.join(concat_mp3([first, second]))
+    if joined == frame * 5:
+        print_success("串接結果只包含 5 個音訊幀")
+    else:
+        print_error(f"串接錯誤: {len(joined)} bytes")
+        all_pass = False
+    
+    if b''.join(concat_mp3([b'not mp3'])) == b'not mp3':
+        print_success("無法解析的片段原樣保留")
+    else:
+        print_error("無法解析的片段被丟棄")
+        all_pass = False
+    
+    return all_pass
+
+def test_prometheus_metrics():
+    """測試指標登錄表的階段計時、跨 worker 快照合併與 Prometheus 文字格式"""
+    print_info("測試 Prometheus 指標...")
+    import json
+    import os
+    import tempfile
+    from metrics import MetricsRegistry, MultiprocessMetrics, archive_snapshot, clear_snapshots
+    
+    registry = MetricsRegistry(prefix='test_')
+    stages = registry.histogram('stage_seconds', '階段耗時', label='stage', buckets=(0.1, 1.0))
+    errors = registry.counter('stage_errors_total', '階段錯誤次數', label='stage')
+    depth = [3]
+    registry.gauge_func('queue_depth', '佇列深度', lambda: depth[0])
+    registry.gauge_func('store_bytes', '共用儲存位元組數', lambda: 100, aggregate='max')
+    
+    all_pass = True
+    with registry.timer(stages, 'translate', errors):
+        pass
+    try:
+        with registry.timer(stages, 'reply', errors):
+            raise ValueError("回覆失敗")
+    except ValueError:
+        pass
+    
+    with tempfile.TemporaryDirectory() as directory:
+        exporter = MultiprocessMetrics(registry, directory=directory, interval=60)
+        # 模擬另一個已結束的 worker 留下的快照：計數器與直方圖要計入，量測值不計入
+        other = registry.snapshot()
+        with open(f"{directory}/999999999.json", 'w') as f:
+            json.dump(other, f)
+        text = exporter.render()
+        # gunicorn child_exit 把結束 worker 的計數併入封存快照，合併後的計數不下降
+        archive_snapshot(directory, 999999999)
+        with open(f"{directory}/999999998.json", 'w') as f:
+            json.dump(other, f)
+        archive_snapshot(directory, 999999998)
+        after_exit = exporter.render().splitlines()
+        if (sorted(os.listdir(directory)) == ['archive.json']
+                and 'test_stage_errors_total{stage="reply"} 3' in after_exit
+                and 'test_stage_seconds_count{stage="translate"} 3' in after_exit
+                and 'test_queue_depth 3' in after_exit):
+            print_success("結束的 worker 計數併入封存快照，合併後的計數不下降")
+        else:
+            print_error(f"封存快照錯誤: {os.listdir(directory)}")
+            all_pass = False
+        # master 啟動時清空整個目錄，不沿用上一次執行的計數
+        exporter.write()
+        cleared = clear_snapshots(directory)
+        if cleared == 2 and not os.listdir(directory):
+            print_success("上一次執行的快照與封存會被刪除，不再計入")
+        else:
+            print_error(f"快照清理錯誤: cleared={cleared}, {os.listdir(directory)}")
+            all_pass = False
+    
+    lines = set(text.splitlines())
+    expected = [
+        '# TYPE test_stage_seconds histogram',
+        'test_stage_seconds_bucket{stage="translate",le="0.1"} 2',
+        'test_stage_seconds_bucket{stage="reply",le="+Inf"} 2',
+        'test_stage_seconds_count{stage="translate"} 2',
+        'test_stage_errors_total{stage="reply"} 2',
+        'test_queue_depth 3',
+        'test_store_bytes 100',
+    ]
+    missing = [line for line in expected if line not in lines]
+    if not missing:
+        print_success("兩個 worker 的直方圖與計數器相加，已結束 worker 的量測值不計入")
+    else:
+        print_error(f"指標輸出錯誤，缺少: {missing}\n{text}")
+        all_pass = False
+    
+    if 'test_stage_errors_total{stage="translate"}' not in text:
+        print_success("只有拋出例外的階段計入錯誤次數")
+    else:
+        print_error("未出錯的階段被計入錯誤次數")
+        all_pass = False
+    
+    return all_pass
+
+def test_benchmark_harness():
+    """測試基準測試工具的簽名 webhook 內容、伺服器設定解析與記憶體取樣"""
+    print_info("測試基準測試工具...")
+    import os
+    from linebot import WebhookParser
+    from benchmark import BENCH_SECRET, signed_payload, parse_config, process_tree_rss
+    
+    all_pass = True
+    body, signature = signed_payload('Xin chào', 'token-1')
+    events = WebhookParser(BENCH_SECRET).parse(body.decode('utf-8'), signature)
+    if len(events) == 1 and events[0].reply_token == 'token-1' and events[0].message.text == 'Xin chào':
+        print_success("產生的 webhook 可通過 X-Line-Signature 驗證")
+    else:
+        print_error(f"webhook 內容錯誤: {events}")
+        all_pass = False
+    
+    config = parse_config('queue=flask,WEBHOOK_MODE=queue,WEBHOOK_WORKERS=8')
+    if config == {'name': 'queue', 'app': 'flask', 'env': {'WEBHOOK_MODE': 'queue', 'WEBHOOK_WORKERS': '8'}} \
+            and parse_config('asgi')['app'] == 'asgi':
+        print_success("伺服器設定解析正確")
+    else:
+        print_error(f"伺服器設定解析錯誤: {config}")
+        all_pass = False
+    
+    rss = process_tree_rss(os.getpid())
+    if rss is None or rss > 0:
+        print_success(f"程序記憶體: {rss}")
+    else:
+        print_error(f"無法讀取程序記憶體: {rss}")
+        all_pass = False
+    
+    return all_pass
+
+def test_event_tracing():
+    """測試事件追蹤的 span 記錄、跨執行緒傳遞與抽樣規則"""
+    print_info("測試事件追蹤...")
+    import contextvars
+    import threading
+    import time
+    from tracing import Tracer
+    
+    records = []
+    tracer = Tracer(sample_rate=1.0, emit=records.append)
+    all_pass = True
+    
+    def synthesize():
+        with tracer.span('tts'):
+            time.sleep(0.001)
+    
+    with tracer.trace('event-1', event='message'):
+        with tracer.span('detect'):
+            pass
+        context = contextvars.copy_context()
+        # 交給其他執行緒時需帶上 context，span 才會記錄到同一個追蹤
+        worker = threading.Thread(target=context.run, args=(synthesize,))
+        worker.start()
+        worker.join()
+        tracer.annotate(src_lang='vi')
+    with tracer.span('reply'):
+        pass  # 追蹤之外的 span 不記錄
+    
+    record = records[0] if records else {}
+    names = [span['name'] for span in record.get('spans', [])]
+    if record.get('trace_id') == 'event-1' and names == ['detect', 'tts'] and record.get('src_lang') == 'vi' \
+            and record.get('status') == 'ok':
+        print_success(f"一個事件輸出一筆記錄，span: {names}")
+    else:
+        print_error(f"追蹤記錄錯誤: {record}")
+        all_pass = False
+    
+    records.clear()
+    sampled = Tracer(sample_rate=0.0, slow_ms=20, emit=records.append)
+    with sampled.trace('fast'):
+        pass
+    with sampled.trace('slow'):
+        time.sleep(0.03)
+    try:
+        with sampled.trace('failed'):
+            raise ValueError("翻譯失敗")
+    except ValueError:
+        pass
+    ids = [r['trace_id'] for r in records]
+    if ids == ['slow', 'failed'] and records[1]['status'] == 'error' and sampled.stats()['traces'] == 3:
+        print_success("抽樣比例 0 時只輸出慢事件與出錯的事件")
+    else:
+        print_error(f"抽樣錯誤: {ids}")
+        all_pass = False
+    
+    return all_pass
+
+def test_fair_queue():
+    """測試加權公平佇列的取出順序與每個來源的權杖桶限流"""
+    print_info("測試公平排程與限流...")
+    from fair_queue import FairQueue, SourceLimiter, TokenBucket
+    
+    all_pass = True
+    q = FairQueue(maxsize=100, weight=lambda key: 2.0 if key == 'user' else 1.0)
+    for i in range(10):
+        q.put(f'flood-{i}', key='group')
+    q.put('quiet-0', key='quiet')
+    q.put('quiet-1', key='quiet')
+    order = [q.get() for _ in range(4)]
+    if order[:2] == ['flood-0', 'quiet-0'] and 'quiet-1' in order:
+        print_success(f"洗版的來源不會擋住其他來源: {order}")
+    else:
+        print_error(f"取出順序錯誤: {order}")
+        all_pass = False
+    
+    weighted = FairQueue(weight=lambda key: 2.0 if key == 'user' else 1.0)
+    for i in range(6):
+        weighted.put(('group', i), key='group')
+        weighted.put(('user', i), key='user')
+    first = [weighted.get()[0] for _ in range(6)]
+    if first.count('user') == 4:
+        print_success(f"權重 2 的來源分得兩倍順位: {first}")
+    else:
+        print_error(f"加權順序錯誤: {first}")
+        all_pass = False
+    
+    bucket = TokenBucket(rate=1.0, burst=2, now=0.0)
+    taken = [bucket.consume(now=0.0), bucket.consume(now=0.0), bucket.consume(now=0.0), bucket.consume(now=1.0)]
+    limiter = SourceLimiter(rate=0.001, burst=2)
+    allowed = [limiter.allow('group:C1') for _ in range(3)] + [limiter.allow('user:U1')]
+    if taken == [True, True, False, True] and allowed == [True, True, False, True] \
+            and limiter.stats()['limited'] == 1:
+        print_success("超出額度的來源被限流，其他來源不受影響")
+    else:
+        print_error(f"限流錯誤: {taken}, {allowed}")
+        all_pass = False
+    
+    return all_pass
+
+def test_mp4_duration():
+    """測試 MP4 / M4A 播放長度解析：mvhd 版本 0 / 1、分段 MP4 的 tfhd 預設時長與逐樣本時長"""
+    print_info("測試 MP4 播放長度解析...")
+    import os
+    import shutil
+    import struct
+    from audio_format import mp4_duration_ms, audio_duration_ms
+    from transcoder import Transcoder
+    
+    def atom(kind, payload):
+        return struct.pack('>I', 8 + len(payload)) + kind + payload
+    
+    def header_v1(timescale, duration):
+        # version 1：建立 / 修改時間為 64 位元，duration 也是 64 位元
+        return b'\x01\x00\x00\x00' + b'\x00' * 16 + struct.pack('>IQ', timescale, duration)
+    
+    def header_v0(timescale, duration):
+        return b'\x00' * 12 + struct.pack('>II', timescale, duration)
+    
+    moov = atom(b'moov', atom(b'mvhd', header_v0(1000, 0))
+                + atom(b'trak', atom(b'mdia', atom(b'mdhd', header_v0(24000, 0)))))
+    # tfhd flags 0x08：預設樣本時長 2048；trun flags 0x100：每個樣本各自的時長
+    moof_default = atom(b'moof', atom(b'traf', atom(b'tfhd', struct.pack('>III', 0x08, 1, 2048))
+                                      + atom(b'trun', struct.pack('>II', 0, 6))))
+    moof_samples = atom(b'moof', atom(b'traf', atom(b'tfhd', struct.pack('>II', 0, 1))
+                                      + atom(b'trun', struct.pack('>II', 0x100, 3) + struct.pack('>III', 1024, 1024, 512))))
+    test_cases = [
+        (mp4_duration_ms(atom(b'moov', atom(b'mvhd', header_v1(44100, 44100 * 90)))), 90000, "mvhd 版本 1（64 位元長度）"),
+        (mp4_duration_ms(atom(b'moov', atom(b'trak', atom(b'mdia', atom(b'mdhd', header_v0(24000, 24000)))))), None, "沒有 mvhd"),
+        (mp4_duration_ms(moov + moof_default), 512, "分段 MP4：tfhd 預設時長（6 × 2048 / 24000 秒）"),
+        (mp4_duration_ms(moov + moof_default + moof_samples), 619, "分段 MP4：加上逐樣本時長（2560 / 24000 秒）"),
+        (audio_duration_ms(moov + moof_samples[:-6], 'm4a'), None, "截斷的 trun"),
+    ]
+    
+    all_pass = True
+    for duration, expected, label in test_cases:
+        if duration == expected:
+            print_success(f"{label} → {duration}")
+        else:
+            print_error(f"{label} → {duration} (期望 {expected})")
+            all_pass = False
+    
+    # 實際由 ffmpeg 轉出的分段 M4A（沒有 ffmpeg 時略過）
+    ffmpeg = os.getenv('FFMPEG_BINARY') or shutil.which('ffmpeg')
+    if not ffmpeg or not shutil.which(ffmpeg):
+        print_info("找不到 ffmpeg，略過實際 M4A 檔案測試")
+        return all_pass
+    # MPEG-2 Layer III, 24kHz 靜音幀：100 幀 × 24ms = 2400ms
+    frame = bytes([0xFF, 0xF3, 0x44, 0xC0]) + b'\x00' * 92
+    m4a, _ = Transcoder(ffmpeg=ffmpeg).mp3_to_m4a([frame * 100])
+    duration = audio_duration_ms(m4a, 'm4a')
+    if duration is not None and abs(duration - 2400) <= 100:
+        print_success(f"ffmpeg 分段 M4A → {duration}ms")
+    else:
+        print_error(f"ffmpeg 分段 M4A 長度錯誤: {duration} (期望約 2400)")
+        all_pass = False
+    
+    return all_pass
+
+def test_transcoder():
+    """測試 ffmpeg 管線轉檔：指令內容、找不到 ffmpeg、非零返回碼、逾時，以及實際轉檔（沒有 ffmpeg 時略過）"""
+    print_info("測試 ffmpeg 管線轉檔...")
+    import asyncio
+    import os
+    import shutil
+    import stat
+    import tempfile
+    from transcoder import Transcoder, TranscodeError
+    from audio_format import audio_duration_ms
+    
+    all_pass = True
+    with tempfile.TemporaryDirectory() as directory:
+        def fake_ffmpeg(name, script):
+            path = os.path.join(directory, name)
+            with open(path, 'w') as f:
+                f.write('#!/bin/sh\n' + script + '\n')
+            os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+            return path
+        
+        failing = Transcoder(ffmpeg=fake_ffmpeg('ffmpeg-fail', 'cat > /dev/null; echo "Invalid data found" >&2; exit 1'),
+                             bitrate='48k')
+        command = failing.command()
+        if (command[0] == failing.ffmpeg and command[command.index('-b:a') + 1] == '48k'
+                and command[command.index('-i') + 1] == 'pipe:0' and command[-1] == 'pipe:1'
+                and 'empty_moov' in command[command.index('-movflags') + 1]):
+            print_success("指令由管線讀入 MP3、以分段 MP4 輸出到管線")
+        else:
+            print_error(f"ffmpeg 指令錯誤: {command}")
+            all_pass = False
+        
+        missing = Transcoder(ffmpeg=os.path.join(directory, 'no-such-ffmpeg'))
+        errors = []
+        for transcoder, label in ((missing, "找不到 ffmpeg"), (failing, "非零返回碼")):
+            try:
+                transcoder.mp3_to_m4a([b'\xff\xf3' * 100, b'\x00' * 100])
+                errors.append(f"{label}（同步）未拋出錯誤")
+            except TranscodeError as e:
+                print_success(f"{label}: {e}")
+            try:
+                asyncio.run(transcoder.mp3_to_m4a_async(b'\xff\xf3' * 100))
+                errors.append(f"{label}（非同步）未拋出錯誤")
+            except TranscodeError:
+                pass
+        if failing.stats()['failures'] != 2 or missing.available:
+            errors.append(f"失敗統計錯誤: {failing.stats()}")
+        
+        slow = Transcoder(ffmpeg=fake_ffmpeg('ffmpeg-slow', 'exec sleep 5'), timeout=0.3)
+        try:
+            slow.mp3_to_m4a(b'\x00')
+            errors.append("逾時未拋出錯誤")
+        except TranscodeError:
+            print_success("ffmpeg 逾時時終止並拋出 TranscodeError")
+        for error in errors:
+            print_error(error)
+            all_pass = False
+    
+    ffmpeg = os.getenv('FFMPEG_BINARY') or shutil.which('ffmpeg')
+    if not ffmpeg or not shutil.which(ffmpeg):
+        print_info("找不到 ffmpeg，略過實際轉檔測試")
+        return all_pass
+    # MPEG-2 Layer III, 24kHz 靜音幀，分兩段寫入管線
+    frame = bytes([0xFF, 0xF3, 0x44, 0xC0]) + b'\x00' * 92
+    transcoder = Transcoder(ffmpeg=ffmpeg)
+    m4a, _ = transcoder.mp3_to_m4a([frame * 50, frame * 50])
+    m4a_async, _ = asyncio.run(transcoder.mp3_to_m4a_async([frame * 50, frame * 50]))
+    if m4a[4:8] == b'ftyp' and b'moof' in m4a and m4a_async[4:8] == b'ftyp' and audio_duration_ms(m4a, 'm4a'):
+        print_success(f"MP3 → 分段 M4A: {len(m4a)} bytes, {audio_duration_ms(m4a, 'm4a')}ms")
+    else:
+        print_error(f"轉檔輸出不是分段 M4A: {m4a[:16]!r}")
+        all_pass = False
+    
+    return all_pass
+
+def test_audio_wait_pending():
+    """測試管線模式的 /audio/<id>：只等待共用儲存中標記為生成中的語音，未知的 ID 立即返回 404"""
+    print_info("測試共用儲存的生成中等待...")
+    import tempfile
+    import threading
+    import time
+    from audio_store import DiskAudioStore
+    from benchmark import silent_mp3
+    
+    bot, _ = load_bot()
+    all_pass = True
+    with tempfile.TemporaryDirectory() as directory:
+        store = DiskAudioStore(directory)
+        saved = (bot.audio_cache, bot.AUDIO_PIPELINE, bot.AUDIO_WAIT_TIMEOUT)
+        bot.audio_cache, bot.AUDIO_PIPELINE, bot.AUDIO_WAIT_TIMEOUT = store, True, 3
+        try:
+            client = bot.app.test_client()
+            start = time.monotonic()
+            response = client.get('/audio/' + 'ab' * 16)
+            elapsed = time.monotonic() - start
+            if response.status_code == 404 and elapsed < 0.5:
+                print_success(f"未知的 ID 立即返回 404（{elapsed * 1000:.0f}ms）")
+            else:
+                print_error(f"未知的 ID: {response.status_code}, {elapsed:.2f} 秒")
+                all_pass = False
+            
+            # 模擬另一個 worker 正在生成，0.3 秒後寫入儲存
+            audio_id = 'cd' * 16
+            store.mark_pending(audio_id)
+            
+            def finish():
+                time.sleep(0.3)
+                store.put(audio_id, silent_mp3(), 'mp3')
+                store.clear_pending(audio_id)
+            
+            threading.Thread(target=finish).start()
+            start = time.monotonic()
+            response = client.get('/audio/' + audio_id)
+            elapsed = time.monotonic() - start
+            if response.status_code == 200 and 0.25 <= elapsed < 2 and not store.is_pending(audio_id):
+                print_success(f"生成中的 ID 等待完成後返回音訊（{elapsed * 1000:.0f}ms）")
+            else:
+                print_error(f"生成中的 ID: {response.status_code}, {elapsed:.2f} 秒")
+                all_pass = False
+            
+            store.mark_pending('ef' * 16)
+            if store.is_pending('ef' * 16) and not store.is_pending('ef' * 16, max_age=-1):
+                print_success("超過時限的生成中標記視為已中斷")
+            else:
+                print_error("生成中標記的時限錯誤")
+                all_pass = False
+        finally:
+            bot.audio_cache, bot.AUDIO_PIPELINE, bot.AUDIO_WAIT_TIMEOUT = saved
+    
+    return all_pass
+
+def test_asgi_app():
+    """測試 ASGI 版本：/callback 簽名驗證與翻譯回覆、/audio 的完整與 Range 回應，背景工作完成後釋放"""
+    print_info("測試 ASGI 伺服器...")
+    import asyncio
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+    import httpx
+    from benchmark import signed_payload, silent_mp3
+    from pipeline import AsyncIO
+    
+    bot, state = load_bot()
+    import asgi_app
+    all_pass = True
+    
+    async def run():
+        nonlocal all_pass
+        transport = httpx.ASGITransport(app=asgi_app.app)
+        async with httpx.AsyncClient(transport=transport, base_url='https://bot.example.com') as client:
+            body, signature = signed_payload('Xin chào các bạn', 'asgi-reply-1')
+            missing = await client.post('/callback', data=body)
+            forged = await client.post('/callback', data=body, headers={'X-Line-Signature': 'AAAA' + signature[4:]})
+            if missing.status_code == 400 and forged.status_code == 400:
+                print_success("缺少或錯誤的簽名返回 400")
+            else:
+                print_error(f"簽名驗證: {missing.status_code}, {forged.status_code}")
+                all_pass = False
+            
+            response = await client.post('/callback', data=body, headers={'X-Line-Signature': signature})
+            deadline = time.monotonic() + 5
+            while 'asgi-reply-1' not in state.replies and time.monotonic() < deadline:
+                await asyncio.sleep(0.02)
+            replied = state.replies.get('asgi-reply-1')
+            if response.status_code == 200 and replied and replied[1] == 2:
+                print_success("簽名正確的訊息已翻譯並回覆文字與語音")
+            else:
+                print_error(f"翻譯回覆: {response.status_code}, {replied}")
+                all_pass = False
+            while asgi_app.async_io.background_count() and time.monotonic() < deadline:
+                await asyncio.sleep(0.02)
+            if asgi_app.async_io.background_count() == 0 and asgi_app._inflight == 0:
+                print_success("背景工作完成後從工作集合移除")
+            else:
+                print_error(f"背景工作未釋放: {asgi_app.async_io.background_count()}, inflight={asgi_app._inflight}")
+                all_pass = False
+            
+            clip = silent_mp3()
+            bot.audio_cache.put('ab' * 16, clip, 'mp3')
+            full = await client.get('/audio/' + 'ab' * 16)
+            part = await client.get('/audio/' + 'ab' * 16, headers={'Range': 'bytes=0-9'})
+            unknown = await client.get('/audio/' + 'cd' * 16)
+            if (full.status_code == 200 and full.content == clip and part.status_code == 206
+                    and part.content == clip[:10] and unknown.status_code == 404):
+                print_success("/audio 返回完整音訊、Range 片段與 404")
+            else:
+                print_error(f"/audio: {full.status_code}, {part.status_code}, {unknown.status_code}")
+                all_pass = False
+        
+        # 翻譯與 gTTS 經由非同步 HTTP 呼叫：只有一個執行緒時，同時進行的呼叫數也不受限制
+        one_thread = ThreadPoolExecutor(max_workers=1)
+        async_io = AsyncIO(bot.translation_backend, bot.transcoder, one_thread, asgi_app.get_client,
+                     bot.LINE_API_ENDPOINT, 'token', tts_concurrency=10)
+        state.latency = 0.2
+        try:
+            n = time.time_ns()
+            started = time.perf_counter()
+            results = await asyncio.gather(
+                *[async_io.translate_batch([f'Xin chào {n} {i}'], 'vi', 'zh-tw') for i in range(10)],
+                *[async_io.detect(f'xin chao {n} {i}') for i in range(10)],
+                *[async_io.synthesize(f'你好 {n} {i}', 'zh-TW') for i in range(10)])
+            elapsed = time.perf_counter() - started
+        finally:
+            state.latency = 0
+            one_thread.shutdown()
+        if (results[:10] == [[f'[zh-tw] Xin chào {n} {i}'] for i in range(10)]
+                and results[10:20] == ['vi'] * 10 and all(results[20:]) and elapsed < 1.5):
+            print_success(f"30 個翻譯、檢測與 gTTS 呼叫在單一執行緒下同時進行 ({elapsed * 1000:.0f}ms)")
+        else:
+            print_error(f"非同步呼叫未同時進行: {elapsed * 1000:.0f}ms, {results[:2]}, {results[10:12]}")
+            all_pass = False
+        if asgi_app._client is not None:
+            await asgi_app._client.aclose()
+            asgi_app._client = None
+    
+    asyncio.run(run())
+    return all_pass
+
+def test_audio_load_shedding():
+    """測試語音負載控制：回覆期限不足時只回覆文字、滿載判斷每個工作只計一次、略過的語音以 push 補送"""
+    print_info("測試語音負載控制...")
+    import json
+    import threading
+    import time
+    import uuid
+    from linebot.models import MessageEvent
+    from benchmark import signed_payload
+    
+    bot, state = load_bot()
+    pipe, sync_io = bot.bot_pipeline, bot.sync_io
+    all_pass = True
+    
+    def make_event(text, age=0.0):
+        token = uuid.uuid4().hex
+        data = json.loads(signed_payload(f'{text} {token[:8]}', token, user_id='Ushedding')[0])['events'][0]
+        data['timestamp'] = int((time.time() - age) * 1000)
+        return MessageEvent.new_from_json_dict(data)
+    
+    def replied(token, timeout=5):
+        deadline = time.monotonic() + timeout
+        while token not in state.replies and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return state.replies.get(token, (None, 0))[1]
+    
+    saved = (pipe.reply_budget_ms, pipe.audio_expected_seconds, pipe.audio_max_inflight, pipe.audio_fallback,
+             pipe.audio_pipeline)
+    try:
+        pipe.reply_budget_ms, pipe.audio_expected_seconds = 8000, 2
+        skipped = pipe.tts_skipped.collect().get('budget', 0)
+        event = make_event('Xin chào budget', age=7.5)
+        bot.handle_message(event)
+        if replied(event.reply_token) == 1 and pipe.tts_skipped.collect().get('budget', 0) == skipped + 1:
+            print_success("剩餘回覆時間不足時只回覆文字（budget）")
+        else:
+            print_error(f"回覆期限不足: {state.replies.get(event.reply_token)}")
+            all_pass = False
+        
+        # 管線模式的背景語音生成中時同時計入 audio_inflight 與 pending，滿載判斷只能算一次
+        pipe.audio_pipeline, pipe.audio_max_inflight = True, 2
+        started, release = threading.Event(), threading.Event()
+        
+        async def blocked_generation():
+            with pipe.audio_generation():
+                started.set()
+                release.wait(5)
+        
+        sync_io.submit('ef' * 16, blocked_generation)
+        started.wait(5)
+        one_job = pipe.audio_jobs(sync_io), pipe.audio_skip_reason(sync_io, None)
+        with pipe._load_lock:
+            pipe.queued_pushes += 1
+        two_jobs = pipe.audio_jobs(sync_io), pipe.audio_skip_reason(sync_io, None)
+        with pipe._load_lock:
+            pipe.queued_pushes -= 1
+        release.set()
+        sync_io.wait('ef' * 16, 5)
+        if one_job == (1, None) and two_jobs == (2, 'saturated'):
+            print_success("生成中的背景語音只計一次，達到上限時判斷為滿載（saturated）")
+        else:
+            print_error(f"滿載判斷: {one_job}, {two_jobs}")
+            all_pass = False
+        
+        pipe.audio_pipeline, pipe.audio_max_inflight, pipe.audio_fallback = False, 8, 'push'
+        pushes = len(state.pushes)
+        sent = pipe.audio_pushes.collect().get('sent', 0)
+        event = make_event('Xin chào push', age=7.5)
+        bot.handle_message(event)
+        deadline = time.monotonic() + 5
+        while pipe.audio_pushes.collect().get('sent', 0) == sent and time.monotonic() < deadline:
+            time.sleep(0.01)
+        new_pushes = state.pushes[pushes:]
+        if (replied(event.reply_token) == 1 and len(new_pushes) == 1 and new_pushes[0][1:] == ('Ushedding', 1)
+                and pipe.queued_pushes == 0):
+            print_success("略過的語音生成後以 push message 補送到原聊天室")
+        else:
+            print_error(f"補送語音: {new_pushes}, queued={pipe.queued_pushes}")
+            all_pass = False
+    finally:
+        (pipe.reply_budget_ms, pipe.audio_expected_seconds, pipe.audio_max_inflight, pipe.audio_fallback,
+         pipe.audio_pipeline) = saved
+    
+    return all_pass
+
+def test_sentence_audio():
+    """測試逐句語音：單句訊息只快取整段語音，多句訊息另存各句；所有訊息合計的 gTTS 同時請求受上限限制"""
+    print_info("測試逐句語音合成...")
+    import threading
+    import time
+    import pipeline
+    from audio_store import MemoryAudioStore
+    from benchmark import silent_mp3
+    from pipeline import SyncIO, run_sync
+    
+    bot, _ = load_bot()
+    pipe = bot.bot_pipeline
+    all_pass = True
+    saved = (pipe.audio_store, pipeline.synthesize_mp3)
+    store = MemoryAudioStore()
+    pipe.audio_store = store
+    try:
+        run_sync(pipe.produce_audio(bot.sync_io, 'aa' * 16, 'Xin chào bạn.', 'vi'))
+        single = store.stats()['entries']
+        run_sync(pipe.produce_audio(bot.sync_io, 'bb' * 16, 'Một. Hai. Ba.', 'vi'))
+        multi = store.stats()['entries'] - single
+        if single == 1 and multi == 4:
+            print_success("單句訊息只存一份整段語音，多句訊息另存 3 句可重用的句子音訊")
+        else:
+            print_error(f"快取條目數: 單句 {single}, 多句 {multi}")
+            all_pass = False
+        
+        active = [0, 0]
+        lock = threading.Lock()
+        
+        def slow_synthesize(text, lang):
+            with lock:
+                active[0] += 1
+                active[1] = max(active[1], active[0])
+            time.sleep(0.05)
+            with lock:
+                active[0] -= 1
+            return silent_mp3()
+        
+        pipeline.synthesize_mp3 = slow_synthesize
+        sync_io = SyncIO(bot.translation_backend, bot.transcoder, bot.line_bot_api, bot.tts_executor, tts_concurrency=2)
+        text = '. '.join(f'Câu số {i} {time.time()}' for i in range(8)) + '.'
+        run_sync(pipe.generate_audio(sync_io, text, 'vi'))
+        if active[1] == 2:
+            print_success(f"8 句、每則訊息 {pipe.sentence_workers} 句並行時 gTTS 同時請求不超過上限 2")
+        else:
+            print_error(f"gTTS 同時請求數: {active[1]}")
+            all_pass = False
+    finally:
+        pipe.audio_store, pipeline.synthesize_mp3 = saved
+    
+    return all_pass
+
+def test_source_scheduling():
+    """測試依來源排程與限流：多來源的投遞依來源拆開排隊（全部放入或全部拒絕），已快取的語音不扣來源額度"""
+    print_info("測試依來源拆分投遞與語音額度...")
+    import queue
+    import threading
+    import time
+    import uuid
+    from linebot.models import MessageEvent
+    from fair_queue import FairQueue, SourceLimiter
+    from pipeline import source_key
+    from webhook_queue import WebhookQueue
+    
+    bot, state = load_bot()
+    all_pass = True
+    
+    q = FairQueue(maxsize=3)
+    q.put('a', key='group:C1')
+    q.put('b', key='group:C1')
+    try:
+        q.put_many([('c', 'group:C1', 1), ('d', 'user:U2', 1)], block=False)
+        partial = None
+    except queue.Full:
+        partial = q.qsize()
+    if partial == 2:
+        print_success("空位不足時整個投遞都不放入")
+    else:
+        print_error(f"部分放入: {partial}")
+        all_pass = False
+    
+    received = []
+    done = threading.Event()
+    
+    def record(events):
+        received.append((source_key(events[0].source), len(events)))
+        if len(received) == 2:
+            done.set()
+    
+    group, user = {'type': 'group', 'groupId': 'C1', 'userId': 'U1'}, {'type': 'user', 'userId': 'U2'}
+    body, signature = signed_events([text_event('Xin chào', 'split-1', group), text_event('Cảm ơn', 'split-2', user),
+                                     text_event('Tạm biệt', 'split-3', group)])
+    saved = (bot.WEBHOOK_MODE, bot.webhook_queue, bot.bot_pipeline.tts_limiter)
+    bot.WEBHOOK_MODE, bot.webhook_queue = 'queue', WebhookQueue(record, workers=1)
+    try:
+        response = bot.app.test_client().post('/callback', data=body, headers={'X-Line-Signature': signature})
+        done.wait(5)
+        if response.status_code == 200 and sorted(received) == [('group:C1', 2), ('user:U2', 1)]:
+            print_success(f"投遞依來源拆成 {len(received)} 筆排隊: {sorted(received)}")
+        else:
+            print_error(f"拆分投遞: {response.status_code}, {received}")
+            all_pass = False
+        
+        limiter = SourceLimiter(rate=0.001, burst=1)
+        bot.bot_pipeline.tts_limiter = limiter
+        text = f'Xin chào {uuid.uuid4().hex[:8]}'
+        counts = []
+        for i, message in enumerate([text, text, text + ' nữa']):
+            token = f'limit-{uuid.uuid4().hex}'
+            bot.handle_message(MessageEvent.new_from_json_dict(text_event(message, token, {'type': 'user', 'userId': 'U3'})))
+            deadline = time.monotonic() + 5
+            while token not in state.replies and time.monotonic() < deadline:
+                time.sleep(0.01)
+            counts.append(state.replies.get(token, (None, 0))[1])
+        stats = limiter.stats()
+        if counts == [2, 2, 1] and stats['allowed'] == 1 and stats['limited'] == 1:
+            print_success("已快取的語音不扣額度照常附上，新的語音超出額度時只回覆文字")
+        else:
+            print_error(f"語音額度: 回覆訊息數 {counts}, {stats}")
+            all_pass = False
+    finally:
+        bot.WEBHOOK_MODE, bot.webhook_queue, bot.bot_pipeline.tts_limiter = saved
+    
+    return all_pass
+
+def test_batched_delivery():
+    """測試多事件投遞：每個語言方向只送出一次翻譯請求、重複的文字只翻譯一次，譯文回覆到各自的事件"""
+    print_info("測試多事件投遞的合併翻譯...")
+    import threading
+    import time
+    from linebot.models import MessageEvent
+    from pipeline import run_sync
+    
+    bot, state = load_bot()
+    all_pass = True
+    n = str(time.time_ns())[-8:]
+    source = {'type': 'group', 'groupId': 'Cbatch', 'userId': 'Ubatch'}
+    texts = {
+        f'batch-vi-1-{n}': f'Tôi đang học tiếng Việt {n}',
+        f'batch-vi-2-{n}': f'Hôm nay trời đẹp quá {n}',
+        f'batch-vi-3-{n}': f'Tôi đang học tiếng Việt {n}',
+        f'batch-zh-1-{n}': f'我們明天見面吧 {n}',
+        f'batch-zh-2-{n}': f'這個多少錢 {n}',
+    }
+    body, signature = signed_events([text_event(text, token, source) for token, text in texts.items()])
+    with state.lock:
+        before = len(state.translations)
+    response = bot.app.test_client().post('/callback', data=body, headers={'X-Line-Signature': signature})
+    deadline = time.monotonic() + 5
+    while not all(token in state.replies for token in texts) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    with state.lock:
+        requests = [(text, src, dest) for text, src, dest in state.translations[before:] if src != 'auto']
+        replies = {token: state.reply_messages.get(token) for token in texts}
+    
+    by_dest = {}
+    for text, src, dest in requests:
+        by_dest.setdefault(dest, []).append(text.split('\n'))
+    if (response.status_code == 200 and sorted(by_dest) == ['vi', 'zh-tw']
+            and all(len(calls) == 1 for calls in by_dest.values())):
+        print_success(f"每個語言方向只送出一次翻譯請求: {sorted(by_dest)}")
+    else:
+        print_error(f"翻譯請求: {response.status_code}, {requests}")
+        all_pass = False
+    
+    vi_lines = by_dest.get('zh-tw', [[]])[0]
+    if sorted(vi_lines) == sorted({texts[f'batch-vi-1-{n}'], texts[f'batch-vi-2-{n}']}):
+        print_success("重複的文字在批次請求中只出現一次")
+    else:
+        print_error(f"批次請求的內容: {vi_lines}")
+        all_pass = False
+    
+    routed = True
+    for token, text in texts.items():
+        dest = 'zh-tw' if '-vi-' in token else 'vi'
+        messages = replies[token] or [{}]
+        reply_text = messages[0].get('text', '')
+        routed = routed and reply_text == f'[{dest}] {text}'
+    if routed:
+        print_success(f"{len(texts)} 則譯文各自回覆到原本的事件")
+    else:
+        print_error(f"回覆對應錯誤: {replies}")
+        all_pass = False
+    
+    # 不帶聲調的越南文無法在本地判斷語言，遠端檢測要同時進行而非逐則等待
+    pipe, sync_io = bot.bot_pipeline, bot.sync_io
+    lock = threading.Lock()
+    running = [0, 0]
+    
+    async def slow_detect(text):
+        with lock:
+            running[0] += 1
+            running[1] = max(running[1], running[0])
+        time.sleep(0.1)
+        with lock:
+            running[0] -= 1
+        return 'vi'
+    
+    toneless = [f'xin chao ban {n}', f'cam on nhieu {n}', f'toi di hoc {n}', f'hom nay troi dep {n}']
+    events = [MessageEvent.new_from_json_dict(text_event(text, f'toneless-{i}', source))
+              for i, text in enumerate(toneless)]
+    sync_io.detect = slow_detect
+    try:
+        started = time.perf_counter()
+        groups = run_sync(pipe.batch_translation_groups(sync_io, events))
+        elapsed = time.perf_counter() - started
+    finally:
+        del sync_io.detect
+    if groups == {('vi', 'zh-tw'): toneless} and running[1] > 1 and elapsed < 0.3:
+        print_success(f"需要遠端檢測的 {len(toneless)} 則訊息同時檢測 ({elapsed * 1000:.0f}ms)")
+    else:
+        print_error(f"遠端檢測未同時進行: 最多 {running[1]} 個, {elapsed * 1000:.0f}ms, {groups}")
+        all_pass = False
+    
+    return all_pass
+
+def test_audio_ranges():
+    """測試 /audio 的條件與 Range 回應：記憶體與 disk 後端、Flask 與 ASGI 版本行為一致"""
+    print_info("測試 /audio 的 Range 與 ETag...")
+    import asyncio
+    import shutil
+    import tempfile
+    import httpx
+    from audio_store import MemoryAudioStore, DiskAudioStore
+    from benchmark import silent_mp3
+    
+    bot, _ = load_bot()
+    import asgi_app
+    clip = silent_mp3()
+    audio_id = 'ef' * 16
+    directory = tempfile.mkdtemp()
+    saved = bot.audio_cache
+    all_pass = True
+    
+    def check(name, responses):
+        """responses 依序為：完整、前 10 位元組、最後 10 位元組、超出範圍、If-None-Match、多段 Range"""
+        full, head, suffix, unsatisfiable, not_modified, multi = responses
+        etag = full[2].get('etag')
+        checks = [
+            full[0] == 200 and full[1] == clip and etag,
+            head[0] == 206 and head[1] == clip[:10] and head[2].get('content-range') == f'bytes 0-9/{len(clip)}',
+            suffix[0] == 206 and suffix[1] == clip[-10:],
+            unsatisfiable[0] == 416 and unsatisfiable[2].get('content-range') == f'bytes */{len(clip)}',
+            not_modified[0] == 304 and not_modified[1] == b'',
+            multi[0] == 200 and multi[1] == clip,
+        ]
+        if all(checks):
+            print_success(f"{name}: 200、206、後綴 Range、416、304 與多段 Range 退回 200")
+            return True
+        print_error(f"{name}: {[r[0] for r in responses]} {checks}")
+        return False
+    
+    def flask_responses(etag_of):
+        client = bot.app.test_client()
+        responses = []
+        for headers in ({}, {'Range': 'bytes=0-9'}, {'Range': 'bytes=-10'}, {'Range': 'bytes=999999-'},
+                        {'If-None-Match': etag_of}, {'Range': 'bytes=0-1,4-5'}):
+            response = client.get('/audio/' + audio_id, headers=headers)
+            responses.append((response.status_code, response.data,
+                              {k.lower(): v for k, v in response.headers.items()}))
+        return responses
+    
+    async def asgi_responses(etag_of):
+        transport = httpx.ASGITransport(app=asgi_app.app)
+        responses = []
+        async with httpx.AsyncClient(transport=transport, base_url='https://bot.example.com') as client:
+            for headers in ({}, {'Range': 'bytes=0-9'}, {'Range': 'bytes=-10'}, {'Range': 'bytes=999999-'},
+                            {'If-None-Match': etag_of}, {'Range': 'bytes=0-1,4-5'}):
+                response = await client.get('/audio/' + audio_id, headers=headers)
+                responses.append((response.status_code, response.content, dict(response.headers)))
+        return responses
+    
+    try:
+        for store in (MemoryAudioStore(), DiskAudioStore(directory)):
+            bot.audio_cache = store
+            store.put(audio_id, clip, 'mp3')
+            etag = f'"{store.get(audio_id).etag}"'
+            backend = '記憶體' if isinstance(store, MemoryAudioStore) else 'disk'
+            all_pass = check(f"Flask / {backend}", flask_responses(etag)) and all_pass
+            all_pass = check(f"ASGI / {backend}", asyncio.run(asgi_responses(etag))) and all_pass
+    finally:
+        bot.audio_cache = saved
+        shutil.rmtree(directory, ignore_errors=True)
+    
+    return all_pass
+
+def test_content_addressed_audio():
+    """測試內容位址的語音快取：相同文字與語言重用同一筆音訊，只合成一次"""
+    print_info("測試內容位址語音快取...")
+    import time
+    import pipeline
+    from audio_store import MemoryAudioStore
+    from pipeline import run_sync
+    
+    bot, _ = load_bot()
+    pipe, sync_io = bot.bot_pipeline, bot.sync_io
+    store = MemoryAudioStore()
+    saved = (pipe.audio_store, pipeline.synthesize_mp3)
+    synthesized = []
+    all_pass = True
+    
+    def counting_synthesize(text, lang):
+        synthesized.append((text, lang))
+        return saved[1](text, lang)
+    
+    pipe.audio_store = store
+    pipeline.synthesize_mp3 = counting_synthesize
+    try:
+        text = f'今天天氣很好 {time.time()}'
+        first, _ = run_sync(pipe.build_audio_message(sync_io, text, 'zh-tw'))
+        second, _ = run_sync(pipe.build_audio_message(sync_io, text, 'zh-tw'))
+        if (first and second and first.original_content_url == second.original_content_url
+                and len(store) == 1 and len(synthesized) == 1):
+            print_success(f"相同文字與語言重用同一筆音訊: {first.original_content_url.rsplit('/', 1)[-1]}")
+        else:
+            print_error(f"未重用音訊: entries={len(store)}, 合成 {len(synthesized)} 次")
+            all_pass = False
+        
+        other, _ = run_sync(pipe.build_audio_message(sync_io, text, 'vi'))
+        if other and other.original_content_url != first.original_content_url and len(store) == 2:
+            print_success("不同語言使用不同的音訊 ID")
+        else:
+            print_error(f"不同語言的音訊 ID: entries={len(store)}")
+            all_pass = False
+    finally:
+        pipe.audio_store, pipeline.synthesize_mp3 = saved
+    
+    return all_pass
+
 def run_all_function_tests():
     """運行所有功能測試"""
     print("=" * 60)
@@ -194,34 +1907,146 @@ def run_all_function_tests():
     
     results = {}
     
-    print("【1/7】get_tts_lang 邏輯測試")
+    print("【1/35】get_tts_lang 邏輯測試")
     results['tts_lang'] = test_get_tts_lang_logic()
     print()
     
-    print("【2/7】翻譯邏輯測試")
+    print("【2/35】翻譯邏輯測試")
     results['translation'] = test_translation_logic()
     print()
     
-    print("【3/7】URL 處理邏輯測試")
+    print("【3/35】URL 處理邏輯測試")
     results['url'] = test_url_handling()
     print()
     
-    print("【4/7】音訊長度計算測試")
+    print("【4/35】音訊長度計算測試")
     results['duration'] = test_duration_calculation()
     print()
     
-    print("【5/7】文字截斷邏輯測試")
+    print("【5/35】文字截斷邏輯測試")
     results['truncation'] = test_text_truncation()
     print()
     
-    print("【6/7】音訊格式處理測試")
+    print("【6/35】音訊格式處理測試")
     results['format'] = test_audio_format_handling()
     print()
     
-    print("【7/7】快取條目格式測試")
+    print("【7/35】快取條目格式測試")
     results['cache'] = test_cache_entry_format()
     print()
     
+    print("【8/35】Webhook 佇列測試")
+    results['webhook_queue'] = test_webhook_queue()
+    print()
+    
+    print("【9/35】翻譯快取測試")
+    results['translation_cache'] = test_translation_cache()
+    print()
+    
+    print("【10/35】本地語言檢測測試")
+    results['lang_detect'] = test_local_language_detection()
+    print()
+    
+    print("【11/35】音訊儲存測試")
+    results['audio_store'] = test_audio_store()
+    print()
+    
+    print("【12/35】音訊過期清理測試")
+    results['audio_expiry'] = test_audio_expiry()
+    print()
+    
+    print("【13/35】共用目錄音訊儲存測試")
+    results['disk_audio_store'] = test_disk_audio_store()
+    print()
+    
+    print("【14/35】生成中音訊等待測試")
+    results['pending_audio'] = test_pending_audio()
+    print()
+    
+    print("【15/35】持久化翻譯記憶測試")
+    results['translation_memory'] = test_translation_memory()
+    print()
+    
+    print("【16/35】快取預熱測試")
+    results['cache_warmer'] = test_cache_warmer()
+    print()
+    
+    print("【17/35】相同請求合併測試")
+    results['single_flight'] = test_single_flight()
+    print()
+    
+    print("【18/35】LINE 回覆用戶端測試")
+    results['line_reply_client'] = test_line_reply_client()
+    print()
+    
+    print("【19/35】翻譯後端測試")
+    results['translation_backend'] = test_translation_backend()
+    print()
+    
+    print("【20/35】分句批次翻譯測試")
+    results['sentence_batching'] = test_sentence_batching()
+    print()
+    
+    print("【21/35】MP3 串接測試")
+    results['mp3_concat'] = test_mp3_concat()
+    print()
+    
+    print("【22/35】Prometheus 指標")
+    results['prometheus_metrics'] = test_prometheus_metrics()
+    print()
+    
+    print("【23/35】基準測試工具")
+    results['benchmark_harness'] = test_benchmark_harness()
+    print()
+    
+    print("【24/35】事件追蹤")
+    results['event_tracing'] = test_event_tracing()
+    print()
+    
+    print("【25/35】公平排程與限流")
+    results['fair_queue'] = test_fair_queue()
+    print()
+    
+    print("【26/35】MP4 播放長度解析測試")
+    results['mp4_duration'] = test_mp4_duration()
+    print()
+    
+    print("【27/35】ffmpeg 管線轉檔測試")
+    results['transcoder'] = test_transcoder()
+    print()
+    
+    print("【28/35】共用儲存生成中等待測試")
+    results['audio_wait_pending'] = test_audio_wait_pending()
+    print()
+    
+    print("【29/35】ASGI 伺服器測試")
+    results['asgi_app'] = test_asgi_app()
+    print()
+    
+    print("【30/35】語音負載控制測試")
+    results['audio_load_shedding'] = test_audio_load_shedding()
+    print()
+    
+    print("【31/35】逐句語音合成測試")
+    results['sentence_audio'] = test_sentence_audio()
+    print()
+    
+    print("【32/35】依來源排程與語音額度測試")
+    results['source_scheduling'] = test_source_scheduling()
+    print()
+    
+    print("【33/35】多事件投遞合併翻譯測試")
+    results['batched_delivery'] = test_batched_delivery()
+    print()
+    
+    print("【34/35】測試 /audio 的 Range 與 ETag")
+    results['audio_ranges'] = test_audio_ranges()
+    print()
+    
+    print("【35/35】測試內容位址語音快取")
+    results['content_addressed_audio'] = test_content_addressed_audio()
+    print()
+    
     # 總結
     print("=" * 60)
     print("測試總結")
@@ -0,0 +1,149 @@
+"""
+事件追蹤
+每個 webhook 事件產生一個 trace id，各處理階段（detect / translate / tts / transcode / store / reply）記錄為計時 span，
+事件處理完成後輸出一行結構化 JSON 日誌；可設定抽樣比例，慢事件與出錯的事件一律輸出
+"""
+import contextvars
+import json
+import random
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+# 目前的追蹤（執行緒與 asyncio 工作各自獨立；交給執行緒池時需以 contextvars.copy_context() 帶過去）
+_current = contextvars.ContextVar('trace', default=None)
+
+
+class Trace:
+    """一個事件的追蹤：屬性與 span 列表（span 可能來自多個執行緒）"""
+
+    def __init__(self, trace_id=None, **attrs):
+        self.trace_id = trace_id or uuid.uuid4().hex[:16]
+        self.attrs = attrs
+        self.spans = []
+        self.started_at = time.time()
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+        self.finished = False
+
+    def add_span(self, name, start, end, error=None):
+        span = {
+            "name": name,
+            "start_ms": round((start - self._start) * 1000, 1),
+            "duration_ms": round((end - start) * 1000, 1),
+        }
+        if error:
+            span["error"] = error
+        with self._lock:
+            if not self.finished:
+                self.spans.append(span)
+
+    def annotate(self, **attrs):
+        with self._lock:
+            self.attrs.update(attrs)
+
+    def finish(self):
+        """結束追蹤，返回 (總耗時毫秒, 日誌內容)；之後才結束的 span（例如背景語音）不再記錄"""
+        duration_ms = round((time.perf_counter() - self._start) * 1000, 1)
+        with self._lock:
+            self.finished = True
+            record = {
+                "trace_id": self.trace_id,
+                "time": time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(self.started_at))
+                        + f".{int(self.started_at * 1000) % 1000:03d}Z",
+                "duration_ms": duration_ms,
+                "status": "error" if "error" in self.attrs else "ok",
+            }
+            record.update(self.attrs)
+            record["spans"] = sorted(self.spans, key=lambda span: span["start_ms"])
+        return duration_ms, record
+
+
+class Tracer:
+    """建立追蹤並決定是否輸出：sample_rate 為一般事件的抽樣比例，
+    耗時超過 slow_ms（> 0 時）或出錯的事件一律輸出；兩者皆為 0 時停用"""
+
+    def __init__(self, sample_rate=1.0, slow_ms=0, emit=None):
+        self.sample_rate = max(0.0, min(1.0, sample_rate))
+        self.slow_ms = slow_ms
+        self.emit = emit or self._print
+        self._lock = threading.Lock()
+        self.traces = 0
+        self.emitted = 0
+
+    @property
+    def enabled(self):
+        return self.sample_rate > 0 or self.slow_ms > 0
+
+    @staticmethod
+    def _print(record):
+        print(json.dumps(record, ensure_ascii=False, separators=(',', ':')), flush=True)
+
+    @contextmanager
+    def trace(self, trace_id=None, **attrs):
+        """追蹤 with 區塊內的事件處理；停用時不建立追蹤（yield None）"""
+        if not self.enabled:
+            yield None
+            return
+        trace = Trace(trace_id, **attrs)
+        token = _current.set(trace)
+        try:
+            yield trace
+        except Exception as e:
+            trace.annotate(error=f"{type(e).__name__}: {e}")
+            raise
+        finally:
+            _current.reset(token)
+            self._finish(trace)
+
+    def _finish(self, trace):
+        duration_ms, record = trace.finish()
+        sampled = (record["status"] == "error"
+                   or (self.slow_ms > 0 and duration_ms >= self.slow_ms)
+                   or (self.sample_rate >= 1.0 or random.random() < self.sample_rate))
+        with self._lock:
+            self.traces += 1
+            if sampled:
+                self.emitted += 1
+        if sampled:
+            try:
+                self.emit(record)
+            except Exception as e:
+                print(f"輸出追蹤日誌失敗: {e}")
+
+    @contextmanager
+    def span(self, name):
+        """在目前的追蹤中記錄一個計時 span（沒有追蹤時不做任何事）"""
+        trace = _current.get()
+        if trace is None:
+            yield
+            return
+        start = time.perf_counter()
+        error = None
+        try:
+            yield
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            trace.add_span(name, start, time.perf_counter(), error)
+
+    def annotate(self, **attrs):
+        """為目前的追蹤加上屬性"""
+        trace = _current.get()
+        if trace is not None:
+            trace.annotate(**attrs)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "sample_rate": self.sample_rate,
+                "slow_ms": self.slow_ms,
+                "traces": self.traces,
+                "emitted": self.emitted,
+            }
+
+
+def current_trace():
+    return _current.get()
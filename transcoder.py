@@ -0,0 +1,170 @@
+"""
+MP3 → M4A 轉檔
+直接以管線把 MP3 送入 ffmpeg 的 stdin、從 stdout 讀回 AAC，
+不經過 pydub 的 PCM 解碼與暫存檔，每段語音只啟動一次 ffmpeg
+"""
+import asyncio
+import shutil
+import subprocess
+import threading
+import time
+
+
+class TranscodeError(Exception):
+    """轉檔失敗"""
+
+
+class Transcoder:
+    """以 ffmpeg 管線轉檔，並以號誌限制同時執行的 ffmpeg 數量"""
+
+    def __init__(self, ffmpeg='ffmpeg', bitrate='64k', max_concurrency=2, timeout=30):
+        self.ffmpeg = shutil.which(ffmpeg)
+        self.bitrate = bitrate
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._async_slots = None
+        self._lock = threading.Lock()
+        self.conversions = 0
+        self.failures = 0
+        self.total_seconds = 0.0
+        self.last_seconds = 0.0
+
+    @property
+    def available(self):
+        return self.ffmpeg is not None
+
+    def command(self):
+        """組出 ffmpeg 指令；輸出到管線時 MP4 需使用分段格式（moov 在前）"""
+        return [
+            self.ffmpeg, '-hide_banner', '-loglevel', 'error', '-nostdin',
+            '-f', 'mp3', '-i', 'pipe:0',
+            '-vn', '-c:a', 'aac', '-b:a', self.bitrate,
+            '-f', 'ipod', '-movflags', '+frag_keyframe+empty_moov+default_base_moof',
+            'pipe:1',
+        ]
+
+    def mp3_to_m4a(self, mp3_data):
+        """將 MP3 轉為 M4A，返回 (M4A 資料, 轉檔秒數)；mp3_data 可以是 bytes 或依序的多段 bytes（逐段寫入管線）"""
+        if not self.available:
+            raise TranscodeError("找不到 ffmpeg")
+        chunks = [mp3_data] if isinstance(mp3_data, (bytes, bytearray, memoryview)) else mp3_data
+        with self._slots:
+            start = time.perf_counter()
+            try:
+                returncode, stdout, stderr = self._run_pipe(chunks)
+            except (OSError, subprocess.TimeoutExpired) as e:
+                self._record(None)
+                raise TranscodeError(str(e))
+            elapsed = time.perf_counter() - start
+        if returncode != 0 or not stdout:
+            self._record(None)
+            raise TranscodeError(stderr.decode('utf-8', 'replace').strip() or f"ffmpeg 返回 {returncode}")
+        self._record(elapsed)
+        return (stdout, elapsed)
+
+    def _run_pipe(self, chunks):
+        """啟動 ffmpeg，由寫入執行緒逐段送入 stdin，同時讀取 stdout；逾時則終止 ffmpeg"""
+        proc = subprocess.Popen(self.command(), stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        timed_out = threading.Event()
+
+        def kill():
+            timed_out.set()
+            proc.kill()
+
+        def feed():
+            try:
+                for chunk in chunks:
+                    proc.stdin.write(chunk)
+            except OSError:
+                # ffmpeg 提前結束（錯誤或逾時），由返回碼與 stderr 回報
+                pass
+            finally:
+                try:
+                    proc.stdin.close()
+                except OSError:
+                    pass
+
+        stderr = []
+        timer = threading.Timer(self.timeout, kill)
+        writer = threading.Thread(target=feed, daemon=True)
+        reader = threading.Thread(target=lambda: stderr.append(proc.stderr.read()), daemon=True)
+        timer.start()
+        writer.start()
+        reader.start()
+        try:
+            stdout = proc.stdout.read()
+            proc.wait()
+        finally:
+            timer.cancel()
+            writer.join()
+            reader.join()
+            proc.stdout.close()
+            proc.stderr.close()
+        if timed_out.is_set():
+            raise subprocess.TimeoutExpired(proc.args, self.timeout)
+        return (proc.returncode, stdout, stderr[0] if stderr else b'')
+
+    async def mp3_to_m4a_async(self, mp3_data):
+        """非同步版本（ASGI 使用），以 asyncio 子行程管線轉檔；mp3_data 同樣可以是多段 bytes"""
+        if not self.available:
+            raise TranscodeError("找不到 ffmpeg")
+        chunks = [mp3_data] if isinstance(mp3_data, (bytes, bytearray, memoryview)) else mp3_data
+        if self._async_slots is None:
+            self._async_slots = asyncio.Semaphore(self.max_concurrency)
+        async with self._async_slots:
+            start = time.perf_counter()
+            try:
+                proc = await asyncio.create_subprocess_exec(
+                    *self.command(), stdin=asyncio.subprocess.PIPE,
+                    stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+            except OSError as e:
+                self._record(None)
+                raise TranscodeError(str(e))
+
+            async def feed():
+                try:
+                    for chunk in chunks:
+                        proc.stdin.write(chunk)
+                        await proc.stdin.drain()
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+                finally:
+                    proc.stdin.close()
+
+            try:
+                _, stdout, stderr = await asyncio.wait_for(
+                    asyncio.gather(feed(), proc.stdout.read(), proc.stderr.read()), self.timeout)
+                await proc.wait()
+            except asyncio.TimeoutError:
+                proc.kill()
+                await proc.wait()
+                self._record(None)
+                raise TranscodeError("ffmpeg 逾時")
+            elapsed = time.perf_counter() - start
+        if proc.returncode != 0 or not stdout:
+            self._record(None)
+            raise TranscodeError(stderr.decode('utf-8', 'replace').strip() or f"ffmpeg 返回 {proc.returncode}")
+        self._record(elapsed)
+        return (stdout, elapsed)
+
+    def _record(self, elapsed):
+        with self._lock:
+            if elapsed is None:
+                self.failures += 1
+            else:
+                self.conversions += 1
+                self.total_seconds += elapsed
+                self.last_seconds = elapsed
+
+    def stats(self):
+        """返回轉檔次數、失敗次數與平均耗時"""
+        with self._lock:
+            return {
+                "available": self.available,
+                "conversions": self.conversions,
+                "failures": self.failures,
+                "avg_ms": round(self.total_seconds / self.conversions * 1000, 1) if self.conversions else 0.0,
+                "last_ms": round(self.last_seconds * 1000, 1),
+            }
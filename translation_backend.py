@@ -0,0 +1,257 @@
+"""
+翻譯後端
+TranslationBackend 定義翻譯 / 語言檢測介面；
+GoogletransBackend 以多個 googletrans Translator 組成的池供多執行緒使用（每次呼叫借出一個），
+並以相同的 RPC 提供非同步版本（ASGI 版本經由共用的 httpx.AsyncClient 呼叫，不占用執行緒）；
+StubBackend 不連網路，供測試與基準測試使用；其他後端可用 register_backend() 加入
+"""
+import asyncio
+import os
+import queue
+import shlex
+import sys
+import threading
+import time
+
+from metrics import LatencyHistogram
+from sentences import split_batch_result
+
+
+class TranslationBackend:
+    """翻譯後端介面；native_async 為 True 的後端另外實作 translate_async / detect_async，
+    否則 ASGI 版本把同步呼叫交給執行緒池"""
+
+    name = 'base'
+    native_async = False
+
+    def translate(self, text, src, dest):
+        """翻譯文字，返回譯文字串"""
+        raise NotImplementedError
+
+    def detect(self, text):
+        """檢測語言，返回小寫語言代碼"""
+        raise NotImplementedError
+
+    def translate_batch(self, texts, src, dest):
+        """以一次請求翻譯多句（以換行串接再拆回）；行數對不上時改為逐句翻譯"""
+        if len(texts) == 1:
+            return [self.translate(texts[0], src, dest)]
+        lines = split_batch_result(self.translate('\n'.join(texts), src, dest), len(texts))
+        if lines is None:
+            print(f"批次翻譯行數不符，改為逐句翻譯: {len(texts)} 句")
+            return [self.translate(text, src, dest) for text in texts]
+        return lines
+
+    async def translate_async(self, client, text, src, dest):
+        """以 httpx.AsyncClient 翻譯文字，返回譯文字串"""
+        raise NotImplementedError
+
+    async def detect_async(self, client, text):
+        """以 httpx.AsyncClient 檢測語言，返回小寫語言代碼"""
+        raise NotImplementedError
+
+    async def translate_batch_async(self, client, texts, src, dest):
+        """translate_batch 的非同步版本；行數對不上時改為同時逐句翻譯"""
+        if len(texts) == 1:
+            return [await self.translate_async(client, texts[0], src, dest)]
+        lines = split_batch_result(await self.translate_async(client, '\n'.join(texts), src, dest), len(texts))
+        if lines is None:
+            print(f"批次翻譯行數不符，改為逐句翻譯: {len(texts)} 句")
+            return list(await asyncio.gather(*[self.translate_async(client, text, src, dest) for text in texts]))
+        return lines
+
+    def stats(self):
+        return {"backend": self.name}
+
+
+def _parse_translation(data, text, src, dest):
+    """以 googletrans 的解析邏輯處理 RPC 回應內容，返回 googletrans 的 Translated 物件"""
+    from googletrans import Translator
+
+    class _Parsed(Translator):
+        # 只沿用回應解析，不建立 httpx.Client 也不發出請求
+        def __init__(self):
+            pass
+
+        def _translate(self, text, dest, src):
+            return data, None
+
+    return _Parsed().translate(text, dest=dest, src=src)
+
+
+class GoogletransBackend(TranslationBackend):
+    """googletrans 用戶端池：Translator（httpx.Client）不保證執行緒安全，每個執行緒借出獨立的實例；
+    非同步版本以相同的 RPC 經由呼叫端的 httpx.AsyncClient 送出，不借用池中的實例"""
+
+    name = 'googletrans'
+    native_async = True
+
+    def __init__(self, pool_size=4, translator_factory=None):
+        if translator_factory is None:
+            from googletrans import Translator
+            translator_factory = Translator
+        self.pool_size = max(1, pool_size)
+        self._pool = queue.LifoQueue()
+        for _ in range(self.pool_size):
+            self._pool.put(translator_factory())
+        self.wait_time = LatencyHistogram()
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.in_use = 0
+        self.max_in_use = 0
+
+    def _call(self, fn):
+        start = time.perf_counter()
+        translator = self._pool.get()
+        self.wait_time.observe(time.perf_counter() - start)
+        with self._lock:
+            self.calls += 1
+            self.in_use += 1
+            self.max_in_use = max(self.max_in_use, self.in_use)
+        try:
+            return fn(translator)
+        finally:
+            with self._lock:
+                self.in_use -= 1
+            self._pool.put(translator)
+
+    def translate(self, text, src, dest):
+        return self._call(lambda translator: translator.translate(text, src=src, dest=dest).text)
+
+    def detect(self, text):
+        return self._call(lambda translator: translator.detect(text).lang).lower()
+
+    async def _rpc_async(self, client, text, src, dest):
+        from googletrans import urls
+        from googletrans.client import RPC_ID, Translator
+        from googletrans.constants import DEFAULT_CLIENT_SERVICE_URLS
+        with self._lock:
+            self.calls += 1
+            self.in_use += 1
+            self.max_in_use = max(self.max_in_use, self.in_use)
+        try:
+            response = await client.post(
+                urls.TRANSLATE_RPC.format(host=DEFAULT_CLIENT_SERVICE_URLS[0]),
+                params={
+                    'rpcids': RPC_ID,
+                    'bl': 'boq_translate-webserver_20201207.13_p0',
+                    'soc-app': 1,
+                    'soc-platform': 1,
+                    'soc-device': 1,
+                    'rt': 'c',
+                },
+                data={'f.req': Translator._build_rpc_request(None, text, dest, src)},
+                headers={'Referer': 'https://translate.google.com'})
+            response.raise_for_status()
+            return _parse_translation(response.text, text, src, dest)
+        finally:
+            with self._lock:
+                self.in_use -= 1
+
+    async def translate_async(self, client, text, src, dest):
+        return (await self._rpc_async(client, text, src, dest)).text
+
+    async def detect_async(self, client, text):
+        return (await self._rpc_async(client, text, 'auto', 'en')).src.lower()
+
+    def stats(self):
+        """返回池大小、使用中數量（含非同步呼叫）與借出等待時間"""
+        with self._lock:
+            result = {
+                "backend": self.name,
+                "pool_size": self.pool_size,
+                "in_use": self.in_use,
+                "max_in_use": self.max_in_use,
+                "calls": self.calls,
+            }
+        result["wait_time"] = self.wait_time.snapshot()
+        return result
+
+
+class StubBackend(TranslationBackend):
+    """本地替身後端：譯文為「[目標語言] 原文」，可設定模擬延遲"""
+
+    name = 'stub'
+    native_async = True
+
+    def __init__(self, latency=0.0, **options):
+        self.latency = latency
+        self._lock = threading.Lock()
+        self.calls = 0
+
+    def _wait(self):
+        with self._lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def translate(self, text, src, dest):
+        self._wait()
+        return f"[{dest}] {text}"
+
+    def translate_batch(self, texts, src, dest):
+        self._wait()
+        return [f"[{dest}] {text}" for text in texts]
+
+    def detect(self, text):
+        from lang_detect import detect
+        self._wait()
+        return detect(text)[0] or 'vi'
+
+    async def _wait_async(self):
+        with self._lock:
+            self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def translate_async(self, client, text, src, dest):
+        await self._wait_async()
+        return f"[{dest}] {text}"
+
+    async def translate_batch_async(self, client, texts, src, dest):
+        await self._wait_async()
+        return [f"[{dest}] {text}" for text in texts]
+
+    async def detect_async(self, client, text):
+        from lang_detect import detect
+        await self._wait_async()
+        return detect(text)[0] or 'vi'
+
+    def stats(self):
+        with self._lock:
+            return {"backend": self.name, "calls": self.calls, "latency": self.latency}
+
+
+BACKENDS = {
+    'googletrans': GoogletransBackend,
+    'stub': StubBackend,
+}
+
+
+def register_backend(name, factory):
+    """註冊新的翻譯後端，factory(**options) 需返回 TranslationBackend"""
+    BACKENDS[name] = factory
+
+
+def create_backend(name='googletrans', **options):
+    """依名稱建立翻譯後端"""
+    try:
+        factory = BACKENDS[name]
+    except KeyError:
+        raise ValueError(f"未知的翻譯後端: {name}（可用: {', '.join(sorted(BACKENDS))}）")
+    return factory(**options)
+
+
+def gunicorn_threads(default=1):
+    """從 gunicorn 的命令列或 GUNICORN_CMD_ARGS 讀取 --threads（worker 是由 master fork 出來的，sys.argv 相同）"""
+    args = shlex.split(os.getenv('GUNICORN_CMD_ARGS', '')) + sys.argv[1:]
+    threads = None
+    for i, arg in enumerate(args):
+        if arg == '--threads' and i + 1 < len(args):
+            threads = args[i + 1]
+        elif arg.startswith('--threads='):
+            threads = arg.split('=', 1)[1]
+    try:
+        return max(1, int(threads)) if threads is not None else default
+    except ValueError:
+        return default
@@ -0,0 +1,93 @@
+"""
+翻譯結果快取
+以（正規化文字, 來源語言, 目標語言）為鍵，LRU + TTL 淘汰，並限制記憶體用量
+"""
+import re
+import sys
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+_WHITESPACE_RE = re.compile(r'\s+')
+
+# 每個條目除了字串本身以外的大約額外開銷（tuple、OrderedDict 節點等）
+_ENTRY_OVERHEAD = 200
+
+
+def normalize_text(text):
+    """正規化輸入文字：Unicode NFC、去除首尾空白、合併連續空白"""
+    text = unicodedata.normalize('NFC', text or '')
+    return _WHITESPACE_RE.sub(' ', text).strip()
+
+
+class TranslationCache:
+    """執行緒安全的翻譯快取"""
+
+    def __init__(self, max_bytes=8 * 1024 * 1024, ttl=86400):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(text, src, dest):
+        return (normalize_text(text), src, dest)
+
+    @staticmethod
+    def _entry_size(key, value):
+        return sys.getsizeof(key[0]) + sys.getsizeof(value) + _ENTRY_OVERHEAD
+
+    def get(self, text, src, dest):
+        """查詢快取，未命中或已過期返回 None"""
+        key = self.make_key(text, src, dest)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires_at, size = entry
+            if expires_at <= now:
+                del self._entries[key]
+                self.current_bytes -= size
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, text, src, dest, value):
+        """寫入快取，超出記憶體預算時淘汰最久未使用的條目"""
+        key = self.make_key(text, src, dest)
+        size = self._entry_size(key, value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.current_bytes -= old[2]
+            self._entries[key] = (value, time.monotonic() + self.ttl, size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+                self.evictions += 1
+
+    def stats(self):
+        """返回快取統計"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,182 @@
+"""
+持久化翻譯記憶
+以 SQLite（WAL 模式）保存翻譯結果，重新部署或重啟後仍可使用；
+多個 gunicorn worker 可同時讀寫同一個資料庫檔案
+"""
+import os
+import sqlite3
+import threading
+import time
+
+from translation_cache import normalize_text
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS translations (
+    text TEXT NOT NULL,
+    src TEXT NOT NULL,
+    dest TEXT NOT NULL,
+    translated TEXT NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    last_used REAL NOT NULL,
+    PRIMARY KEY (text, src, dest)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS translations_last_used ON translations (last_used);
+"""
+
+
+class TranslationMemory:
+    """磁碟上的翻譯記憶，超過條目上限時刪除最久未使用的條目"""
+
+    def __init__(self, path, max_entries=100000, busy_timeout=5.0, touch_batch=64, touch_interval=30):
+        self.path = path
+        self.max_entries = max_entries
+        self.busy_timeout = busy_timeout
+        self.touch_batch = touch_batch
+        self.touch_interval = touch_interval
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # 命中時的最後使用時間先累積在記憶體，批次寫回以免每次讀取都搶寫入鎖
+        self._touches = {}
+        self._last_flush = time.monotonic()
+        self._puts_since_prune = 0
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.pruned = 0
+        self.errors = 0
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._connect().executescript(_SCHEMA)
+
+    def _connect(self):
+        """每個執行緒各自使用一條連線（sqlite3 連線不可跨執行緒共用）"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def get(self, text, src, dest):
+        """查詢翻譯記憶，未命中返回 None"""
+        key = (normalize_text(text), src, dest)
+        try:
+            row = self._connect().execute(
+                'SELECT translated FROM translations WHERE text=? AND src=? AND dest=?', key).fetchone()
+        except sqlite3.Error as e:
+            self._record_error('讀取', e)
+            return None
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._touches[key] = self._touches.get(key, 0) + 1
+            flush = (len(self._touches) >= self.touch_batch
+                     or time.monotonic() - self._last_flush >= self.touch_interval)
+        if flush:
+            self.flush()
+        return row[0]
+
+    def put(self, text, src, dest, translated):
+        """寫入翻譯記憶，定期刪除超出上限的最久未使用條目"""
+        key = (normalize_text(text), src, dest)
+        now = time.time()
+        try:
+            self._connect().execute(
+                'INSERT INTO translations (text, src, dest, translated, hits, created_at, last_used) '
+                'VALUES (?, ?, ?, ?, 0, ?, ?) '
+                'ON CONFLICT (text, src, dest) DO UPDATE SET translated=excluded.translated, '
+                'last_used=excluded.last_used',
+                key + (translated, now, now))
+        except sqlite3.Error as e:
+            self._record_error('寫入', e)
+            return
+        with self._lock:
+            self.writes += 1
+            self._puts_since_prune += 1
+            # 每寫入上限的 1% 才檢查一次條目數，讓 COUNT(*) 的成本分攤到多次寫入
+            prune = self._puts_since_prune >= max(1, self.max_entries // 100)
+            if prune:
+                self._puts_since_prune = 0
+        if prune:
+            self.prune()
+
+    def flush(self):
+        """把累積的命中次數與最後使用時間寫回資料庫"""
+        with self._lock:
+            touches, self._touches = self._touches, {}
+            self._last_flush = time.monotonic()
+        if not touches:
+            return
+        now = time.time()
+        try:
+            self._connect().executemany(
+                'UPDATE translations SET hits=hits+?, last_used=? WHERE text=? AND src=? AND dest=?',
+                [(count, now) + key for key, count in touches.items()])
+        except sqlite3.Error as e:
+            self._record_error('更新', e)
+
+    def prune(self):
+        """條目超過上限時刪除最久未使用的條目，保留上限的 90%，返回刪除數"""
+        self.flush()
+        conn = self._connect()
+        try:
+            count = conn.execute('SELECT COUNT(*) FROM translations').fetchone()[0]
+            if count <= self.max_entries:
+                return 0
+            excess = count - int(self.max_entries * 0.9)
+            deleted = conn.execute(
+                'DELETE FROM translations WHERE (text, src, dest) IN '
+                '(SELECT text, src, dest FROM translations ORDER BY last_used LIMIT ?)', (excess,)).rowcount
+        except sqlite3.Error as e:
+            self._record_error('清理', e)
+            return 0
+        with self._lock:
+            self.pruned += deleted
+        print(f"翻譯記憶已清理 {deleted} 筆最久未使用的條目")
+        return deleted
+
+    def hottest(self, limit):
+        """返回最常使用的 limit 筆 (text, src, dest, translated)"""
+        try:
+            return self._connect().execute(
+                'SELECT text, src, dest, translated FROM translations '
+                'ORDER BY hits DESC, last_used DESC LIMIT ?', (limit,)).fetchall()
+        except sqlite3.Error as e:
+            self._record_error('讀取', e)
+            return []
+
+    def warm(self, cache, limit):
+        """把最常使用的 limit 筆載入記憶體快取，返回載入筆數"""
+        rows = self.hottest(limit)
+        for text, src, dest, translated in rows:
+            cache.put(text, src, dest, translated)
+        return len(rows)
+
+    def _record_error(self, action, error):
+        with self._lock:
+            self.errors += 1
+        print(f"翻譯記憶{action}錯誤: {str(error)}")
+
+    def stats(self):
+        """返回翻譯記憶統計"""
+        try:
+            entries = self._connect().execute('SELECT COUNT(*) FROM translations').fetchone()[0]
+        except sqlite3.Error:
+            entries = None
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "path": self.path,
+                "entries": entries,
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                "writes": self.writes,
+                "pruned": self.pruned,
+                "errors": self.errors,
+            }
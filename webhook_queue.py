@@ -0,0 +1,90 @@
+"""
+Webhook 事件佇列
+/callback 驗證簽名後把事件依來源分組放入有界佇列並立即回應，
+由背景工作執行緒池依來源公平地取出處理（加權公平佇列），佇列滿時拒絕新的投遞（負載削減）
+"""
+import queue
+import threading
+
+from fair_queue import FairQueue
+
+
+class WebhookQueue:
+    """有界的 webhook 投遞佇列與工作執行緒池"""
+
+    def __init__(self, dispatch, maxsize=100, workers=4, put_timeout=0.05, weight=None, max_per_source=0):
+        self._dispatch = dispatch
+        self._queue = FairQueue(maxsize=maxsize, weight=weight, max_per_key=max_per_source)
+        self.maxsize = maxsize
+        self.num_workers = workers
+        self.put_timeout = put_timeout
+        self._threads = []
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.accepted = 0
+        self.rejected = 0
+        self.processed = 0
+        self.failed = 0
+
+    def start(self):
+        """啟動工作執行緒（在 gunicorn fork 之後的第一次投遞時呼叫）"""
+        with self._start_lock:
+            if self._threads:
+                return
+            for i in range(self.num_workers):
+                t = threading.Thread(target=self._worker, name=f"webhook-worker-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    def submit(self, item, source=None, cost=1.0):
+        """放入一筆項目（source 為公平排程的來源，cost 為處理成本，例如事件數）；
+        佇列已滿（或該來源已達上限）且等待 put_timeout 後仍無空位則返回 False"""
+        return self.submit_many([(item, source, cost)])
+
+    def submit_many(self, entries):
+        """一次放入一次投遞拆出的多筆 (項目, 來源, 成本)：全部放入或全部拒絕，
+        拒絕時 LINE 重送整個投遞不會重複處理已放入的部分"""
+        if not entries:
+            return True
+        self.start()
+        try:
+            self._queue.put_many(entries, block=self.put_timeout > 0, timeout=self.put_timeout)
+        except queue.Full:
+            with self._stats_lock:
+                self.rejected += len(entries)
+            return False
+        with self._stats_lock:
+            self.accepted += len(entries)
+        return True
+
+    def depth(self):
+        """目前排隊中的投遞數量"""
+        return self._queue.qsize()
+
+    def stats(self):
+        """返回佇列狀態"""
+        with self._stats_lock:
+            return {
+                "depth": self.depth(),
+                "sources": self._queue.sources(),
+                "maxsize": self.maxsize,
+                "workers": self.num_workers,
+                "accepted": self.accepted,
+                "rejected": self.rejected,
+                "processed": self.processed,
+                "failed": self.failed,
+            }
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            try:
+                self._dispatch(item)
+                with self._stats_lock:
+                    self.processed += 1
+            except Exception as e:
+                with self._stats_lock:
+                    self.failed += 1
+                print(f"佇列事件處理錯誤: {e}")
+            finally:
+                self._queue.task_done()